@@ -27,30 +27,72 @@ import os
 import sys
 import json
 import time
+import random
+import socket
+import errno
+import struct
+import hashlib
+import hmac
+import base64
 import logging
+import fcntl
+import queue
 import argparse
+import threading
 import subprocess
+import uuid
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 
-try:
-    import requests
-except ImportError:
+
+def lazy_import(name: str):
+    """
+    Импорт модуля с загрузкой при первом обращении к его атрибутам
+    
+    Args:
+        name: Имя модуля
+        
+    Returns:
+        Модуль или None, если он не установлен
+    """
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# requests и cryptography загружаются только когда нужны: быстрый выход
+# --auto (см. auto_nothing_due) не тратит время на их импорт
+requests = lazy_import("requests")
+if requests is None:
     print("ОШИБКА: Необходимо установить модуль 'requests'")
     print("Выполните: pip install requests")
     sys.exit(1)
 
-try:
-    from cryptography import x509
-    from cryptography.x509.oid import NameOID, ExtensionOID
-    from cryptography.hazmat.primitives import hashes, serialization
-    from cryptography.hazmat.primitives.asymmetric import rsa
-    from cryptography.hazmat.backends import default_backend
-except ImportError:
+if importlib.util.find_spec("cryptography") is None:
     print("ОШИБКА: Необходимо установить модуль 'cryptography'")
     print("Выполните: pip install cryptography")
     sys.exit(1)
 
+# Certbot нужен только для плагина regru-api (опционально). При запуске
+# как скрипта плагин не нужен - не тратим время на импорт certbot
+CERTBOT_AVAILABLE = False
+if __name__ != "__main__":
+    try:
+        from acme import challenges as acme_challenges
+        from certbot import errors as certbot_errors
+        from certbot import interfaces as certbot_interfaces
+        from certbot.plugins import common as certbot_common
+        CERTBOT_AVAILABLE = True
+    except ImportError:
+        pass
+
 # ==============================================================================
 # КОНФИГУРАЦИЯ
 # ==============================================================================
@@ -61,9 +103,32 @@ DEFAULT_CONFIG = {
     "regru_username": "your_username",
     "regru_password": "your_password",
     
+    # Ограничение частоты запросов к API reg.ru (общее для всех процессов на хосте)
+    "regru_rate_limit_per_minute": 20,  # 0 - без ограничения
+    "regru_rate_limit_burst": 5,
+    "regru_rate_limit_file": "/run/letsencrypt-regru/regru-ratelimit.json",
+    "regru_max_retries": 3,          # Повторы при превышении лимита, таймаутах и ошибках 5xx
+    "regru_retry_base_delay": 1.0,   # Минимальная задержка между повторами (секунды)
+    "regru_retry_max_delay": 30.0,   # Максимальная задержка между повторами (секунды)
+    "regru_cooldown_seconds": 600,   # Пауза в запросах после блокировки по лимиту (секунды)
+    "regru_zone_cache_ttl": 300,     # Время жизни кэша DNS записей зоны (секунды, 0 - без кэша)
+    "regru_zone_list_ttl": 3600,     # Время жизни кэша списка зон аккаунта (секунды)
+    # Дополнительные аккаунты reg.ru (основной - regru_username/regru_password).
+    # У каждого аккаунта своя сессия, свой лимит частоты и своя пауза после блокировки;
+    # запросы к разным аккаунтам выполняются параллельно. Зона без явного аккаунта
+    # относится к аккаунту, в списке зон которого она есть, например:
+    # "regru_accounts": {
+    #     "clients": {"username": "...", "password": "...", "zones": ["example.org"],
+    #                 "rate_limit_per_minute": 20, "rate_limit_burst": 5}
+    # }
+    "regru_accounts": {},
+    
     # Параметры домена
     "domain": "example.com",
     "wildcard": True,  # Создавать wildcard сертификат (*.domain.com)
+    # Дополнительные имена сертификата (в том числе из других зон аккаунта),
+    # например: ["api.eu.example.com", "*.example.org"]
+    "extra_domains": [],
     
     # Email для уведомлений Let's Encrypt
     "email": "admin@example.com",
@@ -76,6 +141,54 @@ DEFAULT_CONFIG = {
     "dns_propagation_wait": 60,  # Время ожидания распространения DNS (секунды)
     "dns_check_attempts": 10,     # Количество попыток проверки DNS
     "dns_check_interval": 10,     # Интервал между проверками DNS (секунды)
+    "dns_poll_initial_interval": 2,  # Начальный интервал опроса DNS (секунды)
+    "dns_poll_max_interval": 15,     # Максимальный интервал опроса DNS (секунды)
+    "dns_nameservers": [],           # DNS серверы для проверки (пусто - из /etc/resolv.conf)
+    "dns_query_timeout": 3,          # Таймаут одного DNS запроса (секунды)
+    "dns_verify_mode": "authoritative",  # Проверка: authoritative (все NS зоны) или resolver
+    "dns_quorum": "all",             # Сколько авторитетных серверов должны видеть запись ("all" или число)
+    "challenge_record_ttl": 60,      # TTL записей challenge (бэкенды rfc2136; на reg.ru действует TTL зоны)
+    # Предел ожидания по истории задержек: перцентиль + запас (значения выше - только верхняя граница)
+    "dns_latency_history_size": 200,  # Замеров на зону в истории (0 - не использовать историю)
+    "dns_latency_percentile": 99,
+    "dns_latency_margin": 10,         # Запас к перцентилю (секунды)
+    
+    # Способ прохождения DNS challenge: manual (hook скрипты) или regru-api (плагин certbot,
+    # регистрируется make install-certbot-plugin)
+    "certbot_authenticator": "manual",
+    
+    # Удаление TXT записей challenge: immediate (в cleanup hook) или deferred
+    # (cleanup hook только ставит запись в очередь, очередь удаляется одним
+    # запросом после завершения certbot или при следующем запуске --auto)
+    "dns_cleanup_mode": "immediate",
+    
+    # Делегирование _acme-challenge.<домен> через CNAME в отдельную зону валидации:
+    # {"example.com": "acme"} или {"example.com": {"backend": "acme", "target": "example-com.acme.example.net"}}
+    # (без target цель определяется по CNAME записи)
+    "challenge_delegation": {},
+    
+    # Бэкенды зон валидации: {"acme": {"type": "builtin" | "rfc2136" | "regru", "zone": "acme.example.net", ...}}
+    #   builtin: встроенный DNS сервер (--challenge-responder): listen, port, ns_name, ns_address (IPv4/IPv6), address, ttl
+    #   rfc2136: server, port, key_name, key_secret, key_algorithm, ttl
+    #   regru:   зона валидации на reg.ru
+    # nameservers - IP адреса для проверки распространения (по умолчанию NS зоны)
+    "challenge_backends": {},
+    
+    # Сборка оставшихся TXT записей _acme-challenge (--gc-challenges)
+    "challenge_gc_min_age": 3600,    # Не удалять записи моложе (секунды)
+    "challenge_gc_batch_size": 50,   # Операций в одном запросе zone/update_records
+    
+    # Время простоя, после которого сервер hooks завершается (секунды)
+    "hook_server_idle_timeout": 300,
+    "hook_socket": "",               # Unix сокет сервера hooks (пусто - state_dir/hook.sock)
+    "hook_client_timeout": 900,      # Максимальное время ответа сервера hooks (секунды)
+    
+    # Директория для файлов состояния между запусками
+    "state_dir": "/var/lib/letsencrypt-regru",
+    
+    # Определение публичного IP адреса (для диагностики доступа к API reg.ru)
+    "public_ip_cache_ttl": 3600,   # Время жизни кэша IP адреса (секунды)
+    "public_ip_timeout": 5,        # Таймаут запроса к сервисам определения IP (секунды)
     
     # Параметры обновления сертификата
     "renewal_days": 30,           # За сколько дней до истечения обновлять (по умолчанию 30)
@@ -85,10 +198,16 @@ DEFAULT_CONFIG = {
     "npm_host": "http://10.10.10.14:81",  # Адрес NPM
     "npm_email": "admin@example.com",       # Email для входа в NPM
     "npm_password": "changeme",             # Пароль NPM
+    # Токен NPM кэшируется в state_dir/npm-tokens (файл на хост, только root) и
+    # обновляется, когда до истечения остаётся меньше этого времени (секунды).
+    # Токен NPM живёт сутки: при запуске таймера раз в 12 часов вход по паролю не нужен
+    "npm_token_refresh_before": 43200,
 }
 
 # API endpoints для reg.ru
 REGRU_API_URL = "https://api.reg.ru/api/regru2"
+# Типы услуг reg.ru, у которых есть DNS зона (service/get_list)
+REGRU_ZONE_SERVICE_TYPES = ("domain", "srv_dns_both")
 
 # ==============================================================================
 # НАСТРОЙКА ЛОГИРОВАНИЯ
@@ -140,1270 +259,5057 @@ def setup_logging(log_file: str, verbose: bool = False) -> logging.Logger:
 
 
 # ==============================================================================
-# КЛАСС ДЛЯ РАБОТЫ С API REG.RU
+# ФАЙЛЫ СОСТОЯНИЯ
 # ==============================================================================
 
-class RegRuAPI:
-    """Класс для работы с API reg.ru"""
+def read_json_file(path: str, default=None):
+    """
+    Чтение JSON файла состояния
+    
+    Args:
+        path: Путь к файлу
+        default: Значение, если файл отсутствует или повреждён
+        
+    Returns:
+        Содержимое файла или default
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json_file(path: str, data, mode: int = 0o600):
+    """
+    Атомарная запись JSON файла состояния (через временный файл и rename)
+    
+    Args:
+        path: Путь к файлу
+        data: Данные для записи
+        mode: Права доступа к файлу
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, path)
+
+
+def append_json_line(path: str, data: Dict):
+    """
+    Добавление строки в JSONL файл с блокировкой fcntl
+    
+    Если файл был заменён (сжатие, забор очереди), пока процесс ждал
+    блокировку, запись повторяется в новый файл.
+    
+    Args:
+        path: Путь к файлу
+        data: Данные для записи
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        with os.fdopen(fd, 'a', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                current = os.stat(path).st_ino
+            except FileNotFoundError:
+                continue
+            if current == os.fstat(f.fileno()).st_ino:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+                return
+
+
+def read_json_lines(path: str) -> List[Dict]:
+    """
+    Чтение JSONL файла (повреждённые строки пропускаются)
+    
+    Args:
+        path: Путь к файлу
+        
+    Returns:
+        Список записей (пустой, если файла нет)
+    """
+    entries = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return entries
+
+
+def lock_json_lines(path: str):
+    """
+    Открытие JSONL файла с эксклюзивной блокировкой fcntl для перезаписи
+    
+    Блокировка та же, что и в append_json_line. Если файл был заменён,
+    пока процесс ждал блокировку, блокируется новый файл.
+    
+    Args:
+        path: Путь к файлу
+        
+    Returns:
+        Открытый файл (блокировка снимается при закрытии)
+    """
+    while True:
+        lock = open(path, 'a', encoding='utf-8')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            current = os.stat(path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current == os.fstat(lock.fileno()).st_ino:
+            return lock
+        lock.close()
+
+
+def rewrite_json_lines(path: str, entries: List[Dict]):
+    """
+    Атомарная замена JSONL файла (вызывается под lock_json_lines)
+    
+    Args:
+        path: Путь к файлу
+        entries: Записи нового файла
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+# ==============================================================================
+# ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ
+# ==============================================================================
+
+class RateLimiter:
+    """
+    Ограничитель частоты запросов (token bucket)
     
-    def __init__(self, username: str, password: str, logger: logging.Logger):
+    Состояние корзины хранится в файле с блокировкой fcntl, поэтому лимит
+    общий для всех процессов на хосте (hooks, таймер, ручные запуски).
+    Запрос ждёт только тогда, когда лимит действительно исчерпан.
+    """
+    
+    def __init__(self, state_file: str, rate_per_minute: float, burst: int,
+                 logger: logging.Logger):
         """
-        Инициализация API клиента
+        Инициализация ограничителя
         
         Args:
-            username: Имя пользователя reg.ru
-            password: Пароль reg.ru
+            state_file: Файл состояния корзины (например, в /run)
+            rate_per_minute: Допустимое число запросов в минуту (0 - без ограничения)
+            burst: Максимальное число запросов подряд без ожидания
             logger: Logger объект
         """
-        self.username = username
-        self.password = password
+        self.state_file = state_file
+        self.rate = max(0.0, float(rate_per_minute)) / 60.0
+        self.burst = max(1, burst)
         self.logger = logger
-        self.session = requests.Session()
+        # Запасное состояние в памяти, если файл недоступен
+        self._local_state = {"tokens": float(self.burst), "updated": time.time()}
+        self._local_lock = threading.Lock()
     
-    def _make_request(self, method: str, params: Dict) -> Dict:
+    def _take(self, state: Dict) -> float:
         """
-        Выполнение запроса к API reg.ru
+        Пополнение корзины и попытка взять токен
         
         Args:
-            method: Название метода API
-            params: Параметры запроса
+            state: Состояние корзины (изменяется)
             
         Returns:
-            Ответ API в формате dict
+            0 если токен получен, иначе время ожидания до появления токена
         """
-        url = f"{REGRU_API_URL}/{method}"
+        now = time.time()
+        elapsed = max(0.0, now - state.get("updated", now))
+        tokens = min(float(self.burst), state.get("tokens", float(self.burst)) + elapsed * self.rate)
+        state["updated"] = now
+        if tokens >= 1:
+            state["tokens"] = tokens - 1
+            return 0.0
+        state["tokens"] = tokens
+        return (1 - tokens) / self.rate
+    
+    def _take_shared(self) -> float:
+        """Попытка взять токен из общего файла состояния"""
+        directory = os.path.dirname(self.state_file)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                wait = self._take(state)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                return wait
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    
+    def acquire(self) -> float:
+        """
+        Получение разрешения на запрос (с ожиданием при исчерпании лимита)
         
-        # Добавляем учетные данные к параметрам
-        params.update({
-            "username": self.username,
-            "password": self.password,
-            "output_format": "json"
-        })
+        Returns:
+            Общее время ожидания в секундах
+        """
+        if self.rate <= 0:
+            # Ограничение отключено (rate_per_minute = 0)
+            return 0.0
+        waited = 0.0
+        while True:
+            try:
+                wait = self._take_shared()
+            except OSError as e:
+                self.logger.debug(f"Файл ограничителя {self.state_file} недоступен ({e}), лимит локальный")
+                with self._local_lock:
+                    wait = self._take(self._local_state)
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+# ==============================================================================
+# ПУБЛИЧНЫЙ IP АДРЕС
+# ==============================================================================
+
+# Сервисы определения публичного IP адреса (опрашиваются одновременно)
+PUBLIC_IP_ENDPOINTS = ("https://api.ipify.org", "https://ipinfo.io/ip")
+
+
+def _fetch_public_ip(url: str, timeout: float, answers: "queue.Queue"):
+    """Запрос IP адреса у одного сервиса; результат (или None) - в очередь"""
+    address = None
+    try:
+        response = requests.get(url, timeout=timeout)
+        if response.status_code == 200:
+            candidate = response.text.strip()
+            family = socket.AF_INET6 if ":" in candidate else socket.AF_INET
+            socket.inet_pton(family, candidate)
+            address = candidate
+    except (requests.exceptions.RequestException, OSError, ValueError):
+        pass
+    answers.put(address)
+
+
+def detect_public_ip(cache_path: Optional[str], ttl: float, timeout: float = 5.0,
+                     logger: Optional[logging.Logger] = None) -> Optional[str]:
+    """
+    Определение публичного IP адреса
+    
+    Адрес берётся из кэша, пока он не устарел. Иначе все сервисы
+    PUBLIC_IP_ENDPOINTS опрашиваются одновременно и используется первый
+    ответ; запросы выполняются в фоновых потоках и не задерживают
+    завершение процесса.
+    
+    Args:
+        cache_path: Файл кэша (None - без кэша)
+        ttl: Время жизни кэша (секунды)
+        timeout: Таймаут запроса (секунды)
+        logger: Logger объект
         
+    Returns:
+        IP адрес или None, если ни один сервис не ответил
+    """
+    if cache_path:
+        cached = read_json_file(cache_path)
+        if cached and time.time() - cached.get("time", 0) <= ttl:
+            return cached.get("ip")
+    
+    answers: "queue.Queue" = queue.Queue()
+    for url in PUBLIC_IP_ENDPOINTS:
+        threading.Thread(target=_fetch_public_ip, args=(url, timeout, answers), daemon=True).start()
+    
+    address = None
+    deadline = time.monotonic() + timeout
+    for _ in PUBLIC_IP_ENDPOINTS:
         try:
-            self.logger.debug(f"Отправка запроса к API: {method}")
-            response = self.session.post(url, data=params, timeout=30)
-            response.raise_for_status()
-            
-            result = response.json()
-            
-            if result.get("result") == "success":
-                self.logger.debug(f"Запрос {method} выполнен успешно")
-                return result
-            else:
-                error_msg = result.get("error_text", "Неизвестная ошибка")
-                error_code = result.get("error_code", "unknown")
-                
-                # Обработка специфических ошибок
-                if "Access to API from this IP denied" in error_msg or error_code == "IP_DENIED":
-                    self.logger.error("=" * 80)
-                    self.logger.error("🚫 ОШИБКА ДОСТУПА К API REG.RU")
-                    self.logger.error("=" * 80)
-                    self.logger.error("❌ Доступ к API заблокирован для текущего IP адреса")
-                    self.logger.error("")
-                    self.logger.error("🔧 РЕШЕНИЕ ПРОБЛЕМЫ:")
-                    self.logger.error("1. Войдите в личный кабинет reg.ru")
-                    self.logger.error("2. Перейдите в 'Настройки' → 'Безопасность' → 'API'")
-                    self.logger.error("3. Добавьте текущий IP адрес в список разрешенных")
-                    self.logger.error("4. Или отключите ограничение по IP (менее безопасно)")
-                    self.logger.error("")
-                    self.logger.error("🌐 Текущий IP можно узнать командой:")
-                    self.logger.error("   curl -s https://ipinfo.io/ip")
-                    self.logger.error("   или на сайте: https://whatismyipaddress.com/")
-                    self.logger.error("")
-                    self.logger.error("📚 Документация API: https://www.reg.ru/support/api")
-                    self.logger.error("=" * 80)
-                elif "Invalid username or password" in error_msg:
-                    self.logger.error("=" * 80)
-                    self.logger.error("🔐 ОШИБКА АУТЕНТИФИКАЦИИ")
-                    self.logger.error("=" * 80)
-                    self.logger.error("❌ Неверные учетные данные")
-                    self.logger.error("🔧 Проверьте username и password в конфигурации")
-                    self.logger.error("=" * 80)
-                elif "IP exceeded allowed connection rate" in error_msg or error_code == "IP_EXCEEDED_ALLOWED_CONNECTION_RATE":
-                    self.logger.error("=" * 80)
-                    self.logger.error("⏱️  ОШИБКА: ПРЕВЫШЕН ЛИМИТ ЗАПРОСОВ К API")
-                    self.logger.error("=" * 80)
-                    self.logger.error("❌ IP адрес превысил допустимую частоту подключений к API reg.ru")
-                    self.logger.error("")
-                    self.logger.error("🔧 РЕШЕНИЕ ПРОБЛЕМЫ:")
-                    self.logger.error("1. Подождите 5-10 минут перед следующей попыткой")
-                    self.logger.error("2. Не запускайте скрипт слишком часто")
-                    self.logger.error("3. Используйте --test-api только для диагностики")
-                    self.logger.error("4. Настройте systemd timer для автоматических проверок (раз в день)")
-                    self.logger.error("")
-                    self.logger.error("📊 ЛИМИТЫ API REG.RU:")
-                    self.logger.error("   • Обычно: не более 10-20 запросов в минуту с одного IP")
-                    self.logger.error("   • Рекомендация: проверка сертификатов 1-2 раза в день")
-                    self.logger.error("")
-                    self.logger.error("⚙️  АВТОМАТИЗАЦИЯ:")
-                    self.logger.error("   sudo systemctl enable letsencrypt-regru.timer")
-                    self.logger.error("   sudo systemctl start letsencrypt-regru.timer")
-                    self.logger.error("=" * 80)
-                else:
-                    self.logger.error(f"Ошибка API reg.ru: {error_msg} (код: {error_code})")
-                
-                raise Exception(f"API Error: {error_msg}")
-                
-        except requests.exceptions.Timeout:
-            self.logger.error("Таймаут при обращении к API reg.ru (30 сек)")
-            raise
-        except requests.exceptions.ConnectionError:
-            self.logger.error("Ошибка соединения с API reg.ru. Проверьте интернет подключение")
-            raise
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Ошибка HTTP запроса: {e}")
-            raise
+            address = answers.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if address:
+            break
+    
+    if address and cache_path:
+        try:
+            write_json_file(cache_path, {"ip": address, "time": time.time()}, mode=0o644)
+        except OSError as e:
+            if logger:
+                logger.debug(f"Не удалось сохранить IP адрес в кэш: {e}")
+    return address
+
+
+# ==============================================================================
+# КЛАСС ДЛЯ РАБОТЫ С API REG.RU
+# ==============================================================================
+
+class RegRuAPIError(Exception):
+    """Ошибка API reg.ru"""
+    
+    def __init__(self, message: str, code: Optional[str] = None):
+        super().__init__(message)
+        self.code = code
+
+
+class RegRuAuthError(RegRuAPIError):
+    """Неверные учётные данные или доступ к API с текущего IP запрещён"""
+
+
+class RegRuRateLimitError(RegRuAPIError):
+    """Превышен лимит частоты запросов (IP_EXCEEDED_ALLOWED_CONNECTION_RATE)"""
+
+
+class RegRuTransientError(RegRuAPIError):
+    """Временная ошибка: таймаут, ошибка соединения или ответ 5xx"""
+    
+    def __init__(self, message: str, code: Optional[str] = None, sent: bool = True):
+        super().__init__(message, code)
+        # Запрос мог дойти до reg.ru и быть выполнен (False - соединение не установлено)
+        self.sent = sent
+
+
+class RegRuCircuitOpenError(RegRuAPIError):
+    """Запросы к API приостановлены после превышения лимита"""
+
+
+class CircuitBreaker:
+    """
+    Пауза в обращениях к API после блокировки по частоте запросов
+    
+    Срок окончания паузы хранится в файле, поэтому следующий запуск
+    (например, по таймеру systemd) не продлевает блокировку новыми запросами.
+    """
     
-    def get_zone_records(self, domain: str) -> List[Dict]:
+    def __init__(self, state_file: str, logger: logging.Logger):
         """
-        Получение DNS записей домена
+        Инициализация
         
         Args:
-            domain: Доменное имя
-            
-        Returns:
-            Список DNS записей
+            state_file: Файл с временем окончания паузы
+            logger: Logger объект
         """
-        self.logger.info(f"Получение DNS записей для домена: {domain}")
-        
-        # Задержка перед запросом (защита от rate limit)
-        import time
-        time.sleep(1)
-        
-        params = {
-            "domain_name": domain,
-        }
-        
-        result = self._make_request("zone/get_resource_records", params)
-        
-        if "answer" in result and "records" in result["answer"]:
-            records = result["answer"]["records"]
-            self.logger.info(f"Получено {len(records)} DNS записей")
-            return records
-        else:
-            self.logger.warning("DNS записи не найдены")
-            return []
+        self.state_file = state_file
+        self.logger = logger
+        self._until = 0.0
     
-    def add_txt_record(self, domain: str, subdomain: str, txt_value: str) -> bool:
+    def remaining(self) -> float:
         """
-        Добавление TXT записи для DNS валидации
+        Оставшееся время паузы
         
-        Args:
-            domain: Основной домен
-            subdomain: Поддомен (например, _acme-challenge)
-            txt_value: Значение TXT записи
-            
         Returns:
-            True если успешно, False в противном случае
+            Секунды до окончания паузы (0 если запросы разрешены)
         """
-        self.logger.info(f"Добавление TXT записи: {subdomain}.{domain} = {txt_value}")
-        
-        # Задержка перед запросом (защита от rate limit)
-        import time
-        time.sleep(2)
-        
-        params = {
-            "domain_name": domain,
-            "subdomain": subdomain,
-            "text": txt_value,
-            "output_content_type": "plain"
-        }
+        state = read_json_file(self.state_file, {}) or {}
+        until = max(self._until, state.get("until", 0))
+        return max(0.0, until - time.time())
+    
+    def open(self, seconds: float, reason: str):
+        """
+        Приостановка запросов
         
+        Args:
+            seconds: Длительность паузы
+            reason: Причина (для диагностики)
+        """
+        self._until = time.time() + seconds
         try:
-            self._make_request("zone/add_txt", params)
-            self.logger.info("TXT запись успешно добавлена")
-            return True
-        except Exception as e:
-            self.logger.error(f"Не удалось добавить TXT запись: {e}")
-            return False
+            write_json_file(self.state_file, {"until": self._until, "reason": reason})
+        except OSError as e:
+            self.logger.warning(f"Не удалось сохранить паузу API в {self.state_file}: {e}")
+
+
+class ZoneRecordCache:
+    """
+    Кэш DNS записей зон reg.ru с ограниченным временем жизни
     
-    def get_current_ip(self) -> str:
+    Снимок зоны хранится в памяти и (если задана директория) на диске,
+    чтобы hooks, запускаемые отдельными процессами, не загружали зону
+    повторно. Изменения через RegRuAPI применяются к снимку на месте.
+    Поиск записей идёт по индексу (rectype, subdomain, content), который
+    перестраивается только когда файл снимка изменил другой процесс.
+    """
+    
+    def __init__(self, cache_dir: Optional[str], ttl: float, logger: logging.Logger):
         """
-        Получение текущего публичного IP адреса
+        Инициализация
+        
+        Args:
+            cache_dir: Директория для файлов кэша (None - только в памяти)
+            ttl: Время жизни снимка зоны (секунды, 0 - кэш отключён)
+            logger: Logger объект
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.logger = logger
+        self._zones: Dict[str, Dict] = {}
+        self._indexes: Dict[str, Dict[Tuple[str, str, str], List[Dict]]] = {}
+        # Версия файла снимка (inode, mtime, размер), уже загруженная в память
+        self._versions: Dict[str, Tuple[int, int, int]] = {}
+    
+    @staticmethod
+    def record_key(record: Dict) -> Tuple[str, str, str]:
+        """
+        Ключ индекса для DNS записи
         
+        Args:
+            record: Запись в формате zone/get_resource_records
+            
         Returns:
-            IP адрес или 'Неизвестно'
+            Кортеж (rectype, subdomain, content)
         """
+        return (
+            str(record.get("rectype", "")).upper(),
+            str(record.get("subname", record.get("subdomain", ""))).lower(),
+            str(record.get("content", record.get("text", ""))),
+        )
+    
+    def _path(self, domain: str) -> Optional[str]:
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, f"zone-{domain.lower()}.json")
+    
+    @staticmethod
+    def _version(path: str) -> Optional[Tuple[int, int, int]]:
+        """Версия файла: запись атомарная (новый inode), поэтому изменение видно всегда"""
         try:
-            response = requests.get("https://ipinfo.io/ip", timeout=10)
-            if response.status_code == 200:
-                return response.text.strip()
-        except:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+    
+    def _load(self, domain: str) -> Optional[Dict]:
+        """Снимок зоны из памяти или с диска (без проверки срока жизни)"""
+        snapshot = self._zones.get(domain)
+        path = self._path(domain)
+        if not path:
+            return snapshot
+        
+        version = self._version(path)
+        if version == self._versions.get(domain):
+            return snapshot
+        if version is None:
+            # Файл удалён другим процессом (invalidate) - снимок больше не достоверен
+            self._versions.pop(domain, None)
+            self._zones.pop(domain, None)
+            self._indexes.pop(domain, None)
+            return None
+        
+        stored = read_json_file(path)
+        self._versions[domain] = version
+        if stored and (not snapshot or stored.get("fetched", 0) >= snapshot["fetched"]):
+            snapshot = stored
+            self._set(domain, snapshot, persist=False)
+        return snapshot
+    
+    def _set(self, domain: str, snapshot: Dict, persist: bool = True):
+        self._zones[domain] = snapshot
+        index: Dict[Tuple[str, str, str], List[Dict]] = {}
+        for record in snapshot["records"]:
+            index.setdefault(self.record_key(record), []).append(record)
+        self._indexes[domain] = index
+        
+        path = self._path(domain)
+        if persist and path:
             try:
-                response = requests.get("https://api.ipify.org", timeout=10)
-                if response.status_code == 200:
-                    return response.text.strip()
-            except:
-                pass
-        return "Неизвестно"
+                write_json_file(path, snapshot)
+                self._versions[domain] = self._version(path)
+            except OSError as e:
+                self.logger.debug(f"Не удалось сохранить кэш зоны {domain}: {e}")
     
-    def test_api_access(self) -> bool:
+    def get(self, domain: str) -> Optional[List[Dict]]:
         """
-        Проверка доступности API reg.ru
+        Записи зоны из кэша
         
+        Args:
+            domain: Доменное имя
+            
         Returns:
-            True если API доступен
+            Список записей или None, если снимка нет или он устарел
         """
-        # Получаем текущий IP
-        current_ip = self.get_current_ip()
-        self.logger.info(f"Текущий IP адрес: {current_ip}")
-        self.logger.info("Проверка доступности API reg.ru...")
+        if self.ttl <= 0:
+            return None
+        snapshot = self._load(domain)
+        if not snapshot or time.time() - snapshot.get("fetched", 0) > self.ttl:
+            return None
+        return snapshot["records"]
+    
+    def put(self, domain: str, records: List[Dict]):
+        """
+        Сохранение свежего снимка зоны
         
-        try:
-            # Небольшая задержка перед запросом (защита от rate limit)
-            import time
-            time.sleep(1)
-            
-            # Простой запрос для проверки доступа
-            params = {}
-            result = self._make_request("user/get_balance", params)
-            
-            if result and result.get("result") == "success":
-                balance = result.get("answer", {}).get("prepay", "Неизвестно")
-                self.logger.info(f"✅ API reg.ru доступен. Баланс: {balance} руб.")
-                return True
-            else:
-                self.logger.error("❌ API reg.ru недоступен")
-                return False
-                
-        except Exception as e:
-            self.logger.error(f"❌ Не удалось подключиться к API reg.ru: {e}")
-            return False
+        Args:
+            domain: Доменное имя
+            records: Записи зоны
+        """
+        if self.ttl > 0:
+            self._set(domain, {"fetched": time.time(), "records": list(records)})
     
-    def remove_txt_record(self, domain: str, subdomain: str, txt_value: str) -> bool:
+    def find(self, domain: str, rectype: str, subdomain: str,
+             content: Optional[str] = None) -> Optional[List[Dict]]:
         """
-        Удаление TXT записи
+        Поиск записей в снимке зоны по индексу
         
         Args:
-            domain: Основной домен
+            domain: Доменное имя
+            rectype: Тип записи (TXT, A, ...)
             subdomain: Поддомен
-            txt_value: Значение TXT записи
+            content: Содержимое записи (None - любое)
             
         Returns:
-            True если успешно, False в противном случае
+            Найденные записи или None, если снимка нет или он устарел
         """
-        self.logger.info(f"Удаление TXT записи: {subdomain}.{domain}")
+        if self.get(domain) is None:
+            return None
+        index = self._indexes.get(domain, {})
+        if content is not None:
+            return list(index.get((rectype.upper(), subdomain.lower(), content), []))
+        return [record for key, records in index.items()
+                if key[:2] == (rectype.upper(), subdomain.lower()) for record in records]
+    
+    def apply(self, domain: str, action: str, rectype: str, subdomain: str, content: str):
+        """
+        Применение изменения, выполненного через API, к снимку зоны
         
-        try:
-            # Сначала получаем список всех записей
-            records = self.get_zone_records(domain)
-            
-            # Ищем нужную TXT запись
-            record_id = None
-            for record in records:
-                if (record.get("rectype") == "TXT" and 
-                    record.get("subdomain") == subdomain and 
-                    record.get("text") == txt_value):
-                    record_id = record.get("id")
-                    break
-            
-            if not record_id:
-                self.logger.warning("TXT запись для удаления не найдена")
-                # Не считаем это критической ошибкой
-                return True
-            
-            params = {
-                "domain_name": domain,
-                "record_id": record_id
-            }
-            
-            self._make_request("zone/remove_record", params)
-            self.logger.info("TXT запись успешно удалена")
-            return True
-            
-        except Exception as e:
-            self.logger.error(f"Не удалось удалить TXT запись: {e}")
-            # Для cleanup hook не критично, если не удалось удалить
-            self.logger.warning("Продолжаем выполнение, несмотря на ошибку удаления")
-            return True
-
+        Args:
+            domain: Доменное имя
+            action: add (добавление) или remove (удаление)
+            rectype: Тип записи
+            subdomain: Поддомен
+            content: Содержимое записи
+        """
+        snapshot = self._load(domain)
+        if not snapshot:
+            return
+        record = {"rectype": rectype.upper(), "subname": subdomain, "content": content}
+        key = self.record_key(record)
+        if action == "add":
+            records = snapshot["records"] + [record]
+        else:
+            records = [r for r in snapshot["records"] if self.record_key(r) != key]
+        self._set(domain, {"fetched": snapshot["fetched"], "records": records})
+    
+    def invalidate(self, domain: str):
+        """
+        Сброс снимка зоны (например, после изменения с неизвестным результатом)
+        
+        Args:
+            domain: Доменное имя
+        """
+        self._zones.pop(domain, None)
+        self._indexes.pop(domain, None)
+        self._versions.pop(domain, None)
+        path = self._path(domain)
+        if path:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
 
-# ==============================================================================
-# КЛАСС ДЛЯ РАБОТЫ С NGINX PROXY MANAGER
-# ==============================================================================
 
-class NginxProxyManagerAPI:
-    """Класс для работы с API Nginx Proxy Manager"""
+class ZoneIndex:
+    """
+    Список зон аккаунта reg.ru с поиском зоны по имени
+    
+    Зоны хранятся в дереве по меткам в обратном порядке (com → example → eu),
+    поэтому зона имени находится за число шагов, равное числу его меток;
+    выбирается самая длинная подходящая зона. Список кэшируется в памяти
+    и (если задан файл) на диске с ограниченным временем жизни.
+    """
+    
+    # Ключ узла дерева с именем зоны (метка DNS не бывает пустой)
+    ZONE = ""
     
-    def __init__(self, host: str, email: str, password: str, logger: logging.Logger):
+    def __init__(self, cache_path: Optional[str], ttl: float, logger: logging.Logger):
         """
-        Инициализация API клиента NPM
+        Инициализация
         
         Args:
-            host: URL адрес NPM (например, http://10.10.10.14:81)
-            email: Email для входа
-            password: Пароль
+            cache_path: Файл кэша списка зон (None - только в памяти)
+            ttl: Время жизни списка (секунды)
             logger: Logger объект
         """
-        self.host = host.rstrip('/')
-        self.email = email
-        self.password = password
+        self.cache_path = cache_path
+        self.ttl = ttl
         self.logger = logger
-        self.session = requests.Session()
-        self.token = None
+        self.zones: List[str] = []
+        self.fetched = 0.0
+        self._trie: Dict = {}
+        self._reload()
     
-    def login(self) -> bool:
+    def _reload(self):
+        """Загрузка списка с диска, если он свежее списка в памяти"""
+        if not self.cache_path:
+            return
+        stored = read_json_file(self.cache_path)
+        if stored and stored.get("fetched", 0) > self.fetched:
+            self._build(stored.get("zones", []), stored["fetched"])
+    
+    def _build(self, zones: List[str], fetched: float):
+        trie: Dict = {}
+        for zone in zones:
+            zone = zone.lower().rstrip(".")
+            node = trie
+            for label in reversed(zone.split(".")):
+                node = node.setdefault(label, {})
+            node[self.ZONE] = zone
+        self.zones = sorted(set(zone.lower().rstrip(".") for zone in zones))
+        self.fetched = fetched
+        self._trie = trie
+    
+    def fresh(self) -> bool:
         """
-        Авторизация в Nginx Proxy Manager
+        Действителен ли список зон
         
         Returns:
-            True если успешно
+            True если список загружен и не устарел
         """
-        url = f"{self.host}/api/tokens"
+        if time.time() - self.fetched > self.ttl:
+            self._reload()
+        return self.fetched > 0 and time.time() - self.fetched <= self.ttl
+    
+    def update(self, zones: List[str]):
+        """
+        Сохранение свежего списка зон
         
-        payload = {
-            "identity": self.email,
-            "secret": self.password
-        }
+        Args:
+            zones: Зоны аккаунта
+        """
+        self._build(zones, time.time())
+        if self.cache_path:
+            try:
+                write_json_file(self.cache_path, {"fetched": self.fetched, "zones": self.zones})
+            except OSError as e:
+                self.logger.debug(f"Не удалось сохранить список зон: {e}")
+    
+    def lookup(self, name: str) -> Optional[Tuple[str, str]]:
+        """
+        Поиск зоны, в которую входит имя
         
-        try:
-            self.logger.info("Авторизация в Nginx Proxy Manager...")
-            response = self.session.post(url, json=payload, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
-            self.token = data.get("token")
+        Args:
+            name: Полное имя (например, _acme-challenge.api.eu.example.com)
             
-            if self.token:
-                # Устанавливаем токен в заголовки для последующих запросов
-                self.session.headers.update({
-                    "Authorization": f"Bearer {self.token}"
-                })
-                self.logger.info("Авторизация в NPM успешна")
-                return True
-            else:
-                self.logger.error("Токен не получен при авторизации")
-                return False
-                
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Ошибка при авторизации в NPM: {e}")
-            return False
+        Returns:
+            Кортеж (зона, поддомен относительно зоны) или None.
+            Для имени, совпадающего с зоной, поддомен - "@"
+        """
+        labels = name.lower().rstrip(".").split(".")
+        node = self._trie
+        match = None
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                break
+            if self.ZONE in node:
+                match = (node[self.ZONE], depth)
+        if match is None:
+            return None
+        zone, depth = match
+        return zone, ".".join(labels[:len(labels) - depth]) or "@"
+
+
+class ChallengeLedger:
+    """
+    Журнал опубликованных TXT записей challenge (append-only JSONL)
     
-    def get_certificates(self) -> List[Dict]:
+    Каждая строка - событие add или remove с доменом, поддоменом, значением
+    записи (токеном валидации certbot), ID записи (если reg.ru его вернул)
+    и временем. По журналу cleanup удаляет запись без загрузки зоны,
+    а оставшиеся записи легко найти позже.
+    """
+    
+    # Сжимать журнал, когда в нём накопилось столько удалённых записей
+    COMPACT_AFTER = 500
+    
+    def __init__(self, path: str, logger: logging.Logger):
         """
-        Получение списка сертификатов
+        Инициализация
         
-        Returns:
-            Список сертификатов
+        Args:
+            path: Путь к файлу журнала
+            logger: Logger объект
         """
-        url = f"{self.host}/api/nginx/certificates"
+        self.path = path
+        self.logger = logger
+    
+    def _replay(self) -> Tuple[Dict[str, Dict], int]:
+        """Активные записи по значению и число удалённых записей в журнале"""
+        active: Dict[str, Dict] = {}
+        removed = 0
+        for event in read_json_lines(self.path):
+            if event.get("event") == "add":
+                active[event["value"]] = event
+            elif active.pop(event.get("value"), None) is not None:
+                removed += 1
+        return active, removed
+    
+    def record_added(self, domain: str, subdomain: str, value: str, record_id=None,
+                     backend: Optional[str] = None):
+        """
+        Запись о публикации TXT записи
         
+        Args:
+            domain: Основной домен
+            subdomain: Поддомен
+            value: Значение TXT записи (токен валидации)
+            record_id: ID записи в reg.ru (если известен)
+            backend: Бэкенд зоны валидации (None - API reg.ru)
+        """
+        event = {"event": "add", "domain": domain, "subdomain": subdomain,
+                 "value": value, "record_id": record_id, "time": time.time()}
+        if backend:
+            event["backend"] = backend
         try:
-            self.logger.debug("Получение списка сертификатов из NPM...")
-            response = self.session.get(url, timeout=10)
-            response.raise_for_status()
-            
-            certificates = response.json()
-            self.logger.debug(f"Получено {len(certificates)} сертификатов")
-            return certificates
+            append_json_line(self.path, event)
+        except OSError as e:
+            self.logger.warning(f"Не удалось записать в журнал challenge {self.path}: {e}")
+    
+    def record_removed(self, value: str):
+        """
+        Запись об удалении TXT записи
+        
+        Args:
+            value: Значение TXT записи (токен валидации)
+        """
+        try:
+            append_json_line(self.path, {"event": "remove", "value": value, "time": time.time()})
+            # Активные записи пересчитываются в compact() под блокировкой:
+            # снимок, прочитанный здесь, не видит add других процессов
+            if self._replay()[1] >= self.COMPACT_AFTER:
+                self.compact()
+        except OSError as e:
+            self.logger.warning(f"Не удалось записать в журнал challenge {self.path}: {e}")
+    
+    def get(self, value: str) -> Optional[Dict]:
+        """
+        Поиск опубликованной записи по токену валидации
+        
+        Args:
+            value: Значение TXT записи (токен валидации)
             
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Ошибка при получении списка сертификатов: {e}")
-            return []
+        Returns:
+            Событие add (domain, subdomain, value, record_id, time) или None
+        """
+        return self._replay()[0].get(value)
+    
+    def active(self) -> List[Dict]:
+        """
+        Опубликованные и ещё не удалённые записи
+        
+        Returns:
+            События add в порядке публикации
+        """
+        return sorted(self._replay()[0].values(), key=lambda event: event.get("time", 0))
+    
+    def compact(self):
+        """
+        Перезапись журнала только с активными записями
+        
+        Активные записи читаются под той же блокировкой, что и в
+        append_json_line, поэтому добавленные другими процессами
+        события не теряются.
+        """
+        with lock_json_lines(self.path):
+            active = self._replay()[0]
+            rewrite_json_lines(self.path, sorted(active.values(), key=lambda event: event.get("time", 0)))
 
-    def get_certificate_by_id(self, cert_id: int) -> Optional[Dict]:
-        """Возвращает данные сертификата по ID из NPM"""
-        url = f"{self.host}/api/nginx/certificates/{cert_id}"
-        try:
-            self.logger.debug(f"Запрос сертификата ID={cert_id} из NPM...")
-            response = self.session.get(url, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            self.logger.warning(f"Не удалось получить сертификат ID {cert_id}: {e}")
-            return None
 
-    def wait_for_certificate_parse(self, cert_id: int, timeout_seconds: int = 30, interval_seconds: float = 2.0) -> Optional[Dict]:
+class RegRuAPI:
+    """Класс для работы с API reg.ru"""
+    
+    def __init__(self, username: str, password: str, logger: logging.Logger,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 circuit_breaker: Optional["CircuitBreaker"] = None,
+                 max_retries: int = 3, retry_base_delay: float = 1.0,
+                 retry_max_delay: float = 30.0, cooldown_seconds: int = 600,
+                 zone_cache: Optional[ZoneRecordCache] = None,
+                 ledger: Optional[ChallengeLedger] = None,
+                 zone_index: Optional[ZoneIndex] = None,
+                 ip_cache_file: Optional[str] = None, ip_cache_ttl: float = 3600,
+                 ip_timeout: float = 5.0):
         """
-        Ожидает, пока NPM распарсит загруженный сертификат и заполнит поля domain_names и expires_on.
-
-        Возвращает актуальные данные сертификата или None по таймауту.
+        Инициализация API клиента
+        
+        Args:
+            username: Имя пользователя reg.ru
+            password: Пароль reg.ru
+            logger: Logger объект
+            rate_limiter: Общий ограничитель частоты запросов (по умолчанию - лимит по умолчанию)
+            circuit_breaker: Пауза после блокировки по лимиту (по умолчанию - файл в state_dir)
+            max_retries: Число повторов при временных ошибках
+            retry_base_delay: Минимальная задержка между повторами (секунды)
+            retry_max_delay: Максимальная задержка между повторами (секунды)
+            cooldown_seconds: Длительность паузы после превышения лимита (секунды)
+            zone_cache: Кэш DNS записей зон (по умолчанию - только в памяти)
+            ledger: Журнал опубликованных TXT записей (по умолчанию - без журнала)
+            zone_index: Список зон аккаунта (по умолчанию - только в памяти)
+            ip_cache_file: Файл кэша публичного IP адреса (None - без кэша)
+            ip_cache_ttl: Время жизни кэша IP адреса (секунды)
+            ip_timeout: Таймаут определения IP адреса (секунды)
         """
-        start = time.time()
-        last: Optional[Dict] = None
-        while time.time() - start < timeout_seconds:
-            cert = self.get_certificate_by_id(cert_id)
-            if cert:
-                last = cert
-                domains = cert.get('domain_names', []) or []
-                created_on = cert.get('created_on')
-                expires_on = cert.get('expires_on')
-                self.logger.debug(f"Проверка парсинга NPM: domains={domains}, expires_on={expires_on}, created_on={created_on}")
-                # Готово: домены определены и expires_on отличается от created_on
-                if domains and expires_on and (not created_on or expires_on != created_on):
-                    self.logger.info("NPM завершил парсинг сертификата")
-                    return cert
-            time.sleep(interval_seconds)
-        return last
+        self.username = username
+        self.password = password
+        self.logger = logger
+        self.session = requests.Session()
+        self.rate_limiter = rate_limiter or RateLimiter(
+            DEFAULT_CONFIG["regru_rate_limit_file"],
+            DEFAULT_CONFIG["regru_rate_limit_per_minute"],
+            DEFAULT_CONFIG["regru_rate_limit_burst"],
+            logger
+        )
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(
+            os.path.join(DEFAULT_CONFIG["state_dir"], "regru-cooldown.json"),
+            logger
+        )
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.cooldown_seconds = cooldown_seconds
+        self.zone_cache = zone_cache or ZoneRecordCache(
+            None, DEFAULT_CONFIG["regru_zone_cache_ttl"], logger
+        )
+        self.ledger = ledger
+        self.zone_index = zone_index or ZoneIndex(None, DEFAULT_CONFIG["regru_zone_list_ttl"], logger)
+        self.ip_cache_file = ip_cache_file
+        self.ip_cache_ttl = ip_cache_ttl
+        self.ip_timeout = ip_timeout
     
-    def find_certificate_by_domain(self, domain: str) -> Optional[Dict]:
+    def cooldown_remaining(self, zones: Optional[List[str]] = None) -> float:
         """
-        Поиск сертификата по домену
+        Оставшееся время паузы после блокировки по частоте запросов
         
         Args:
-            domain: Доменное имя
+            zones: Зоны, с которыми предстоит работать (для одного аккаунта не учитываются)
             
         Returns:
-            Данные сертификата или None
+            Секунды до окончания паузы (0 если запросы разрешены)
         """
-        certificates = self.get_certificates()
+        return self.circuit_breaker.remaining()
+    
+    def _make_request(self, method: str, params: Dict, idempotent: bool = True) -> Dict:
+        """
+        Выполнение запроса к API reg.ru
         
-        self.logger.debug(f"Поиск сертификата для домена: {domain}")
-        self.logger.debug(f"Всего сертификатов в NPM: {len(certificates)}")
+        Превышение лимита, таймауты, ошибки соединения и ответы 5xx повторяются
+        с экспоненциальной задержкой (decorrelated jitter). Если лимит остаётся
+        превышенным после всех попыток, запросы к API приостанавливаются на
+        regru_cooldown_seconds; пауза сохраняется на диск и действует для
+        следующих запусков.
         
-        # Список доменов для поиска (основной домен и wildcard)
-        search_domains = [domain, f"*.{domain}"]
+        Неидемпотентные запросы (добавление записей) повторяются только если
+        соединение не было установлено: иначе reg.ru мог уже выполнить запрос,
+        и повтор создал бы дубликат.
         
-        for cert in certificates:
-            cert_id = cert.get("id")
-            cert_name = cert.get("nice_name", "Unknown")
-            domains = cert.get("domain_names", [])
-            
-            self.logger.debug(f"Проверка сертификата ID={cert_id}, name='{cert_name}', domains={domains}")
+        Args:
+            method: Название метода API
+            params: Параметры запроса
+            idempotent: Запрос можно безопасно повторить после таймаута
             
-            # Проверяем точное совпадение доменов
-            for search_domain in search_domains:
-                if search_domain in domains:
-                    self.logger.info(f"✅ Найден существующий сертификат для {domain}")
-                    self.logger.info(f"   ID: {cert_id}, Домены: {', '.join(domains)}")
-                    return cert
+        Returns:
+            Ответ API в формате dict
             
-            # Если NPM ещё не распарсил домены (domains == []), проверяем по nice_name
-            # Это предотвращает дублирование сертификатов при первичной загрузке
-            if not domains:
-                if cert_name.strip().lower() == domain.strip().lower() or cert_name.strip().lower() == f"*.{domain.strip().lower()}":
-                    self.logger.info(f"✅ Найден сертификат по имени (домены ещё не распознаны NPM)")
-                    self.logger.info(f"   ID: {cert_id}, Имя: {cert_name}")
-                    return cert
+        Raises:
+            RegRuCircuitOpenError: Действует пауза после блокировки
+            RegRuAuthError: Неверные учётные данные или IP не разрешён
+            RegRuRateLimitError: Превышен лимит запросов (после всех попыток)
+            RegRuTransientError: Таймаут, ошибка соединения или 5xx (после всех попыток)
+            RegRuAPIError: Прочие ошибки API
+        """
+        remaining = self.cooldown_remaining()
+        if remaining > 0:
+            raise RegRuCircuitOpenError(
+                f"Запросы к API reg.ru приостановлены ещё на {int(remaining)} сек "
+                f"после превышения лимита запросов"
+            )
         
-        self.logger.debug(f"Сертификат для {domain} не найден")
-        return None
+        url = f"{REGRU_API_URL}/{method}"
+        
+        # Добавляем учетные данные к параметрам
+        params.update({
+            "username": self.username,
+            "password": self.password,
+            "output_format": "json"
+        })
+        
+        delay = self.retry_base_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._send_request(method, url, params)
+            except (RegRuRateLimitError, RegRuTransientError) as e:
+                if not idempotent and isinstance(e, RegRuTransientError) and e.sent:
+                    self.logger.warning(f"{e}. Запрос мог быть выполнен, автоматический повтор пропущен")
+                    raise
+                if attempt >= self.max_retries:
+                    if isinstance(e, RegRuRateLimitError):
+                        self.circuit_breaker.open(self.cooldown_seconds, str(e))
+                        self._log_rate_limit_help()
+                    else:
+                        self.logger.error(str(e))
+                    raise
+                delay = min(self.retry_max_delay, random.uniform(self.retry_base_delay, delay * 3))
+                self.logger.warning(f"{e}. Повтор {attempt + 1}/{self.max_retries} через {delay:.1f} сек")
+                time.sleep(delay)
     
-    def upload_certificate(self, domain: str, cert_path: str, key_path: str, 
-                          chain_path: Optional[str] = None) -> Optional[Dict]:
+    def _send_request(self, method: str, url: str, params: Dict) -> Dict:
         """
-        Загрузка нового сертификата в NPM
-        
-        ВАЖНО: NPM автоматически извлекает информацию из сертификата.
-        Мы загружаем сертификат через веб-интерфейс формы (multipart/form-data),
-        а не через JSON API, так как JSON endpoint имеет строгую валидацию схемы.
+        Одна попытка запроса к API reg.ru
         
         Args:
-            domain: Основной домен
-            cert_path: Путь к файлу сертификата
-            key_path: Путь к приватному ключу
-            chain_path: Путь к цепочке сертификатов (опционально)
+            method: Название метода API
+            url: URL метода
+            params: Параметры запроса (с учётными данными)
             
         Returns:
-            Данные созданного сертификата или None
+            Ответ API в формате dict
         """
-        url = f"{self.host}/api/nginx/certificates"
+        # Общий для всех процессов лимит частоты запросов
+        waited = self.rate_limiter.acquire()
+        if waited > 0:
+            self.logger.info(f"Лимит запросов к API reg.ru: ожидание {waited:.1f} сек")
         
         try:
-            # Читаем приватный ключ
-            with open(key_path, 'r') as f:
-                certificate_key = f.read()
-            
-            # Определяем, какие файлы использовать
-            cert_dir = os.path.dirname(cert_path)
-            cert_only_path = os.path.join(cert_dir, "cert.pem")
-            chain_only_path = os.path.join(cert_dir, "chain.pem")
-            
-            # Используем отдельные файлы cert.pem и chain.pem
-            # NPM лучше работает с разделенными файлами
-            if os.path.exists(cert_only_path) and os.path.exists(chain_only_path):
-                self.logger.info("Загружаем cert.pem и chain.pem отдельно")
-                with open(cert_only_path, 'rb') as f:
-                    certificate = f.read().decode('utf-8')
-                with open(chain_only_path, 'rb') as f:
-                    intermediate_certificate = f.read().decode('utf-8')
-                self.logger.info(f"Загружено: cert.pem ({len(certificate)} байт), chain.pem ({len(intermediate_certificate)} байт)")
-            else:
-                # Fallback: загружаем fullchain целиком
-                self.logger.info("cert.pem/chain.pem не найдены, загружаем fullchain.pem")
-                with open(cert_path, 'rb') as f:
-                    certificate = f.read().decode('utf-8')
-                intermediate_certificate = ""
-                self.logger.info(f"Загружено: fullchain.pem ({len(certificate)} байт)")
-            
-            # Проверяем корректность сертификатов
-            if not certificate.strip().startswith('-----BEGIN CERTIFICATE-----'):
-                self.logger.error("Ошибка: Основной сертификат не начинается с BEGIN CERTIFICATE")
-                return None
-            
-            if intermediate_certificate and not intermediate_certificate.strip().startswith('-----BEGIN CERTIFICATE-----'):
-                self.logger.error("Ошибка: Промежуточный сертификат не начинается с BEGIN CERTIFICATE")
-                return None
-            
-            # Показываем первые строки для диагностики
-            self.logger.debug(f"Основной сертификат начинается с: {certificate[:60]}...")
-            if intermediate_certificate:
-                self.logger.debug(f"Промежуточный сертификат начинается с: {intermediate_certificate[:60]}...")
-            
-            # NPM Web UI использует multipart/form-data для загрузки custom сертификатов
-            # Загружаем cert.pem и chain.pem отдельно
-            files = {
-                'certificate': ('cert.pem', certificate, 'application/x-pem-file'),
-                'certificate_key': ('privkey.pem', certificate_key, 'application/x-pem-file'),
-            }
-            
-            # Добавляем intermediate_certificate если есть
-            if intermediate_certificate and intermediate_certificate.strip():
-                files['intermediate_certificate'] = ('chain.pem', intermediate_certificate, 'application/x-pem-file')
-                self.logger.info(f"Загружаем cert ({len(certificate)} байт) + chain ({len(intermediate_certificate)} байт) + privkey")
-            else:
-                self.logger.info(f"Загружаем cert ({len(certificate)} байт) + privkey (без chain)")
-            
-            # Дополнительные поля формы (только разрешенные NPM поля)
-            data = {
-                'nice_name': domain,
-                'provider': 'other',  # other для custom сертификатов
-            }
-            
-            self.logger.debug("NPM будет автоматически извлекать домены и дату истечения из сертификата")
-            
-            self.logger.debug(f"Uploading certificate as multipart/form-data")
-            self.logger.debug(f"Files: {list(files.keys())}")
-            self.logger.debug(f"Data: {data}")
-            self.logger.info(f"Загрузка сертификата для {domain} в NPM...")
-            
-            # Отправляем как multipart/form-data
-            response = self.session.post(url, files=files, data=data, timeout=30)
+            self.logger.debug(f"Отправка запроса к API: {method}")
+            response = self.session.post(url, data=params, timeout=30)
             response.raise_for_status()
-            
             result = response.json()
-            cert_id = result.get("id")
-            
-            if cert_id:
-                self.logger.info(f"Сертификат успешно загружен в NPM (ID: {cert_id})")
-                
-                # Показываем что вернул NPM
-                self.logger.debug(f"Полный ответ NPM: {json.dumps(result, indent=2, ensure_ascii=False)}")
-                
-                expires = result.get("expires_on")
-                if expires:
-                    self.logger.info(f"NPM определил дату истечения: {expires}")
-                else:
-                    self.logger.warning("NPM не вернул дату истечения сертификата!")
-                
-                # Проверяем meta.letsencrypt_email - если есть, значит NPM считает это Let's Encrypt
-                meta = result.get("meta", {})
-                if meta:
-                    self.logger.debug(f"NPM meta: {json.dumps(meta, indent=2, ensure_ascii=False)}")
-                
-                # После загрузки подождём, пока NPM распарсит сертификат (domain_names, expires_on)
-                try:
-                    parsed = self.wait_for_certificate_parse(cert_id, timeout_seconds=12, interval_seconds=1)
-                    if parsed:
-                        self.logger.info(
-                            f"Итоговые данные NPM: домены={parsed.get('domain_names', [])}, истекает={parsed.get('expires_on')}"
-                        )
-                        return parsed
-                except Exception as e:
-                    self.logger.warning(f"Не удалось дождаться парсинга сертификата в NPM: {e}")
-                
-                return result
-            else:
-                self.logger.error("Не удалось получить ID созданного сертификата")
-                self.logger.error(f"Ответ NPM: {result}")
-                return None
-                
-        except FileNotFoundError as e:
-            self.logger.error(f"Файл сертификата не найден: {e}")
-            return None
+        except requests.exceptions.ConnectTimeout as e:
+            raise RegRuTransientError("Таймаут подключения к API reg.ru", sent=False) from e
+        except requests.exceptions.Timeout as e:
+            raise RegRuTransientError("Таймаут при обращении к API reg.ru (30 сек)") from e
+        except requests.exceptions.ConnectionError as e:
+            raise RegRuTransientError("Ошибка соединения с API reg.ru. Проверьте интернет подключение",
+                                      sent=self._request_sent(e)) from e
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else 0
+            if status >= 500:
+                raise RegRuTransientError(f"Ошибка сервера API reg.ru: HTTP {status}", str(status)) from e
+            self.logger.error(f"Ошибка HTTP запроса: {e}")
+            raise RegRuAPIError(f"Ошибка HTTP запроса: {e}", str(status)) from e
         except requests.exceptions.RequestException as e:
-            self.logger.error(f"Ошибка при загрузке сертификата в NPM: {e}")
-            if hasattr(e.response, 'text'):
-                self.logger.error(f"Ответ сервера: {e.response.text}")
-            return None
+            self.logger.error(f"Ошибка HTTP запроса: {e}")
+            raise RegRuAPIError(f"Ошибка HTTP запроса: {e}") from e
+        except ValueError as e:
+            raise RegRuTransientError("API reg.ru вернул некорректный JSON") from e
+        
+        if result.get("result") == "success":
+            self.logger.debug(f"Запрос {method} выполнен успешно")
+            return result
+        
+        error_msg = result.get("error_text", "Неизвестная ошибка")
+        error_code = result.get("error_code", "unknown")
+        
+        # Обработка специфических ошибок
+        if "Access to API from this IP denied" in error_msg or error_code == "IP_DENIED":
+            self.logger.error("=" * 80)
+            self.logger.error("🚫 ОШИБКА ДОСТУПА К API REG.RU")
+            self.logger.error("=" * 80)
+            self.logger.error("❌ Доступ к API заблокирован для текущего IP адреса")
+            self.logger.error("")
+            self.logger.error("🔧 РЕШЕНИЕ ПРОБЛЕМЫ:")
+            self.logger.error("1. Войдите в личный кабинет reg.ru")
+            self.logger.error("2. Перейдите в 'Настройки' → 'Безопасность' → 'API'")
+            self.logger.error("3. Добавьте текущий IP адрес в список разрешенных")
+            self.logger.error("4. Или отключите ограничение по IP (менее безопасно)")
+            self.logger.error("")
+            self.logger.error("🌐 Текущий IP можно узнать командой:")
+            self.logger.error("   curl -s https://ipinfo.io/ip")
+            self.logger.error("   или на сайте: https://whatismyipaddress.com/")
+            self.logger.error("")
+            self.logger.error("📚 Документация API: https://www.reg.ru/support/api")
+            self.logger.error("=" * 80)
+            raise RegRuAuthError(f"API Error: {error_msg}", error_code)
+        elif "Invalid username or password" in error_msg:
+            self.logger.error("=" * 80)
+            self.logger.error("🔐 ОШИБКА АУТЕНТИФИКАЦИИ")
+            self.logger.error("=" * 80)
+            self.logger.error("❌ Неверные учетные данные")
+            self.logger.error("🔧 Проверьте username и password в конфигурации")
+            self.logger.error("=" * 80)
+            raise RegRuAuthError(f"API Error: {error_msg}", error_code)
+        elif "IP exceeded allowed connection rate" in error_msg or error_code == "IP_EXCEEDED_ALLOWED_CONNECTION_RATE":
+            raise RegRuRateLimitError(f"API Error: {error_msg}", error_code)
+        else:
+            self.logger.error(f"Ошибка API reg.ru: {error_msg} (код: {error_code})")
+            raise RegRuAPIError(f"API Error: {error_msg}", error_code)
     
-    def update_certificate(self, cert_id: int, cert_path: str, key_path: str,
-                          chain_path: Optional[str] = None) -> bool:
+    @staticmethod
+    def _request_sent(error: Exception) -> bool:
         """
-        Обновление существующего сертификата
+        Мог ли запрос дойти до сервера при ошибке соединения
         
         Args:
-            cert_id: ID сертификата в NPM
-            cert_path: Путь к файлу сертификата
-            key_path: Путь к приватному ключу
-            chain_path: Путь к цепочке сертификатов (опционально)
+            error: requests.exceptions.ConnectionError
             
         Returns:
-            True если успешно
+            False если соединение не было установлено (DNS, отказ в подключении)
         """
-        url = f"{self.host}/api/nginx/certificates/{cert_id}"
-        
-        try:
-            # Читаем приватный ключ
-            with open(key_path, 'r') as f:
-                certificate_key = f.read()
-            
-            # Определяем, какие файлы использовать
-            cert_dir = os.path.dirname(cert_path)
-            cert_only_path = os.path.join(cert_dir, "cert.pem")
-            chain_only_path = os.path.join(cert_dir, "chain.pem")
-            
-            # Используем cert.pem и chain.pem при обновлении, при отсутствии – fullchain
-            files: Dict[str, Tuple[str, str, str]]
-            if os.path.exists(cert_only_path) and os.path.exists(chain_only_path):
-                self.logger.info("Обновление: используем cert.pem и chain.pem")
-                with open(cert_only_path, 'rb') as f:
-                    certificate = f.read().decode('utf-8')
-                with open(chain_only_path, 'rb') as f:
-                    intermediate_certificate = f.read().decode('utf-8')
-                self.logger.debug(f"Загружено: cert.pem ({len(certificate)} байт), chain.pem ({len(intermediate_certificate)} байт)")
-                files = {
-                    'certificate': ('cert.pem', certificate, 'application/x-pem-file'),
-                    'certificate_key': ('privkey.pem', certificate_key, 'application/x-pem-file'),
-                    'intermediate_certificate': ('chain.pem', intermediate_certificate, 'application/x-pem-file'),
-                }
-            else:
-                self.logger.info("Обновление: cert/chain не найдены, используем fullchain.pem")
-                with open(cert_path, 'rb') as f:
-                    certificate = f.read().decode('utf-8')
-                self.logger.debug(f"Загружено: fullchain.pem ({len(certificate)} байт)")
-                files = {
-                    'certificate': ('fullchain.pem', certificate, 'application/x-pem-file'),
-                    'certificate_key': ('privkey.pem', certificate_key, 'application/x-pem-file'),
-                }
-            
-            # Дополнительные поля формы
-            data = {
-                'provider': 'other',  # other для custom сертификатов
-            }
-            
-            self.logger.info(f"Обновление сертификата ID {cert_id} в NPM...")
-            response = self.session.put(url, files=files, data=data, timeout=30)
-            response.raise_for_status()
-            
-            self.logger.info("Сертификат успешно обновлен в NPM")
-            # Дождаться, пока NPM обновит метаданные
-            try:
-                parsed = self.wait_for_certificate_parse(cert_id, timeout_seconds=12, interval_seconds=1)
-                if parsed:
-                    self.logger.info(
-                        f"Итоговые данные NPM после обновления: домены={parsed.get('domain_names', [])}, истекает={parsed.get('expires_on')}"
-                    )
-            except Exception as e:
-                self.logger.warning(f"Не удалось дождаться обновления метаданных сертификата: {e}")
-            return True
-            
-        except FileNotFoundError as e:
-            self.logger.error(f"Файл сертификата не найден: {e}")
-            return False
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Ошибка при обновлении сертификата в NPM: {e}")
-            if hasattr(e.response, 'text'):
-                self.logger.error(f"Ответ сервера: {e.response.text}")
-            return False
+        from urllib3.exceptions import NewConnectionError
+        reason = error.args[0] if error.args else None
+        return not isinstance(getattr(reason, "reason", reason), NewConnectionError)
     
-    def delete_certificate(self, cert_id: int) -> bool:
+    def _log_rate_limit_help(self):
+        """Вывод рекомендаций при превышении лимита запросов"""
+        self.logger.error("=" * 80)
+        self.logger.error("⏱️  ОШИБКА: ПРЕВЫШЕН ЛИМИТ ЗАПРОСОВ К API")
+        self.logger.error("=" * 80)
+        self.logger.error("❌ IP адрес превысил допустимую частоту подключений к API reg.ru")
+        self.logger.error(f"⏸️  Запросы к API приостановлены на {self.cooldown_seconds} сек")
+        self.logger.error("")
+        self.logger.error("🔧 РЕШЕНИЕ ПРОБЛЕМЫ:")
+        self.logger.error("1. Подождите 5-10 минут перед следующей попыткой")
+        self.logger.error("2. Не запускайте скрипт слишком часто")
+        self.logger.error("3. Используйте --test-api только для диагностики")
+        self.logger.error("4. Настройте systemd timer для автоматических проверок (раз в день)")
+        self.logger.error("")
+        self.logger.error("📊 ЛИМИТЫ API REG.RU:")
+        self.logger.error("   • Обычно: не более 10-20 запросов в минуту с одного IP")
+        self.logger.error("   • Рекомендация: проверка сертификатов 1-2 раза в день")
+        self.logger.error("")
+        self.logger.error("⚙️  АВТОМАТИЗАЦИЯ:")
+        self.logger.error("   sudo systemctl enable letsencrypt-regru.timer")
+        self.logger.error("   sudo systemctl start letsencrypt-regru.timer")
+        self.logger.error("=" * 80)
+    
+    def get_zones(self, use_cache: bool = True) -> List[str]:
         """
-        Удаление сертификата из NPM
+        Получение списка зон аккаунта (доменов и услуг DNS-хостинга)
         
         Args:
-            cert_id: ID сертификата в NPM
+            use_cache: Использовать список из кэша, если он не устарел
             
         Returns:
-            True если успешно
+            Список зон
         """
-        url = f"{self.host}/api/nginx/certificates/{cert_id}"
+        if use_cache and self.zone_index.fresh():
+            return self.zone_index.zones
+        
+        self.logger.info("Получение списка зон аккаунта reg.ru")
+        result = self._make_request("service/get_list", {})
+        services = result.get("answer", {}).get("services", [])
+        zones = [
+            service["dname"] for service in services
+            if service.get("dname") and service.get("servtype") in REGRU_ZONE_SERVICE_TYPES
+            and service.get("state") != "D"
+        ]
+        self.zone_index.update(zones)
+        self.logger.info(f"Зон в аккаунте: {len(self.zone_index.zones)}")
+        return self.zone_index.zones
+    
+    def resolve_zone(self, name: str) -> Tuple[str, str]:
+        """
+        Определение зоны аккаунта для имени
         
-        try:
-            self.logger.info(f"Удаление сертификата ID {cert_id} из NPM...")
-            response = self.session.delete(url, timeout=10)
-            response.raise_for_status()
+        Args:
+            name: Полное имя (например, _acme-challenge.api.eu.example.com)
             
-            self.logger.info(f"✅ Сертификат ID {cert_id} успешно удален из NPM")
-            return True
+        Returns:
+            Кортеж (зона, поддомен относительно зоны)
             
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Ошибка при удалении сертификата: {e}")
-            if hasattr(e.response, 'text'):
-                self.logger.error(f"Ответ сервера: {e.response.text}")
-            return False
+        Raises:
+            RegRuAPIError: Имя не входит ни в одну зону аккаунта
+        """
+        self.get_zones()
+        match = self.zone_index.lookup(name)
+        if match is None:
+            raise RegRuAPIError(f"{name} не входит ни в одну зону аккаунта reg.ru")
+        return match
     
-    def sync_certificate(self, domain: str, cert_dir: str) -> bool:
+    def get_zone_records(self, domain: str, use_cache: bool = True) -> List[Dict]:
         """
-        Синхронизация сертификата с NPM (создание или обновление)
+        Получение DNS записей домена
         
         Args:
             domain: Доменное имя
-            cert_dir: Директория с сертификатами Let's Encrypt
+            use_cache: Использовать снимок зоны из кэша, если он не устарел
             
         Returns:
-            True если успешно
+            Список DNS записей
         """
-        # Пути к файлам сертификата
-        cert_path = os.path.join(cert_dir, "cert.pem")
-        key_path = os.path.join(cert_dir, "privkey.pem")
-        chain_path = os.path.join(cert_dir, "chain.pem")
-        fullchain_path = os.path.join(cert_dir, "fullchain.pem")
+        if use_cache:
+            records = self.zone_cache.get(domain)
+            if records is not None:
+                self.logger.debug(f"DNS записи {domain} взяты из кэша ({len(records)} записей)")
+                return records
         
-        # Проверяем наличие файлов
-        if not os.path.exists(cert_path) or not os.path.exists(key_path):
-            self.logger.error(f"Файлы сертификата не найдены в {cert_dir}")
-            return False
+        self.logger.info(f"Получение DNS записей для домена: {domain}")
         
-        # Авторизуемся в NPM
-        if not self.login():
-            return False
+        params = {
+            "domain_name": domain,
+        }
         
-        # Проверяем, существует ли уже сертификат для этого домена
-        existing_cert = self.find_certificate_by_domain(domain)
+        result = self._make_request("zone/get_resource_records", params)
         
-        # Используем fullchain если доступен, иначе cert + chain
-        if os.path.exists(fullchain_path):
-            final_cert_path = fullchain_path
-            final_chain_path = None
+        if "answer" in result and "records" in result["answer"]:
+            records = result["answer"]["records"]
+            self.logger.info(f"Получено {len(records)} DNS записей")
+            self.zone_cache.put(domain, records)
+            return records
         else:
-            final_cert_path = cert_path
-            final_chain_path = chain_path if os.path.exists(chain_path) else None
+            self.logger.warning("DNS записи не найдены")
+            return []
+    
+    def find_records(self, domain: str, rectype: str, subdomain: str,
+                     content: Optional[str] = None) -> List[Dict]:
+        """
+        Поиск DNS записей по типу, поддомену и (опционально) содержимому
         
-        if existing_cert:
-            # Обновляем существующий сертификат
-            cert_id = existing_cert.get("id")
-            self.logger.info(f"Обновление существующего сертификата (ID: {cert_id})")
-            return self.update_certificate(cert_id, final_cert_path, key_path, final_chain_path)
-        else:
-            # Создаем новый сертификат
-            self.logger.info("Создание нового сертификата в NPM")
-            result = self.upload_certificate(domain, final_cert_path, key_path, final_chain_path)
-            return result is not None
-
-
+        Зона загружается только если в кэше нет свежего снимка.
+        
+        Args:
+            domain: Доменное имя
+            rectype: Тип записи (TXT, A, ...)
+            subdomain: Поддомен
+            content: Содержимое записи (None - любое)
+            
+        Returns:
+            Найденные записи
+        """
+        found = self.zone_cache.find(domain, rectype, subdomain, content)
+        if found is None:
+            records = self.get_zone_records(domain, use_cache=False)
+            found = [record for record in records
+                     if ZoneRecordCache.record_key(record)[:2] == (rectype.upper(), subdomain.lower())
+                     and (content is None or ZoneRecordCache.record_key(record)[2] == content)]
+        return found
+    
+    def add_txt_record(self, domain: str, subdomain: str, txt_value: str) -> bool:
+        """
+        Добавление TXT записи для DNS валидации
+        
+        Args:
+            domain: Основной домен
+            subdomain: Поддомен (например, _acme-challenge)
+            txt_value: Значение TXT записи
+            
+        Returns:
+            True если успешно, False в противном случае
+        """
+        self.logger.info(f"Добавление TXT записи: {subdomain}.{domain} = {txt_value}")
+        
+        result = self.batch().add_txt(domain, subdomain, txt_value).submit()[0]
+        if result["success"]:
+            self.logger.info("TXT запись успешно добавлена")
+            return True
+        self.logger.error(f"Не удалось добавить TXT запись: {result['error']}")
+        return False
+    
+    def batch(self) -> "ZoneUpdateBatch":
+        """
+        Создание пакета изменений DNS для одного вызова zone/update_records
+        
+        Returns:
+            Пустой пакет изменений
+        """
+        return ZoneUpdateBatch(self)
+    
+    def update_records(self, operations: List[Dict], retries: Optional[int] = None) -> List[Dict]:
+        """
+        Выполнение набора изменений DNS одним запросом zone/update_records
+        
+        Если запрос с добавлением записей мог дойти до reg.ru, но ответ не
+        получен, вслепую он не повторяется: по зоне проверяется, какие
+        изменения уже выполнены, и повторяются только остальные.
+        
+        Args:
+            operations: Операции с полями action (add_txt/remove_record), domain,
+                        subdomain, value и record_type (для remove_record)
+            retries: Оставшиеся повторы после неизвестного результата (по умолчанию max_retries)
+            
+        Returns:
+            Операции, дополненные полями success и error (в исходном порядке)
+        """
+        results = [dict(op, success=False, error=None) for op in operations]
+        if not operations:
+            return results
+        
+        # Группируем операции по доменам, сохраняя порядок
+        by_domain: Dict[str, List[int]] = {}
+        for index, op in enumerate(operations):
+            by_domain.setdefault(op["domain"], []).append(index)
+        
+        domains = []
+        for domain, indexes in by_domain.items():
+            action_list = []
+            for index in indexes:
+                op = operations[index]
+                action = {"action": op["action"], "subdomain": op["subdomain"]}
+                if op["action"] == "add_txt":
+                    action["text"] = op["value"]
+                else:
+                    action["record_type"] = op.get("record_type", "TXT")
+                    action["content"] = op["value"]
+                action_list.append(action)
+            domains.append({"dname": domain, "action_list": action_list})
+        
+        input_data = {
+            "username": self.username,
+            "password": self.password,
+            "domains": domains,
+            "output_content_type": "plain",
+        }
+        
+        has_adds = any(op["action"] == "add_txt" for op in operations)
+        try:
+            response = self._make_request("zone/update_records", {
+                "input_format": "json",
+                "input_data": json.dumps(input_data, ensure_ascii=False),
+            }, idempotent=not has_adds)
+        except Exception as e:
+            # Результат неизвестен (например, таймаут) - снимки зон больше не достоверны
+            for domain in by_domain:
+                self.zone_cache.invalidate(domain)
+            retries = self.max_retries if retries is None else retries
+            if has_adds and isinstance(e, RegRuTransientError) and e.sent and retries > 0:
+                return self._resubmit_missing(operations, retries - 1)
+            for result in results:
+                result["error"] = str(e)
+            return results
+        
+        answers = {item.get("dname"): item for item in response.get("answer", {}).get("domains", [])}
+        for domain, indexes in by_domain.items():
+            answer = answers.get(domain, {})
+            actions = answer.get("action_list", [])
+            for position, index in enumerate(indexes):
+                action = actions[position] if position < len(actions) else {}
+                if answer.get("result") == "success" and action.get("result", "success") == "success":
+                    results[index]["success"] = True
+                    op = operations[index]
+                    self.zone_cache.apply(domain, "add" if op["action"] == "add_txt" else "remove",
+                                          op.get("record_type", "TXT"), op["subdomain"], op["value"])
+                    if self.ledger and op["action"] == "add_txt":
+                        self.ledger.record_added(domain, op["subdomain"], op["value"], action.get("id"))
+                    elif self.ledger and op.get("record_type", "TXT") == "TXT":
+                        self.ledger.record_removed(op["value"])
+                else:
+                    results[index]["error"] = (action.get("error_text") or answer.get("error_text")
+                                               or "Нет ответа для операции")
+        return results
+    
+    def _resubmit_missing(self, operations: List[Dict], retries: int) -> List[Dict]:
+        """
+        Повтор изменений с неизвестным результатом без дубликатов
+        
+        Зона загружается заново; операции, результат которых уже виден
+        в зоне, считаются выполненными, остальные отправляются повторно.
+        
+        Args:
+            operations: Операции запроса с неизвестным результатом
+            retries: Оставшиеся повторы
+            
+        Returns:
+            Операции, дополненные полями success и error (в исходном порядке)
+        """
+        results = [dict(op, success=False, error=None) for op in operations]
+        missing = []
+        for index, op in enumerate(operations):
+            try:
+                present = bool(self.find_records(op["domain"], op.get("record_type", "TXT"),
+                                                 op["subdomain"], op["value"]))
+            except RegRuAPIError as e:
+                results[index]["error"] = f"Результат изменения неизвестен: {e}"
+                continue
+            if present != (op["action"] == "add_txt"):
+                missing.append(index)
+                continue
+            results[index]["success"] = True
+            if self.ledger and op["action"] == "add_txt":
+                self.ledger.record_added(op["domain"], op["subdomain"], op["value"])
+            elif self.ledger and op.get("record_type", "TXT") == "TXT":
+                self.ledger.record_removed(op["value"])
+        
+        self.logger.info(f"zone/update_records: выполнено {sum(r['success'] for r in results)} "
+                         f"из {len(operations)} операций, повтор {len(missing)}")
+        if missing:
+            resent = self.update_records([operations[index] for index in missing], retries)
+            for index, result in zip(missing, resent):
+                results[index] = result
+        return results
+    
+    def get_current_ip(self) -> str:
+        """
+        Получение текущего публичного IP адреса
+        
+        Returns:
+            IP адрес или 'Неизвестно'
+        """
+        address = detect_public_ip(self.ip_cache_file, self.ip_cache_ttl, self.ip_timeout, self.logger)
+        return address or "Неизвестно"
+    
+    def test_api_access(self) -> bool:
+        """
+        Проверка доступности API reg.ru
+        
+        Returns:
+            True если API доступен
+        """
+        # Получаем текущий IP
+        current_ip = self.get_current_ip()
+        self.logger.info(f"Текущий IP адрес: {current_ip}")
+        self.logger.info("Проверка доступности API reg.ru...")
+        
+        try:
+            # Простой запрос для проверки доступа
+            params = {}
+            result = self._make_request("user/get_balance", params)
+            
+            if result and result.get("result") == "success":
+                balance = result.get("answer", {}).get("prepay", "Неизвестно")
+                self.logger.info(f"✅ API reg.ru доступен. Баланс: {balance} руб.")
+                return True
+            else:
+                self.logger.error("❌ API reg.ru недоступен")
+                return False
+                
+        except Exception as e:
+            self.logger.error(f"❌ Не удалось подключиться к API reg.ru: {e}")
+            return False
+    
+    def remove_txt_record(self, domain: str, subdomain: str, txt_value: str) -> bool:
+        """
+        Удаление TXT записи
+        
+        Запись удаляется по содержимому через zone/update_records,
+        без загрузки всей зоны для поиска ID записи.
+        
+        Args:
+            domain: Основной домен
+            subdomain: Поддомен
+            txt_value: Значение TXT записи
+            
+        Returns:
+            True если успешно, False в противном случае
+        """
+        self.logger.info(f"Удаление TXT записи: {subdomain}.{domain}")
+        
+        result = self.batch().remove_txt(domain, subdomain, txt_value).submit()[0]
+        if result["success"]:
+            self.logger.info("TXT запись успешно удалена")
+        else:
+            self.logger.error(f"Не удалось удалить TXT запись: {result['error']}")
+            # Для cleanup hook не критично, если не удалось удалить
+            self.logger.warning("Продолжаем выполнение, несмотря на ошибку удаления")
+        return True
+
+
+class ZoneUpdateBatch:
+    """
+    Пакет изменений DNS записей для одного вызова zone/update_records
+    
+    Собирает операции добавления и удаления TXT записей для любых
+    поддоменов и доменов аккаунта и отправляет их одним запросом.
+    """
+    
+    def __init__(self, api: RegRuAPI):
+        """
+        Инициализация пакета
+        
+        Args:
+            api: API клиент reg.ru
+        """
+        self.api = api
+        self.operations: List[Dict] = []
+    
+    def __len__(self) -> int:
+        return len(self.operations)
+    
+    def add_txt(self, domain: str, subdomain: str, value: str) -> "ZoneUpdateBatch":
+        """
+        Добавление TXT записи в пакет
+        
+        Args:
+            domain: Основной домен
+            subdomain: Поддомен
+            value: Значение TXT записи
+            
+        Returns:
+            Этот же пакет (для цепочек вызовов)
+        """
+        self.operations.append({"action": "add_txt", "domain": domain,
+                                "subdomain": subdomain, "value": value})
+        return self
+    
+    def remove_txt(self, domain: str, subdomain: str, value: str) -> "ZoneUpdateBatch":
+        """
+        Удаление TXT записи (по содержимому) в пакет
+        
+        Args:
+            domain: Основной домен
+            subdomain: Поддомен
+            value: Значение TXT записи
+            
+        Returns:
+            Этот же пакет (для цепочек вызовов)
+        """
+        self.operations.append({"action": "remove_record", "domain": domain, "subdomain": subdomain,
+                                "record_type": "TXT", "value": value})
+        return self
+    
+    def submit(self) -> List[Dict]:
+        """
+        Отправка пакета
+        
+        Returns:
+            Результаты операций (поля success и error) в порядке добавления
+        """
+        operations, self.operations = self.operations, []
+        if operations:
+            self.api.logger.debug(f"zone/update_records: {len(operations)} операций")
+        return self.api.update_records(operations)
+
+
+class RegRuAccountPool:
+    """
+    Несколько аккаунтов reg.ru за интерфейсом RegRuAPI
+    
+    Каждый аккаунт - отдельный RegRuAPI со своей сессией, ограничителем
+    частоты и паузой после блокировки. Операции распределяются по
+    аккаунтам по зонам; пакеты изменений для разных аккаунтов
+    отправляются параллельно (по одному запросу на аккаунт).
+    """
+    
+    def __init__(self, accounts: Dict[str, RegRuAPI], zones: Dict[str, str],
+                 logger: logging.Logger):
+        """
+        Инициализация
+        
+        Args:
+            accounts: Клиенты API по именам аккаунтов (первый - основной)
+            zones: Явное соответствие зона → имя аккаунта
+            logger: Logger объект
+        """
+        self.accounts = accounts
+        self.default = next(iter(accounts))
+        self.logger = logger
+        self._owners = {zone.lower(): name for zone, name in zones.items()}
+        # Общий индекс зон всех аккаунтов; перестраивается при изменении _owners
+        self._index: Optional[ZoneIndex] = None
+        primary = accounts[self.default]
+        self.zone_cache = primary.zone_cache
+        self.ledger = primary.ledger
+    
+    def cooldown_remaining(self, zones: Optional[List[str]] = None) -> float:
+        """
+        Оставшееся время паузы после блокировки по частоте запросов
+        
+        У каждого аккаунта своя пауза: блокировка одного аккаунта
+        не мешает работе с зонами других.
+        
+        Args:
+            zones: Зоны, с которыми предстоит работать (None - все аккаунты)
+            
+        Returns:
+            Наибольшая пауза среди аккаунтов этих зон (0 если запросы разрешены)
+        """
+        names = self.accounts if zones is None else {self.account_for(zone) for zone in zones}
+        return max((self.accounts[name].cooldown_remaining() for name in names), default=0)
+    
+    def get_zones(self, use_cache: bool = True) -> List[str]:
+        """
+        Получение списка зон всех аккаунтов
+        
+        Args:
+            use_cache: Использовать списки из кэша, если они не устарели
+            
+        Returns:
+            Список зон
+        """
+        zones = set()
+        for name, api in self.accounts.items():
+            try:
+                for zone in api.get_zones(use_cache):
+                    zones.add(zone)
+                    if zone not in self._owners:
+                        self._owners[zone] = name
+                        self._index = None
+            except RegRuAPIError as e:
+                self.logger.warning(f"Не удалось получить список зон аккаунта {name}: {e}")
+        return sorted(zones)
+    
+    def resolve_zone(self, name: str) -> Tuple[str, str]:
+        """
+        Определение зоны для имени по спискам зон всех аккаунтов
+        
+        Зоны, явно указанные в regru_accounts, учитываются наравне
+        со списками зон аккаунтов.
+        
+        Args:
+            name: Полное имя (например, _acme-challenge.api.eu.example.com)
+            
+        Returns:
+            Кортеж (зона, поддомен относительно зоны)
+            
+        Raises:
+            RegRuAPIError: Имя не входит ни в одну зону аккаунтов
+        """
+        self.get_zones()
+        if self._index is None:
+            self._index = ZoneIndex(None, 0, self.logger)
+            self._index.update(list(self._owners))
+        match = self._index.lookup(name)
+        if match is None:
+            raise RegRuAPIError(f"{name} не входит ни в одну зону аккаунтов reg.ru")
+        return match
+    
+    def account_for(self, zone: str) -> str:
+        """
+        Аккаунт, которому принадлежит зона
+        
+        Args:
+            zone: Зона
+            
+        Returns:
+            Имя аккаунта (основной, если зона не найдена в списках)
+        """
+        zone = zone.lower()
+        if zone not in self._owners:
+            self.get_zones()
+        return self._owners.get(zone, self.default)
+    
+    def api_for(self, zone: str) -> RegRuAPI:
+        """
+        Клиент API аккаунта зоны
+        
+        Args:
+            zone: Зона
+            
+        Returns:
+            API клиент reg.ru
+        """
+        return self.accounts[self.account_for(zone)]
+    
+    def get_zone_records(self, domain: str, use_cache: bool = True) -> List[Dict]:
+        return self.api_for(domain).get_zone_records(domain, use_cache)
+    
+    def find_records(self, domain: str, rectype: str, subdomain: str,
+                     content: Optional[str] = None) -> List[Dict]:
+        return self.api_for(domain).find_records(domain, rectype, subdomain, content)
+    
+    def add_txt_record(self, domain: str, subdomain: str, txt_value: str) -> bool:
+        return self.api_for(domain).add_txt_record(domain, subdomain, txt_value)
+    
+    def remove_txt_record(self, domain: str, subdomain: str, txt_value: str) -> bool:
+        return self.api_for(domain).remove_txt_record(domain, subdomain, txt_value)
+    
+    def batch(self) -> ZoneUpdateBatch:
+        """
+        Создание пакета изменений DNS (один запрос на аккаунт)
+        
+        Returns:
+            Пустой пакет изменений
+        """
+        return ZoneUpdateBatch(self)
+    
+    def update_records(self, operations: List[Dict]) -> List[Dict]:
+        """
+        Выполнение набора изменений DNS: параллельно по аккаунтам
+        
+        Args:
+            operations: Операции (см. RegRuAPI.update_records)
+            
+        Returns:
+            Операции, дополненные полями success и error (в исходном порядке)
+        """
+        by_account: Dict[str, List[int]] = {}
+        for index, op in enumerate(operations):
+            by_account.setdefault(self.account_for(op["domain"]), []).append(index)
+        
+        if len(by_account) <= 1:
+            name = next(iter(by_account), self.default)
+            return self.accounts[name].update_records(operations)
+        
+        results: List[Dict] = [{}] * len(operations)
+        self.logger.debug(f"zone/update_records: {len(by_account)} аккаунтов параллельно")
+        with ThreadPoolExecutor(max_workers=len(by_account)) as pool:
+            futures = {
+                name: pool.submit(self.accounts[name].update_records,
+                                  [operations[index] for index in indexes])
+                for name, indexes in by_account.items()
+            }
+            for name, future in futures.items():
+                for index, result in zip(by_account[name], future.result()):
+                    results[index] = result
+        return results
+    
+    def get_current_ip(self) -> str:
+        return self.accounts[self.default].get_current_ip()
+    
+    def test_api_access(self) -> bool:
+        """
+        Проверка доступности API reg.ru для всех аккаунтов
+        
+        Returns:
+            True если API доступен всем аккаунтам
+        """
+        available = True
+        for name, api in self.accounts.items():
+            self.logger.info(f"Аккаунт reg.ru: {name} ({api.username})")
+            available = api.test_api_access() and available
+        return available
+
+
+# ==============================================================================
+# DNS КЛИЕНТ
+# ==============================================================================
+
+# Типы DNS записей
+DNS_TYPE_A = 1
+DNS_TYPE_NS = 2
+DNS_TYPE_CNAME = 5
+DNS_TYPE_SOA = 6
+DNS_TYPE_TXT = 16
+DNS_TYPE_AAAA = 28
+DNS_TYPE_OPT = 41
+DNS_TYPE_TSIG = 250
+
+# Коды ответа DNS
+DNS_RCODE_NOERROR = 0
+DNS_RCODE_NXDOMAIN = 3
+DNS_RCODE_REFUSED = 5
+
+# Классы записей и код операции UPDATE (RFC 2136)
+DNS_CLASS_IN = 1
+DNS_CLASS_NONE = 254
+DNS_CLASS_ANY = 255
+DNS_OPCODE_UPDATE = 5
+
+# Публичные DNS серверы, если системные не найдены
+DEFAULT_NAMESERVERS = ["8.8.8.8", "1.1.1.1"]
+
+
+class DNSError(Exception):
+    """Ошибка выполнения DNS запроса"""
+
+
+class DNSResolver:
+    """
+    Минимальный DNS клиент (RFC 1035) без внешних зависимостей
+    
+    Отправляет запросы по UDP, при усечённом ответе (флаг TC) повторяет по TCP.
+    Поддерживает разбор записей A, AAAA, NS, CNAME, SOA и TXT.
+    """
+    
+    def __init__(self, nameservers: Optional[List[str]] = None, timeout: float = 3.0,
+                 logger: Optional[logging.Logger] = None):
+        """
+        Инициализация DNS клиента
+        
+        Args:
+            nameservers: Список IP адресов DNS серверов (по умолчанию из /etc/resolv.conf)
+            timeout: Таймаут одного запроса в секундах
+            logger: Logger объект
+        """
+        self.nameservers = list(nameservers) if nameservers else self.system_nameservers()
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger('LetsEncrypt_RegRU')
+    
+    @staticmethod
+    def system_nameservers(resolv_conf: str = "/etc/resolv.conf") -> List[str]:
+        """
+        Получение списка системных DNS серверов
+        
+        Args:
+            resolv_conf: Путь к resolv.conf
+            
+        Returns:
+            Список IP адресов DNS серверов
+        """
+        servers = []
+        try:
+            with open(resolv_conf, 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 2 and parts[0] == "nameserver":
+                        servers.append(parts[1])
+        except OSError:
+            pass
+        return servers or list(DEFAULT_NAMESERVERS)
+    
+    @staticmethod
+    def _encode_name(name: str) -> bytes:
+        """Кодирование доменного имени в формат DNS (последовательность меток)"""
+        encoded = b""
+        for label in name.rstrip(".").split("."):
+            if label:
+                try:
+                    raw = label.encode("ascii")
+                except UnicodeEncodeError:
+                    raw = label.encode("idna")
+                encoded += struct.pack("!B", len(raw)) + raw
+        return encoded + b"\x00"
+    
+    def _build_query(self, name: str, qtype: int, qid: int, recursion: bool = True) -> bytes:
+        """
+        Формирование DNS запроса
+        
+        Args:
+            name: Доменное имя
+            qtype: Тип записи
+            qid: Идентификатор запроса
+            recursion: Флаг RD (рекурсивный запрос)
+            
+        Returns:
+            DNS сообщение
+        """
+        flags = 0x0100 if recursion else 0x0000
+        header = struct.pack("!HHHHHH", qid, flags, 1, 0, 0, 1)
+        question = self._encode_name(name) + struct.pack("!HH", qtype, 1)
+        # EDNS0 OPT: размер UDP буфера 1232 байта снижает число повторов по TCP
+        opt = b"\x00" + struct.pack("!HHIH", DNS_TYPE_OPT, 1232, 0, 0)
+        return header + question + opt
+    
+    @staticmethod
+    def _read_name(data: bytes, offset: int) -> Tuple[str, int]:
+        """
+        Чтение доменного имени с учётом сжатия (RFC 1035, 4.1.4)
+        
+        Args:
+            data: DNS сообщение
+            offset: Смещение начала имени
+            
+        Returns:
+            Кортеж (имя, смещение после имени)
+        """
+        labels = []
+        end_offset = None
+        jumps = 0
+        while True:
+            if offset >= len(data):
+                raise DNSError("Некорректное DNS сообщение: выход за границы")
+            length = data[offset]
+            if length & 0xC0 == 0xC0:
+                if offset + 1 >= len(data):
+                    raise DNSError("Некорректное DNS сообщение: обрезанный указатель сжатия")
+                if end_offset is None:
+                    end_offset = offset + 2
+                offset = ((length & 0x3F) << 8) | data[offset + 1]
+                jumps += 1
+                if jumps > 32:
+                    raise DNSError("Некорректное DNS сообщение: цикл сжатия имён")
+                continue
+            if length & 0xC0:
+                raise DNSError("Некорректное DNS сообщение: неизвестный тип метки")
+            offset += 1
+            if length == 0:
+                break
+            if offset + length > len(data):
+                raise DNSError("Некорректное DNS сообщение: выход за границы")
+            labels.append(data[offset:offset + length].decode("ascii", errors="replace"))
+            offset += length
+        return ".".join(labels), (end_offset if end_offset is not None else offset)
+    
+    def _parse_rdata(self, data: bytes, rtype: int, offset: int, rdlength: int):
+        """Разбор RDATA записи в зависимости от типа"""
+        rdata = data[offset:offset + rdlength]
+        if rtype == DNS_TYPE_A and rdlength == 4:
+            return socket.inet_ntop(socket.AF_INET, rdata)
+        if rtype == DNS_TYPE_AAAA and rdlength == 16:
+            return socket.inet_ntop(socket.AF_INET6, rdata)
+        if rtype in (DNS_TYPE_NS, DNS_TYPE_CNAME):
+            return self._read_name(data, offset)[0]
+        if rtype == DNS_TYPE_TXT:
+            # TXT запись может состоять из нескольких строк - объединяем их
+            chunks = []
+            pos = 0
+            while pos < rdlength:
+                length = rdata[pos]
+                chunks.append(rdata[pos + 1:pos + 1 + length].decode("utf-8", errors="replace"))
+                pos += 1 + length
+            return "".join(chunks)
+        if rtype == DNS_TYPE_SOA:
+            mname, pos = self._read_name(data, offset)
+            rname, pos = self._read_name(data, pos)
+            serial, refresh, retry, expire, minimum = struct.unpack("!IIIII", data[pos:pos + 20])
+            return {
+                "mname": mname,
+                "rname": rname,
+                "serial": serial,
+                "refresh": refresh,
+                "retry": retry,
+                "expire": expire,
+                "minimum": minimum,
+            }
+        return rdata
+    
+    def _parse_response(self, data: bytes, qid: int) -> Dict:
+        """
+        Разбор DNS ответа
+        
+        Args:
+            data: DNS сообщение
+            qid: Ожидаемый идентификатор запроса
+            
+        Returns:
+            Словарь с полями rcode, truncated, authoritative, answers, authority
+        """
+        if len(data) < 12:
+            raise DNSError("Слишком короткий DNS ответ")
+        rid, flags, qdcount, ancount, nscount, arcount = struct.unpack("!HHHHHH", data[:12])
+        if rid != qid:
+            raise DNSError("Идентификатор DNS ответа не совпадает с запросом")
+        
+        offset = 12
+        sections = {"answers": [], "authority": [], "additional": []}
+        # Обрезанный или испорченный ответ не должен ронять вызывающий код:
+        # ошибки разбора RDATA сводятся к DNSError
+        try:
+            for _ in range(qdcount):
+                _, offset = self._read_name(data, offset)
+                offset += 4
+            
+            for section, count in (("answers", ancount), ("authority", nscount), ("additional", arcount)):
+                for _ in range(count):
+                    name, offset = self._read_name(data, offset)
+                    rtype, rclass, ttl, rdlength = struct.unpack("!HHIH", data[offset:offset + 10])
+                    offset += 10
+                    if rtype != DNS_TYPE_OPT:
+                        sections[section].append({
+                            "name": name,
+                            "type": rtype,
+                            "ttl": ttl,
+                            "data": self._parse_rdata(data, rtype, offset, rdlength),
+                        })
+                    offset += rdlength
+        except (IndexError, ValueError, struct.error) as e:
+            raise DNSError(f"Некорректное DNS сообщение: {e}")
+        
+        return {
+            "rcode": flags & 0x000F,
+            "truncated": bool(flags & 0x0200),
+            "authoritative": bool(flags & 0x0400),
+            **sections,
+        }
+    
+    @staticmethod
+    def format_server(address: str, port: int = 53) -> str:
+        """
+        Адрес DNS сервера с портом для списков nameservers
+        
+        Args:
+            address: IP адрес
+            port: Порт (53 - без указания порта)
+            
+        Returns:
+            "адрес", "адрес:порт" или "[IPv6]:порт"
+        """
+        if port == 53:
+            return address
+        return f"[{address}]:{port}" if ":" in address else f"{address}:{port}"
+    
+    @staticmethod
+    def split_server(server: str) -> Tuple[str, int]:
+        """
+        Разбор адреса DNS сервера из списка nameservers
+        
+        Args:
+            server: "адрес", "адрес:порт" или "[IPv6]:порт"
+            
+        Returns:
+            Кортеж (адрес, порт)
+        """
+        if server.startswith("["):
+            address, _, port = server[1:].partition("]:")
+            return address.rstrip("]"), int(port) if port else 53
+        if server.count(":") == 1:
+            address, port = server.split(":")
+            return address, int(port)
+        return server, 53
+    
+    @staticmethod
+    def _send_udp(server: str, packet: bytes, timeout: float, port: int = 53) -> bytes:
+        """Отправка DNS запроса по UDP"""
+        family = socket.AF_INET6 if ":" in server else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.sendto(packet, (server, port))
+            data, _ = sock.recvfrom(65535)
+            return data
+    
+    @staticmethod
+    def _send_tcp(server: str, packet: bytes, timeout: float, port: int = 53) -> bytes:
+        """Отправка DNS запроса по TCP (сообщение предваряется двухбайтной длиной)"""
+        with socket.create_connection((server, port), timeout=timeout) as sock:
+            sock.sendall(struct.pack("!H", len(packet)) + packet)
+            
+            def recv_exact(size: int) -> bytes:
+                buf = b""
+                while len(buf) < size:
+                    chunk = sock.recv(size - len(buf))
+                    if not chunk:
+                        raise DNSError("TCP соединение закрыто DNS сервером")
+                    buf += chunk
+                return buf
+            
+            length = struct.unpack("!H", recv_exact(2))[0]
+            return recv_exact(length)
+    
+    def query(self, name: str, qtype: int, nameservers: Optional[List[str]] = None,
+              timeout: Optional[float] = None, recursion: bool = True) -> Dict:
+        """
+        Выполнение DNS запроса
+        
+        Серверы опрашиваются по очереди до первого полученного ответа.
+        
+        Args:
+            name: Доменное имя
+            qtype: Тип записи (DNS_TYPE_*)
+            nameservers: Серверы для запроса (по умолчанию self.nameservers)
+            timeout: Таймаут запроса (по умолчанию self.timeout)
+            recursion: Флаг RD (False для запросов к авторитетным серверам)
+            
+        Returns:
+            Разобранный DNS ответ (см. _parse_response)
+        """
+        servers = nameservers or self.nameservers
+        timeout = timeout if timeout is not None else self.timeout
+        last_error: Optional[Exception] = None
+        
+        for server in servers:
+            qid = random.randint(0, 0xFFFF)
+            packet = self._build_query(name, qtype, qid, recursion)
+            address, port = self.split_server(server)
+            try:
+                response = self._parse_response(self._send_udp(address, packet, timeout, port), qid)
+                if response["truncated"]:
+                    self.logger.debug(f"DNS ответ от {server} усечён, повтор по TCP")
+                    response = self._parse_response(self._send_tcp(address, packet, timeout, port), qid)
+                response["server"] = server
+                return response
+            except (OSError, DNSError, struct.error) as e:
+                self.logger.debug(f"DNS запрос {name} (тип {qtype}) к {server} не выполнен: {e}")
+                last_error = e
+        
+        raise DNSError(f"Нет ответа от DNS серверов {', '.join(servers)} для {name}: {last_error}")
+    
+    def _answer_data(self, response: Dict, qtype: int) -> List:
+        """Извлечение значений записей заданного типа из секции ответа"""
+        return [rr["data"] for rr in response["answers"] if rr["type"] == qtype]
+    
+    def query_txt(self, name: str, nameservers: Optional[List[str]] = None,
+                  timeout: Optional[float] = None, recursion: bool = True) -> List[str]:
+        """
+        Получение значений TXT записей
+        
+        Args:
+            name: Доменное имя
+            nameservers: Серверы для запроса
+            timeout: Таймаут запроса
+            recursion: Флаг RD (False для запросов к авторитетным серверам)
+            
+        Returns:
+            Список значений (многострочные записи объединены)
+        """
+        return self._answer_data(self.query(name, DNS_TYPE_TXT, nameservers, timeout, recursion), DNS_TYPE_TXT)
+    
+    def query_soa(self, name: str, nameservers: Optional[List[str]] = None,
+                  timeout: Optional[float] = None, recursion: bool = True) -> Optional[Dict]:
+        """
+        Получение SOA записи зоны
+        
+        Args:
+            name: Имя зоны
+            nameservers: Серверы для запроса
+            timeout: Таймаут запроса
+            recursion: Флаг RD (False для запросов к авторитетным серверам)
+            
+        Returns:
+            Поля SOA записи и TTL самой записи (ttl) или None
+        """
+        response = self.query(name, DNS_TYPE_SOA, nameservers, timeout, recursion)
+        records = [rr for rr in response["answers"] if rr["type"] == DNS_TYPE_SOA]
+        if not records:
+            # Для имени внутри зоны SOA возвращается в секции authority
+            records = [rr for rr in response["authority"] if rr["type"] == DNS_TYPE_SOA]
+        return dict(records[0]["data"], ttl=records[0]["ttl"]) if records else None
+    
+    def query_ns(self, name: str, nameservers: Optional[List[str]] = None,
+                 timeout: Optional[float] = None, recursion: bool = True) -> List[str]:
+        """
+        Получение списка NS серверов зоны
+        
+        Args:
+            name: Имя зоны
+            nameservers: Серверы для запроса
+            timeout: Таймаут запроса
+            recursion: Флаг RD (False для запросов к авторитетным серверам)
+            
+        Returns:
+            Список имён NS серверов
+        """
+        return self._answer_data(self.query(name, DNS_TYPE_NS, nameservers, timeout, recursion), DNS_TYPE_NS)
+    
+    def query_cname(self, name: str, nameservers: Optional[List[str]] = None,
+                    timeout: Optional[float] = None, recursion: bool = True) -> Optional[str]:
+        """
+        Получение цели CNAME записи
+        
+        Args:
+            name: Доменное имя
+            nameservers: Серверы для запроса
+            timeout: Таймаут запроса
+            recursion: Флаг RD (False для запросов к авторитетным серверам)
+            
+        Returns:
+            Имя, на которое указывает CNAME, или None
+        """
+        records = self._answer_data(self.query(name, DNS_TYPE_CNAME, nameservers, timeout, recursion), DNS_TYPE_CNAME)
+        return records[0] if records else None
+    
+    def query_a(self, name: str, nameservers: Optional[List[str]] = None,
+                timeout: Optional[float] = None, recursion: bool = True) -> List[str]:
+        """
+        Получение IPv4 адресов имени
+        
+        Args:
+            name: Доменное имя
+            nameservers: Серверы для запроса
+            timeout: Таймаут запроса
+            recursion: Флаг RD (False для запросов к авторитетным серверам)
+            
+        Returns:
+            Список IPv4 адресов
+        """
+        return self._answer_data(self.query(name, DNS_TYPE_A, nameservers, timeout, recursion), DNS_TYPE_A)
+
+
+# ==============================================================================
+# БЭКЕНДЫ DNS CHALLENGE (ДЕЛЕГИРОВАНИЕ ЧЕРЕЗ CNAME)
+# ==============================================================================
+
+# Алгоритмы TSIG: имя алгоритма в DNS и функция хэширования hmac
+TSIG_ALGORITHMS = {
+    "hmac-md5": ("hmac-md5.sig-alg.reg.int", "md5"),
+    "hmac-sha1": ("hmac-sha1", "sha1"),
+    "hmac-sha256": ("hmac-sha256", "sha256"),
+    "hmac-sha512": ("hmac-sha512", "sha512"),
+}
+
+
+def encode_txt_rdata(value: str) -> bytes:
+    """
+    Кодирование значения TXT записи (строки по 255 байт с префиксом длины)
+    
+    Args:
+        value: Значение TXT записи
+        
+    Returns:
+        RDATA записи
+    """
+    raw = value.encode("utf-8")
+    chunks = [raw[i:i + 255] for i in range(0, len(raw), 255)] or [b""]
+    return b"".join(struct.pack("!B", len(chunk)) + chunk for chunk in chunks)
+
+
+class ChallengeBackend:
+    """
+    Бэкенд для публикации TXT записей challenge
+    
+    Записи передаются тройками (зона, поддомен, значение). Методы возвращают
+    для каждой записи None при успехе или текст ошибки.
+    """
+    
+    name = ""
+    zone: Optional[str] = None
+    
+    def publish(self, records: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+        """Публикация TXT записей"""
+        raise NotImplementedError
+    
+    def unpublish(self, records: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+        """Удаление TXT записей"""
+        raise NotImplementedError
+    
+    def nameservers(self) -> Dict[str, List[str]]:
+        """
+        Серверы для проверки распространения
+        
+        Returns:
+            Словарь {имя сервера: [IP адреса]} (пусто - NS записи зоны)
+        """
+        return {}
+
+
+class RegRuChallengeBackend(ChallengeBackend):
+    """Публикация через API reg.ru (одним запросом zone/update_records)"""
+    
+    def __init__(self, api: "RegRuAPI", name: str = "regru", zone: Optional[str] = None,
+                 nameservers: Optional[List[str]] = None):
+        """
+        Инициализация
+        
+        Args:
+            api: API клиент reg.ru
+            name: Имя бэкенда в конфигурации
+            zone: Зона валидации (None - зона самого домена)
+            nameservers: IP адреса серверов для проверки (по умолчанию NS зоны)
+        """
+        self.api = api
+        self.name = name
+        self.zone = zone
+        self._nameservers = nameservers or []
+    
+    def _submit(self, records: List[Tuple[str, str, str]], add: bool) -> List[Optional[str]]:
+        batch = self.api.batch()
+        for zone, subdomain, value in records:
+            if add:
+                batch.add_txt(zone, subdomain, value)
+            else:
+                batch.remove_txt(zone, subdomain, value)
+        return [None if result["success"] else result["error"] for result in batch.submit()]
+    
+    def publish(self, records: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+        return self._submit(records, add=True)
+    
+    def unpublish(self, records: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+        return self._submit(records, add=False)
+    
+    def nameservers(self) -> Dict[str, List[str]]:
+        return {address: [address] for address in self._nameservers}
+
+
+class RFC2136ChallengeBackend(ChallengeBackend):
+    """
+    Публикация через динамическое обновление DNS (RFC 2136) с подписью TSIG
+    
+    Все записи одного вызова отправляются одним сообщением UPDATE.
+    Ответ сервера проверяется по коду rcode.
+    """
+    
+    def __init__(self, name: str, zone: str, server: str, logger: logging.Logger,
+                 port: int = 53, key_name: Optional[str] = None, key_secret: Optional[str] = None,
+                 key_algorithm: str = "hmac-sha256", ttl: int = 60, timeout: float = 5.0,
+                 nameservers: Optional[List[str]] = None):
+        """
+        Инициализация
+        
+        Args:
+            name: Имя бэкенда в конфигурации
+            zone: Зона валидации
+            server: IP адрес primary сервера зоны
+            logger: Logger объект
+            port: Порт сервера
+            key_name: Имя ключа TSIG (None - без подписи)
+            key_secret: Секрет ключа TSIG (base64)
+            key_algorithm: Алгоритм TSIG (hmac-sha256, hmac-sha512, hmac-sha1, hmac-md5)
+            ttl: TTL публикуемых записей
+            timeout: Таймаут запроса (секунды)
+            nameservers: IP адреса серверов для проверки (по умолчанию NS зоны)
+        """
+        if key_name and key_algorithm not in TSIG_ALGORITHMS:
+            raise ValueError(f"Неизвестный алгоритм TSIG: {key_algorithm}")
+        self.name = name
+        self.zone = zone.rstrip(".").lower()
+        self.server = server
+        self.port = port
+        self.key_name = key_name
+        self.key_secret = base64.b64decode(key_secret) if key_secret else b""
+        self.key_algorithm = key_algorithm
+        self.ttl = ttl
+        self.timeout = timeout
+        self.logger = logger
+        self._nameservers = nameservers or []
+    
+    def _sign(self, message: bytes, qid: int) -> bytes:
+        """Добавление записи TSIG (RFC 8945) к сообщению"""
+        algorithm, digest = TSIG_ALGORITHMS[self.key_algorithm]
+        key_name = DNSResolver._encode_name(self.key_name.lower())
+        algorithm_name = DNSResolver._encode_name(algorithm)
+        time_signed = int(time.time())
+        time_fields = struct.pack("!HIH", time_signed >> 32, time_signed & 0xFFFFFFFF, 300)
+        
+        variables = (key_name + struct.pack("!HI", DNS_CLASS_ANY, 0) + algorithm_name
+                     + time_fields + struct.pack("!HH", 0, 0))
+        mac = hmac.new(self.key_secret, message + variables, digest).digest()
+        
+        rdata = (algorithm_name + time_fields + struct.pack("!H", len(mac)) + mac
+                 + struct.pack("!HHH", qid, 0, 0))
+        tsig = key_name + struct.pack("!HHIH", DNS_TYPE_TSIG, DNS_CLASS_ANY, 0, len(rdata)) + rdata
+        arcount = struct.unpack("!H", message[10:12])[0] + 1
+        return message[:10] + struct.pack("!H", arcount) + message[12:] + tsig
+    
+    def _update(self, records: List[Tuple[str, str, str]], add: bool) -> List[Optional[str]]:
+        qid = random.randint(0, 0xFFFF)
+        header = struct.pack("!HHHHHH", qid, DNS_OPCODE_UPDATE << 11, 1, 0, len(records), 0)
+        message = header + DNSResolver._encode_name(self.zone) + struct.pack("!HH", DNS_TYPE_SOA, DNS_CLASS_IN)
+        for zone, subdomain, value in records:
+            rdata = encode_txt_rdata(value)
+            rclass, ttl = (DNS_CLASS_IN, self.ttl) if add else (DNS_CLASS_NONE, 0)
+            message += (DNSResolver._encode_name(f"{subdomain}.{zone}")
+                        + struct.pack("!HHIH", DNS_TYPE_TXT, rclass, ttl, len(rdata)) + rdata)
+        if self.key_name:
+            message = self._sign(message, qid)
+        
+        try:
+            response = DNSResolver._send_udp(self.server, message, self.timeout, self.port)
+            if len(response) >= 4 and struct.unpack("!H", response[2:4])[0] & 0x0200:
+                response = DNSResolver._send_tcp(self.server, message, self.timeout, self.port)
+        except OSError as e:
+            return [f"Сервер {self.server}:{self.port} не ответил: {e}"] * len(records)
+        
+        if len(response) < 12 or struct.unpack("!H", response[:2])[0] != qid:
+            return [f"Некорректный ответ сервера {self.server}"] * len(records)
+        rcode = struct.unpack("!H", response[2:4])[0] & 0x000F
+        if rcode != DNS_RCODE_NOERROR:
+            return [f"Сервер {self.server} отклонил обновление (rcode {rcode})"] * len(records)
+        return [None] * len(records)
+    
+    def publish(self, records: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+        return self._update(records, add=True) if records else []
+    
+    def unpublish(self, records: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+        return self._update(records, add=False) if records else []
+    
+    def nameservers(self) -> Dict[str, List[str]]:
+        return {address: [address] for address in self._nameservers}
+
+
+class BuiltinChallengeBackend(ChallengeBackend):
+    """
+    Публикация во встроенный авторитетный DNS сервер (--challenge-responder)
+    
+    Записи сохраняются в файл, который сервер читает при каждом запросе,
+    поэтому запись видна сразу после публикации.
+    """
+    
+    def __init__(self, name: str, zone: str, store_path: str, address: str = "127.0.0.1",
+                 port: int = 53):
+        """
+        Инициализация
+        
+        Args:
+            name: Имя бэкенда в конфигурации
+            zone: Зона валидации, обслуживаемая встроенным сервером
+            store_path: Файл с записями сервера
+            address: IP адрес сервера для проверки распространения
+            port: Порт сервера
+        """
+        self.name = name
+        self.zone = zone.rstrip(".").lower()
+        self.store = ResponderStore(store_path)
+        self.address = address
+        self.port = port
+    
+    def publish(self, records: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+        try:
+            self.store.update([(f"{subdomain}.{zone}", value) for zone, subdomain, value in records], add=True)
+        except OSError as e:
+            return [f"Не удалось записать {self.store.path}: {e}"] * len(records)
+        return [None] * len(records)
+    
+    def unpublish(self, records: List[Tuple[str, str, str]]) -> List[Optional[str]]:
+        try:
+            self.store.update([(f"{subdomain}.{zone}", value) for zone, subdomain, value in records], add=False)
+        except OSError as e:
+            return [f"Не удалось записать {self.store.path}: {e}"] * len(records)
+        return [None] * len(records)
+    
+    def nameservers(self) -> Dict[str, List[str]]:
+        server = DNSResolver.format_server(self.address, self.port)
+        return {server: [server]}
+
+
+class ResponderStore:
+    """Файл TXT записей встроенного DNS сервера: {"serial", "records": {имя: [значения]}}"""
+    
+    def __init__(self, path: str):
+        """
+        Инициализация
+        
+        Args:
+            path: Путь к файлу записей
+        """
+        self.path = path
+    
+    def load(self) -> Dict:
+        """
+        Чтение записей
+        
+        Returns:
+            Словарь с полями serial и records
+        """
+        return read_json_file(self.path) or {"serial": 1, "records": {}}
+    
+    def update(self, records: List[Tuple[str, str]], add: bool):
+        """
+        Добавление или удаление записей (с увеличением serial зоны)
+        
+        Args:
+            records: Пары (полное имя, значение TXT записи)
+            add: True - добавить, False - удалить
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self.load()
+            for name, value in records:
+                values = data["records"].setdefault(name.rstrip(".").lower(), [])
+                if add and value not in values:
+                    values.append(value)
+                elif not add and value in values:
+                    values.remove(value)
+            data["records"] = {name: values for name, values in data["records"].items() if values}
+            data["serial"] = data.get("serial", 1) + 1
+            write_json_file(self.path, data)
+
+
+class ChallengeResponder:
+    """
+    Встроенный авторитетный DNS сервер для зоны валидации (UDP)
+    
+    Отвечает на запросы TXT записей из ResponderStore, а также SOA и NS
+    на вершине зоны. Минимальный TTL отрицательного кэширования в SOA
+    не даёт резолверам надолго запомнить отсутствие записи.
+    """
+    
+    def __init__(self, zones: List[str], store_path: str, logger: logging.Logger,
+                 listen: str = "0.0.0.0", port: int = 53, ns_name: Optional[str] = None,
+                 ns_address: Optional[str] = None, ttl: int = 1):
+        """
+        Инициализация
+        
+        Args:
+            zones: Обслуживаемые зоны валидации
+            store_path: Файл с записями
+            logger: Logger объект
+            listen: Адрес для приёма запросов
+            port: Порт для приёма запросов
+            ns_name: Имя сервера в записях NS/SOA (по умолчанию ns.<зона>)
+            ns_address: IPv4 или IPv6 адрес сервера (для A/AAAA записи ns_name внутри зоны)
+            ttl: TTL ответов
+            
+        Raises:
+            ValueError: ns_address не является IP адресом
+        """
+        self.zones = [zone.rstrip(".").lower() for zone in zones]
+        self.store = ResponderStore(store_path)
+        self.logger = logger
+        self.listen = listen
+        self.port = port
+        self.ns_name = ns_name
+        self.ns_address = ns_address
+        self.ttl = ttl
+        # Тип и RDATA записи адреса ns_name: A для IPv4, AAAA для IPv6
+        self._ns_glue: Optional[Tuple[int, bytes]] = None
+        if ns_address:
+            family, rtype = (socket.AF_INET6, DNS_TYPE_AAAA) if ":" in ns_address else (socket.AF_INET, DNS_TYPE_A)
+            try:
+                self._ns_glue = (rtype, socket.inet_pton(family, ns_address))
+            except OSError:
+                raise ValueError(f"ns_address должен быть IPv4 или IPv6 адресом: {ns_address}")
+    
+    def _zone_for(self, name: str) -> Optional[str]:
+        for zone in self.zones:
+            if name == zone or name.endswith("." + zone):
+                return zone
+        return None
+    
+    def _rr(self, name: str, rtype: int, rdata: bytes, ttl: Optional[int] = None) -> bytes:
+        return (DNSResolver._encode_name(name)
+                + struct.pack("!HHIH", rtype, DNS_CLASS_IN, self.ttl if ttl is None else ttl, len(rdata)) + rdata)
+    
+    def _soa(self, zone: str, serial: int) -> bytes:
+        ns_name = self.ns_name or f"ns.{zone}"
+        rdata = (DNSResolver._encode_name(ns_name) + DNSResolver._encode_name(f"hostmaster.{zone}")
+                 + struct.pack("!IIIII", serial & 0xFFFFFFFF, 3600, 600, 86400, self.ttl))
+        return self._rr(zone, DNS_TYPE_SOA, rdata)
+    
+    def answer(self, query: bytes) -> Optional[bytes]:
+        """
+        Формирование ответа на DNS запрос
+        
+        Args:
+            query: DNS сообщение запроса
+            
+        Returns:
+            DNS сообщение ответа (None - запрос проигнорирован)
+        """
+        if len(query) < 12:
+            return None
+        qid, flags, qdcount = struct.unpack("!HHH", query[:6])
+        if flags & 0x8000 or qdcount != 1:
+            return None
+        try:
+            qname, offset = DNSResolver._read_name(query, 12)
+            qtype = struct.unpack("!H", query[offset:offset + 2])[0]
+        except (DNSError, struct.error, IndexError):
+            return None
+        question = query[12:offset + 4]
+        name = qname.rstrip(".").lower()
+        
+        answers: List[bytes] = []
+        authority: List[bytes] = []
+        zone = self._zone_for(name)
+        if zone is None:
+            rcode = DNS_RCODE_REFUSED
+        else:
+            data = self.store.load()
+            values = data["records"].get(name, [])
+            ns_name = (self.ns_name or f"ns.{zone}").rstrip(".").lower()
+            exists = bool(values) or name == zone or (name == ns_name and self.ns_address)
+            rcode = DNS_RCODE_NOERROR if exists else DNS_RCODE_NXDOMAIN
+            
+            if qtype == DNS_TYPE_TXT:
+                answers = [self._rr(name, DNS_TYPE_TXT, encode_txt_rdata(value)) for value in values]
+            elif qtype == DNS_TYPE_SOA and name == zone:
+                answers = [self._soa(zone, data.get("serial", 1))]
+            elif qtype == DNS_TYPE_NS and name == zone:
+                answers = [self._rr(zone, DNS_TYPE_NS, DNSResolver._encode_name(ns_name), 3600)]
+            elif self._ns_glue and qtype == self._ns_glue[0] and name == ns_name:
+                answers = [self._rr(name, qtype, self._ns_glue[1], 3600)]
+            if not answers:
+                authority = [self._soa(zone, data.get("serial", 1))]
+        
+        # QR, AA, RD из запроса, код ответа
+        response_flags = 0x8000 | 0x0400 | (flags & 0x7900) | rcode
+        header = struct.pack("!HHHHHH", qid, response_flags, 1, len(answers), len(authority), 0)
+        return header + question + b"".join(answers) + b"".join(authority)
+    
+    def serve_forever(self):
+        """Приём и обработка запросов до остановки процесса"""
+        family = socket.AF_INET6 if ":" in self.listen else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.bind((self.listen, self.port))
+            self.logger.info(f"DNS сервер challenge слушает {self.listen}:{self.port} "
+                             f"(зоны: {', '.join(self.zones)})")
+            while True:
+                query, address = sock.recvfrom(4096)
+                try:
+                    response = self.answer(query)
+                except Exception as e:
+                    self.logger.warning(f"Ошибка обработки DNS запроса от {address[0]}: {e}")
+                    continue
+                if response:
+                    sock.sendto(response, address)
+
+
+# ==============================================================================
+# КЛАСС ДЛЯ РАБОТЫ С NGINX PROXY MANAGER
+# ==============================================================================
+
+class NpmCertificateIndex:
+    """
+    Индекс сертификатов NPM по доменам
+    
+    Строится из одного запроса списка сертификатов и обновляется по ответам
+    создания, изменения и удаления. Ключ - имя без префикса "*.", поэтому
+    example.com находит сертификаты и для example.com, и для *.example.com.
+    Сертификаты, домены которых NPM ещё не распознал, индексируются по nice_name.
+    """
+    
+    def __init__(self, certificates: List[Dict]):
+        """
+        Инициализация
+        
+        Args:
+            certificates: Список сертификатов из /api/nginx/certificates
+        """
+        self._certificates: Dict[int, Dict] = {}
+        self._names: Dict[str, Dict[int, int]] = {}
+        self._position = 0
+        for cert in certificates:
+            self.add(cert)
+    
+    @staticmethod
+    def _keys(cert: Dict) -> List[str]:
+        names = cert.get("domain_names") or [cert.get("nice_name") or ""]
+        return list(dict.fromkeys(
+            name.strip().lower()[2:] if name.strip().startswith("*.") else name.strip().lower()
+            for name in names if name.strip()
+        ))
+    
+    def __len__(self) -> int:
+        return len(self._certificates)
+    
+    def get(self, cert_id: int) -> Optional[Dict]:
+        """
+        Сертификат по ID
+        
+        Args:
+            cert_id: ID сертификата в NPM
+            
+        Returns:
+            Данные сертификата или None
+        """
+        return self._certificates.get(cert_id)
+    
+    def add(self, cert: Dict):
+        """
+        Добавление или замена сертификата (по ID)
+        
+        Args:
+            cert: Данные сертификата
+        """
+        cert_id = cert.get("id")
+        if cert_id is None:
+            return
+        position = self.remove(cert_id)
+        if position is None:
+            position = self._position
+            self._position += 1
+        self._certificates[cert_id] = cert
+        for key in self._keys(cert):
+            self._names.setdefault(key, {})[cert_id] = position
+    
+    def remove(self, cert_id: int) -> Optional[int]:
+        """
+        Удаление сертификата из индекса
+        
+        Args:
+            cert_id: ID сертификата в NPM
+            
+        Returns:
+            Позиция удалённого сертификата в списке или None, если его не было
+        """
+        cert = self._certificates.pop(cert_id, None)
+        if cert is None:
+            return None
+        position = None
+        for key in self._keys(cert):
+            ids = self._names.get(key, {})
+            position = ids.pop(cert_id, position)
+            if not ids:
+                self._names.pop(key, None)
+        return position
+    
+    def find(self, domain: str) -> Optional[Dict]:
+        """
+        Сертификат для домена или его wildcard (первый в порядке списка NPM)
+        
+        Args:
+            domain: Доменное имя
+            
+        Returns:
+            Данные сертификата или None
+        """
+        name = domain.strip().lower()
+        # Ключи индекса хранятся без "*.", как в _keys
+        ids = self._names.get(name[2:] if name.startswith("*.") else name)
+        if not ids:
+            return None
+        return self._certificates[min(ids, key=ids.get)]
+
+
+class NginxProxyManagerAPI:
+    """Класс для работы с API Nginx Proxy Manager"""
+    
+    def __init__(self, host: str, email: str, password: str, logger: logging.Logger,
+                 token_cache_dir: Optional[str] = None, token_refresh_before: float = 43200):
+        """
+        Инициализация API клиента NPM
+        
+        Args:
+            host: URL адрес NPM (например, http://10.10.10.14:81)
+            email: Email для входа
+            password: Пароль
+            logger: Logger объект
+            token_cache_dir: Директория кэша токенов (None - без кэша)
+            token_refresh_before: Обновлять токен, когда до истечения меньше (секунды)
+        """
+        self.host = host.rstrip('/')
+        self.email = email
+        self.password = password
+        self.logger = logger
+        self.session = requests.Session()
+        self.token = None
+        self.token_expires = 0.0
+        self.index: Optional[NpmCertificateIndex] = None
+        self.token_refresh_before = token_refresh_before
+        self.token_cache_file = None
+        if token_cache_dir:
+            host_id = hashlib.sha256(self.host.encode("utf-8")).hexdigest()[:16]
+            self.token_cache_file = os.path.join(token_cache_dir, f"token-{host_id}.json")
+    
+    @staticmethod
+    def token_expiry(token: str, expires: Optional[str] = None) -> float:
+        """
+        Срок действия токена: поле exp JWT или поле expires ответа NPM
+        
+        Args:
+            token: JWT токен
+            expires: Дата истечения из ответа /api/tokens (ISO 8601)
+            
+        Returns:
+            Время истечения (Unix time); без данных - через час
+        """
+        try:
+            payload = token.split(".")[1]
+            payload += "=" * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+        except (IndexError, KeyError, TypeError, ValueError):
+            pass
+        if expires:
+            try:
+                return datetime.fromisoformat(expires.replace("Z", "+00:00")).timestamp()
+            except ValueError:
+                pass
+        return time.time() + 3600
+    
+    def _set_token(self, token: str, expires: Optional[str] = None):
+        """Установка токена в заголовки и сохранение в кэш"""
+        self.token = token
+        self.token_expires = self.token_expiry(token, expires)
+        self.session.headers.update({"Authorization": f"Bearer {token}"})
+        if self.token_cache_file:
+            try:
+                write_json_file(self.token_cache_file, {
+                    "host": self.host, "email": self.email,
+                    "token": token, "expires": self.token_expires,
+                })
+            except OSError as e:
+                self.logger.debug(f"Не удалось сохранить токен NPM: {e}")
+    
+    def _load_token(self):
+        """Загрузка токена из кэша (если он для этого хоста и пользователя)"""
+        cached = read_json_file(self.token_cache_file) if self.token_cache_file else None
+        if cached and cached.get("host") == self.host and cached.get("email") == self.email \
+                and cached.get("expires", 0) > time.time():
+            self.token = cached["token"]
+            self.token_expires = cached["expires"]
+            self.session.headers.update({"Authorization": f"Bearer {self.token}"})
+    
+    def _forget_token(self):
+        """Сброс отклонённого токена в памяти и в кэше"""
+        self.token = None
+        self.token_expires = 0.0
+        self.session.headers.pop("Authorization", None)
+        if self.token_cache_file:
+            try:
+                os.remove(self.token_cache_file)
+            except OSError:
+                pass
+    
+    def _refresh_token(self) -> bool:
+        """
+        Обновление действующего токена (GET /api/tokens), без пароля
+        
+        Returns:
+            True если получен новый токен
+        """
+        try:
+            response = self.session.get(f"{self.host}/api/tokens", timeout=10)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.logger.debug(f"Не удалось обновить токен NPM: {e}")
+            return False
+        if not data.get("token"):
+            return False
+        self._set_token(data["token"], data.get("expires"))
+        self.logger.debug("Токен NPM обновлён")
+        return True
+    
+    def _request(self, method: str, url: str, **kwargs) -> "requests.Response":
+        """
+        Запрос к API NPM; при ответе 401 - вход по паролю и один повтор
+        
+        Args:
+            method: HTTP метод
+            url: URL
+            **kwargs: Параметры requests
+            
+        Returns:
+            Ответ (успешный)
+            
+        Raises:
+            requests.exceptions.RequestException: Ошибка запроса или HTTP ошибка
+        """
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code == 401:
+            self.logger.info("NPM отклонил токен (401), повторная авторизация")
+            self._forget_token()
+            if self._password_login():
+                response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+    
+    def login(self) -> bool:
+        """
+        Авторизация в Nginx Proxy Manager
+        
+        Токен берётся из памяти или из кэша, пока до его истечения больше
+        token_refresh_before секунд; ближе к истечению он обновляется без
+        пароля. Вход по паролю - только без действующего токена или после
+        ответа 401.
+        
+        Returns:
+            True если успешно
+        """
+        if not self.token:
+            self._load_token()
+        remaining = self.token_expires - time.time()
+        if self.token and remaining > self.token_refresh_before:
+            self.logger.debug(f"Используется сохранённый токен NPM (действует ещё {int(remaining)} сек)")
+            return True
+        if self.token and remaining > 0 and self._refresh_token():
+            return True
+        return self._password_login()
+    
+    def _password_login(self) -> bool:
+        """
+        Вход в NPM по email и паролю (POST /api/tokens)
+        
+        Returns:
+            True если успешно
+        """
+        url = f"{self.host}/api/tokens"
+        
+        payload = {
+            "identity": self.email,
+            "secret": self.password
+        }
+        
+        try:
+            self.logger.info("Авторизация в Nginx Proxy Manager...")
+            response = self.session.post(url, json=payload, timeout=10)
+            response.raise_for_status()
+            
+            data = response.json()
+            
+            if data.get("token"):
+                # Устанавливаем токен в заголовки для последующих запросов и в кэш
+                self._set_token(data["token"], data.get("expires"))
+                self.logger.info("Авторизация в NPM успешна")
+                return True
+            else:
+                self.logger.error("Токен не получен при авторизации")
+                return False
+                
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Ошибка при авторизации в NPM: {e}")
+            return False
+    
+    def get_certificates(self) -> List[Dict]:
+        """
+        Получение списка сертификатов
+        
+        Returns:
+            Список сертификатов
+        """
+        url = f"{self.host}/api/nginx/certificates"
+        
+        try:
+            self.logger.debug("Получение списка сертификатов из NPM...")
+            response = self._request("GET", url, timeout=10)
+            
+            certificates = response.json()
+            self.logger.debug(f"Получено {len(certificates)} сертификатов")
+            self.index = NpmCertificateIndex(certificates)
+            return certificates
+            
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Ошибка при получении списка сертификатов: {e}")
+            return []
+
+    def get_certificate_by_id(self, cert_id: int) -> Optional[Dict]:
+        """Возвращает данные сертификата по ID из NPM"""
+        url = f"{self.host}/api/nginx/certificates/{cert_id}"
+        try:
+            self.logger.debug(f"Запрос сертификата ID={cert_id} из NPM...")
+            response = self._request("GET", url, timeout=10)
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            self.logger.warning(f"Не удалось получить сертификат ID {cert_id}: {e}")
+            return None
+
+    @staticmethod
+    def expected_certificate_fields(cert_path: str) -> Optional[Tuple[set, datetime]]:
+        """
+        Домены и дата истечения, которые NPM должен получить из сертификата
+        
+        Args:
+            cert_path: Путь к fullchain.pem или cert.pem (берётся первый сертификат)
+            
+        Returns:
+            (множество доменов SAN в нижнем регистре, not_after в UTC без tzinfo) или None
+        """
+        try:
+            from cryptography import x509
+            from cryptography.hazmat.backends import default_backend
+            import warnings
+            
+            with open(cert_path, "rb") as f:
+                cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+            try:
+                not_after = cert.not_valid_after_utc.replace(tzinfo=None)
+            except AttributeError:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    not_after = cert.not_valid_after
+            try:
+                san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+                domains = {d.lower() for d in san.value.get_values_for_type(x509.DNSName)}
+            except x509.ExtensionNotFound:
+                domains = set()
+            return domains, not_after
+        except Exception:
+            return None
+    
+    @staticmethod
+    def _npm_datetime(value: str) -> Optional[datetime]:
+        """Разбор даты NPM ("2026-01-01 00:00:00" или ISO с Z/смещением) в UTC без tzinfo"""
+        try:
+            parsed = datetime.fromisoformat(str(value).strip().replace(" ", "T").replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        if parsed.tzinfo is not None:
+            parsed = (parsed - parsed.utcoffset()).replace(tzinfo=None)
+        return parsed
+    
+    def certificate_parsed(self, cert: Dict, expected: Optional[Tuple[set, datetime]] = None) -> bool:
+        """
+        Завершил ли NPM парсинг сертификата
+        
+        Если известны ожидаемые значения из PEM - domain_names и expires_on
+        должны с ними совпасть. Иначе: домены определены и expires_on
+        отличается от created_on.
+        """
+        domains = cert.get('domain_names', []) or []
+        expires_on = cert.get('expires_on')
+        if expected is None:
+            created_on = cert.get('created_on')
+            return bool(domains and expires_on and (not created_on or expires_on != created_on))
+        
+        names, not_after = expected
+        if names and {d.lower() for d in domains} != names:
+            return False
+        parsed = self._npm_datetime(expires_on) if expires_on else None
+        # Допуск на часовой пояс NPM: дата может быть сохранена в локальном времени сервера
+        if parsed is None:
+            return False
+        delta = abs((parsed - not_after).total_seconds())
+        offset = delta % 900
+        return delta <= 14 * 3600 and min(offset, 900 - offset) <= 1
+    
+    def wait_for_certificate_parse(self, cert_id: int, cert_path: Optional[str] = None,
+                                   initial: Optional[Dict] = None, timeout_seconds: float = 12,
+                                   initial_delay: float = 0.05, max_delay: float = 2.0) -> Optional[Dict]:
+        """
+        Ожидает, пока NPM распарсит загруженный сертификат и заполнит поля domain_names и expires_on.
+        
+        Сначала проверяется ответ на загрузку (initial), затем сертификат
+        запрашивается с экспоненциально растущей паузой: initial_delay,
+        удваивается до max_delay.
+        
+        Args:
+            cert_id: ID сертификата в NPM
+            cert_path: Путь к загруженному сертификату для сверки domain_names/expires_on
+            initial: Ответ NPM на загрузку/обновление
+            timeout_seconds: Максимальное время ожидания
+            initial_delay: Первая пауза между запросами
+            max_delay: Максимальная пауза между запросами
+            
+        Returns:
+            Итоговые данные сертификата (последние полученные при таймауте) или None
+        """
+        expected = self.expected_certificate_fields(cert_path) if cert_path else None
+        deadline = time.monotonic() + timeout_seconds
+        delay = initial_delay
+        last: Optional[Dict] = initial if isinstance(initial, dict) else None
+        cert = last
+        while True:
+            if cert:
+                last = cert
+                self.logger.debug(
+                    f"Проверка парсинга NPM: domains={cert.get('domain_names', [])}, "
+                    f"expires_on={cert.get('expires_on')}, created_on={cert.get('created_on')}"
+                )
+                if self.certificate_parsed(cert, expected):
+                    self.logger.info("NPM завершил парсинг сертификата")
+                    return cert
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.logger.debug(f"NPM не завершил парсинг за {timeout_seconds} сек")
+                return last
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+            cert = self.get_certificate_by_id(cert_id)
+    
+    def find_certificate_by_domain(self, domain: str) -> Optional[Dict]:
+        """
+        Поиск сертификата по домену
+        
+        Args:
+            domain: Доменное имя
+            
+        Returns:
+            Данные сертификата или None
+        """
+        # Список сертификатов запрашивается один раз за запуск, дальше - индекс
+        if self.index is None:
+            self.get_certificates()
+        if self.index is None:
+            return None
+        
+        self.logger.debug(f"Поиск сертификата для домена: {domain} (в индексе {len(self.index)})")
+        cert = self.index.find(domain)
+        if not cert:
+            self.logger.debug(f"Сертификат для {domain} не найден")
+            return None
+        
+        domains = cert.get("domain_names", [])
+        if domains:
+            self.logger.info(f"✅ Найден существующий сертификат для {domain}")
+            self.logger.info(f"   ID: {cert.get('id')}, Домены: {', '.join(domains)}")
+        else:
+            # NPM ещё не распарсил домены - найден по nice_name;
+            # это предотвращает дублирование сертификатов при первичной загрузке
+            self.logger.info(f"✅ Найден сертификат по имени (домены ещё не распознаны NPM)")
+            self.logger.info(f"   ID: {cert.get('id')}, Имя: {cert.get('nice_name')}")
+        return cert
+    
+    def upload_certificate(self, domain: str, cert_path: str, key_path: str, 
+                          chain_path: Optional[str] = None) -> Optional[Dict]:
+        """
+        Загрузка нового сертификата в NPM
+        
+        ВАЖНО: NPM автоматически извлекает информацию из сертификата.
+        Мы загружаем сертификат через веб-интерфейс формы (multipart/form-data),
+        а не через JSON API, так как JSON endpoint имеет строгую валидацию схемы.
+        
+        Args:
+            domain: Основной домен
+            cert_path: Путь к файлу сертификата
+            key_path: Путь к приватному ключу
+            chain_path: Путь к цепочке сертификатов (опционально)
+            
+        Returns:
+            Данные созданного сертификата или None
+        """
+        url = f"{self.host}/api/nginx/certificates"
+        
+        try:
+            # Читаем приватный ключ
+            with open(key_path, 'r') as f:
+                certificate_key = f.read()
+            
+            # Определяем, какие файлы использовать
+            cert_dir = os.path.dirname(cert_path)
+            cert_only_path = os.path.join(cert_dir, "cert.pem")
+            chain_only_path = os.path.join(cert_dir, "chain.pem")
+            
+            # Используем отдельные файлы cert.pem и chain.pem
+            # NPM лучше работает с разделенными файлами
+            if os.path.exists(cert_only_path) and os.path.exists(chain_only_path):
+                self.logger.info("Загружаем cert.pem и chain.pem отдельно")
+                with open(cert_only_path, 'rb') as f:
+                    certificate = f.read().decode('utf-8')
+                with open(chain_only_path, 'rb') as f:
+                    intermediate_certificate = f.read().decode('utf-8')
+                self.logger.info(f"Загружено: cert.pem ({len(certificate)} байт), chain.pem ({len(intermediate_certificate)} байт)")
+            else:
+                # Fallback: загружаем fullchain целиком
+                self.logger.info("cert.pem/chain.pem не найдены, загружаем fullchain.pem")
+                with open(cert_path, 'rb') as f:
+                    certificate = f.read().decode('utf-8')
+                intermediate_certificate = ""
+                self.logger.info(f"Загружено: fullchain.pem ({len(certificate)} байт)")
+            
+            # Проверяем корректность сертификатов
+            if not certificate.strip().startswith('-----BEGIN CERTIFICATE-----'):
+                self.logger.error("Ошибка: Основной сертификат не начинается с BEGIN CERTIFICATE")
+                return None
+            
+            if intermediate_certificate and not intermediate_certificate.strip().startswith('-----BEGIN CERTIFICATE-----'):
+                self.logger.error("Ошибка: Промежуточный сертификат не начинается с BEGIN CERTIFICATE")
+                return None
+            
+            # Показываем первые строки для диагностики
+            self.logger.debug(f"Основной сертификат начинается с: {certificate[:60]}...")
+            if intermediate_certificate:
+                self.logger.debug(f"Промежуточный сертификат начинается с: {intermediate_certificate[:60]}...")
+            
+            # NPM Web UI использует multipart/form-data для загрузки custom сертификатов
+            # Загружаем cert.pem и chain.pem отдельно
+            files = {
+                'certificate': ('cert.pem', certificate, 'application/x-pem-file'),
+                'certificate_key': ('privkey.pem', certificate_key, 'application/x-pem-file'),
+            }
+            
+            # Добавляем intermediate_certificate если есть
+            if intermediate_certificate and intermediate_certificate.strip():
+                files['intermediate_certificate'] = ('chain.pem', intermediate_certificate, 'application/x-pem-file')
+                self.logger.info(f"Загружаем cert ({len(certificate)} байт) + chain ({len(intermediate_certificate)} байт) + privkey")
+            else:
+                self.logger.info(f"Загружаем cert ({len(certificate)} байт) + privkey (без chain)")
+            
+            # Дополнительные поля формы (только разрешенные NPM поля)
+            data = {
+                'nice_name': domain,
+                'provider': 'other',  # other для custom сертификатов
+            }
+            
+            self.logger.debug("NPM будет автоматически извлекать домены и дату истечения из сертификата")
+            
+            self.logger.debug(f"Uploading certificate as multipart/form-data")
+            self.logger.debug(f"Files: {list(files.keys())}")
+            self.logger.debug(f"Data: {data}")
+            self.logger.info(f"Загрузка сертификата для {domain} в NPM...")
+            
+            # Отправляем как multipart/form-data
+            response = self._request("POST", url, files=files, data=data, timeout=30)
+            
+            result = response.json()
+            cert_id = result.get("id")
+            
+            if cert_id:
+                self.logger.info(f"Сертификат успешно загружен в NPM (ID: {cert_id})")
+                if self.index is not None:
+                    self.index.add(result)
+                
+                # Показываем что вернул NPM
+                self.logger.debug(f"Полный ответ NPM: {json.dumps(result, indent=2, ensure_ascii=False)}")
+                
+                expires = result.get("expires_on")
+                if expires:
+                    self.logger.info(f"NPM определил дату истечения: {expires}")
+                else:
+                    self.logger.warning("NPM не вернул дату истечения сертификата!")
+                
+                # Проверяем meta.letsencrypt_email - если есть, значит NPM считает это Let's Encrypt
+                meta = result.get("meta", {})
+                if meta:
+                    self.logger.debug(f"NPM meta: {json.dumps(meta, indent=2, ensure_ascii=False)}")
+                
+                # После загрузки подождём, пока NPM распарсит сертификат (domain_names, expires_on)
+                try:
+                    parsed = self.wait_for_certificate_parse(cert_id, cert_path, initial=result)
+                    if parsed:
+                        self.logger.info(
+                            f"Итоговые данные NPM: домены={parsed.get('domain_names', [])}, истекает={parsed.get('expires_on')}"
+                        )
+                        if self.index is not None:
+                            self.index.add(parsed)
+                        return parsed
+                except Exception as e:
+                    self.logger.warning(f"Не удалось дождаться парсинга сертификата в NPM: {e}")
+                
+                return result
+            else:
+                self.logger.error("Не удалось получить ID созданного сертификата")
+                self.logger.error(f"Ответ NPM: {result}")
+                return None
+                
+        except FileNotFoundError as e:
+            self.logger.error(f"Файл сертификата не найден: {e}")
+            return None
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Ошибка при загрузке сертификата в NPM: {e}")
+            if hasattr(e.response, 'text'):
+                self.logger.error(f"Ответ сервера: {e.response.text}")
+            return None
+    
+    def update_certificate(self, cert_id: int, cert_path: str, key_path: str,
+                          chain_path: Optional[str] = None) -> bool:
+        """
+        Обновление существующего сертификата
+        
+        Args:
+            cert_id: ID сертификата в NPM
+            cert_path: Путь к файлу сертификата
+            key_path: Путь к приватному ключу
+            chain_path: Путь к цепочке сертификатов (опционально)
+            
+        Returns:
+            True если успешно
+        """
+        url = f"{self.host}/api/nginx/certificates/{cert_id}"
+        
+        try:
+            # Читаем приватный ключ
+            with open(key_path, 'r') as f:
+                certificate_key = f.read()
+            
+            # Определяем, какие файлы использовать
+            cert_dir = os.path.dirname(cert_path)
+            cert_only_path = os.path.join(cert_dir, "cert.pem")
+            chain_only_path = os.path.join(cert_dir, "chain.pem")
+            
+            # Используем cert.pem и chain.pem при обновлении, при отсутствии – fullchain
+            files: Dict[str, Tuple[str, str, str]]
+            if os.path.exists(cert_only_path) and os.path.exists(chain_only_path):
+                self.logger.info("Обновление: используем cert.pem и chain.pem")
+                with open(cert_only_path, 'rb') as f:
+                    certificate = f.read().decode('utf-8')
+                with open(chain_only_path, 'rb') as f:
+                    intermediate_certificate = f.read().decode('utf-8')
+                self.logger.debug(f"Загружено: cert.pem ({len(certificate)} байт), chain.pem ({len(intermediate_certificate)} байт)")
+                files = {
+                    'certificate': ('cert.pem', certificate, 'application/x-pem-file'),
+                    'certificate_key': ('privkey.pem', certificate_key, 'application/x-pem-file'),
+                    'intermediate_certificate': ('chain.pem', intermediate_certificate, 'application/x-pem-file'),
+                }
+            else:
+                self.logger.info("Обновление: cert/chain не найдены, используем fullchain.pem")
+                with open(cert_path, 'rb') as f:
+                    certificate = f.read().decode('utf-8')
+                self.logger.debug(f"Загружено: fullchain.pem ({len(certificate)} байт)")
+                files = {
+                    'certificate': ('fullchain.pem', certificate, 'application/x-pem-file'),
+                    'certificate_key': ('privkey.pem', certificate_key, 'application/x-pem-file'),
+                }
+            
+            # Дополнительные поля формы
+            data = {
+                'provider': 'other',  # other для custom сертификатов
+            }
+            
+            self.logger.info(f"Обновление сертификата ID {cert_id} в NPM...")
+            response = self._request("PUT", url, files=files, data=data, timeout=30)
+            
+            self.logger.info("Сертификат успешно обновлен в NPM")
+            try:
+                updated = response.json()
+            except ValueError:
+                updated = None
+            if self.index is not None and isinstance(updated, dict):
+                self.index.add(dict(self.index.get(cert_id) or {}, **updated))
+            # Дождаться, пока NPM обновит метаданные
+            try:
+                parsed = self.wait_for_certificate_parse(cert_id, cert_path, initial=updated)
+                if parsed:
+                    self.logger.info(
+                        f"Итоговые данные NPM после обновления: домены={parsed.get('domain_names', [])}, истекает={parsed.get('expires_on')}"
+                    )
+                    if self.index is not None:
+                        self.index.add(parsed)
+            except Exception as e:
+                self.logger.warning(f"Не удалось дождаться обновления метаданных сертификата: {e}")
+            return True
+            
+        except FileNotFoundError as e:
+            self.logger.error(f"Файл сертификата не найден: {e}")
+            return False
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Ошибка при обновлении сертификата в NPM: {e}")
+            if hasattr(e.response, 'text'):
+                self.logger.error(f"Ответ сервера: {e.response.text}")
+            return False
+    
+    def delete_certificate(self, cert_id: int) -> bool:
+        """
+        Удаление сертификата из NPM
+        
+        Args:
+            cert_id: ID сертификата в NPM
+            
+        Returns:
+            True если успешно
+        """
+        url = f"{self.host}/api/nginx/certificates/{cert_id}"
+        
+        try:
+            self.logger.info(f"Удаление сертификата ID {cert_id} из NPM...")
+            self._request("DELETE", url, timeout=10)
+            if self.index is not None:
+                self.index.remove(cert_id)
+            
+            self.logger.info(f"✅ Сертификат ID {cert_id} успешно удален из NPM")
+            return True
+            
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"Ошибка при удалении сертификата: {e}")
+            if hasattr(e.response, 'text'):
+                self.logger.error(f"Ответ сервера: {e.response.text}")
+            return False
+    
+    @staticmethod
+    def certificate_matches(cert: Dict, fingerprint: str, last_upload: Optional[Dict] = None) -> bool:
+        """
+        Совпадает ли сертификат в NPM с локальным
+        
+        Сравнивается отпечаток SHA-256 сертификата из meta.certificate ответа
+        NPM (он однозначно определяет и серийный номер). Если NPM не вернул
+        сертификат - отпечаток и ID последней успешной загрузки.
+        
+        Args:
+            cert: Данные сертификата из NPM
+            fingerprint: Отпечаток SHA-256 локального сертификата
+            last_upload: Последняя загрузка (npm_fingerprint, npm_certificate_id)
+            
+        Returns:
+            True если загрузка не нужна
+        """
+        pem = (cert.get("meta") or {}).get("certificate")
+        if pem:
+            return CertificateState.pem_fingerprint(pem) == fingerprint
+        return bool(last_upload) and last_upload.get("npm_fingerprint") == fingerprint \
+            and last_upload.get("npm_certificate_id") == cert.get("id")
+    
+    def sync_certificate(self, domain: str, cert_dir: str,
+                         last_upload: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        Синхронизация сертификата с NPM (создание или обновление)
+        
+        Сертификат загружается, только если в NPM его нет или он отличается
+        от локального (см. certificate_matches).
+        
+        Args:
+            domain: Доменное имя
+            cert_dir: Директория с сертификатами Let's Encrypt
+            last_upload: Сведения о последней загрузке (из CertificateState)
+            
+        Returns:
+            Данные сертификата в NPM (существующего совпадающего, обновлённого
+            или созданного) или None, если файлы сертификата не найдены,
+            авторизация в NPM не удалась или загрузка завершилась ошибкой
+        """
+        # Пути к файлам сертификата
+        cert_path = os.path.join(cert_dir, "cert.pem")
+        key_path = os.path.join(cert_dir, "privkey.pem")
+        chain_path = os.path.join(cert_dir, "chain.pem")
+        fullchain_path = os.path.join(cert_dir, "fullchain.pem")
+        
+        # Проверяем наличие файлов
+        if not os.path.exists(cert_path) or not os.path.exists(key_path):
+            self.logger.error(f"Файлы сертификата не найдены в {cert_dir}")
+            return None
+        
+        # Авторизуемся в NPM
+        if not self.login():
+            return None
+        
+        # Проверяем, существует ли уже сертификат для этого домена
+        existing_cert = self.find_certificate_by_domain(domain)
+        fingerprint = CertificateState.fingerprint(cert_path)
+        if existing_cert and fingerprint and self.certificate_matches(existing_cert, fingerprint, last_upload):
+            self.logger.info(f"Сертификат в NPM (ID: {existing_cert.get('id')}) совпадает с локальным "
+                             f"(SHA-256 {fingerprint[:16]}...), загрузка не требуется")
+            return existing_cert
+        
+        # Используем fullchain если доступен, иначе cert + chain
+        if os.path.exists(fullchain_path):
+            final_cert_path = fullchain_path
+            final_chain_path = None
+        else:
+            final_cert_path = cert_path
+            final_chain_path = chain_path if os.path.exists(chain_path) else None
+        
+        if existing_cert:
+            # Обновляем существующий сертификат
+            cert_id = existing_cert.get("id")
+            self.logger.info(f"Обновление существующего сертификата (ID: {cert_id}): содержимое отличается")
+            if not self.update_certificate(cert_id, final_cert_path, key_path, final_chain_path):
+                return None
+            return (self.index.get(cert_id) if self.index else None) or existing_cert
+        else:
+            # Создаем новый сертификат
+            self.logger.info("Создание нового сертификата в NPM")
+            return self.upload_certificate(domain, final_cert_path, key_path, final_chain_path)
+
+
+# ==============================================================================
+# КЛАСС ДЛЯ ГЕНЕРАЦИИ ТЕСТОВЫХ СЕРТИФИКАТОВ
+# ==============================================================================
+
+class TestCertificateGenerator:
+    """Класс для генерации самоподписанных тестовых SSL сертификатов"""
+    
+    def __init__(self, logger: logging.Logger):
+        """
+        Инициализация генератора тестовых сертификатов
+        
+        Args:
+            logger: Logger объект
+        """
+        self.logger = logger
+    
+    def generate_self_signed_certificate(
+        self,
+        domain: str,
+        wildcard: bool = False,
+        output_dir: str = "/etc/letsencrypt/live",
+        validity_days: int = 90
+    ) -> bool:
+        """
+        Генерация самоподписанного SSL сертификата для тестирования
+        
+        Args:
+            domain: Основной домен
+            wildcard: Создать wildcard сертификат
+            output_dir: Директория для сохранения сертификата
+            validity_days: Срок действия сертификата в днях (по умолчанию 90)
+            
+        Returns:
+            True если сертификат создан успешно, False в противном случае
+        """
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.backends import default_backend
+        
+        try:
+            self.logger.info("=" * 80)
+            self.logger.info("ГЕНЕРАЦИЯ ТЕСТОВОГО САМОПОДПИСАННОГО СЕРТИФИКАТА")
+            self.logger.info("=" * 80)
+            self.logger.info(f"Домен: {domain}")
+            self.logger.info(f"Wildcard: {wildcard}")
+            self.logger.info(f"Срок действия: {validity_days} дней")
+            self.logger.info("⚠️  ВНИМАНИЕ: Это тестовый сертификат, не для production!")
+            
+            # Создаем директорию для сертификата
+            cert_dir = os.path.join(output_dir, domain)
+            os.makedirs(cert_dir, exist_ok=True)
+            self.logger.info(f"Директория: {cert_dir}")
+            
+            # Генерируем приватный ключ
+            self.logger.info("Генерация приватного ключа RSA 2048 бит...")
+            private_key = rsa.generate_private_key(
+                public_exponent=65537,
+                key_size=2048,
+                backend=default_backend()
+            )
+            
+            # Сохраняем приватный ключ
+            key_path = os.path.join(cert_dir, "privkey.pem")
+            with open(key_path, "wb") as f:
+                f.write(private_key.private_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PrivateFormat.TraditionalOpenSSL,
+                    encryption_algorithm=serialization.NoEncryption()
+                ))
+            os.chmod(key_path, 0o600)
+            self.logger.info(f"✓ Приватный ключ сохранен: {key_path}")
+            
+            # Подготовка данных для сертификата
+            subject = issuer = x509.Name([
+                x509.NameAttribute(NameOID.COUNTRY_NAME, "RU"),
+                x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "Moscow"),
+                x509.NameAttribute(NameOID.LOCALITY_NAME, "Moscow"),
+                x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Test Certificate"),
+                x509.NameAttribute(NameOID.COMMON_NAME, domain),
+            ])
+            
+            # Создаем список альтернативных имен (SAN)
+            san_list = [x509.DNSName(domain)]
+            if wildcard:
+                san_list.append(x509.DNSName(f"*.{domain}"))
+            
+            # Генерируем сертификат
+            self.logger.info("Генерация самоподписанного сертификата...")
+            cert = (
+                x509.CertificateBuilder()
+                .subject_name(subject)
+                .issuer_name(issuer)
+                .public_key(private_key.public_key())
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(datetime.utcnow())
+                .not_valid_after(datetime.utcnow() + timedelta(days=validity_days))
+                .add_extension(
+                    x509.SubjectAlternativeName(san_list),
+                    critical=False,
+                )
+                .add_extension(
+                    x509.BasicConstraints(ca=False, path_length=None),
+                    critical=True,
+                )
+                .add_extension(
+                    x509.KeyUsage(
+                        digital_signature=True,
+                        key_encipherment=True,
+                        content_commitment=False,
+                        data_encipherment=False,
+                        key_agreement=False,
+                        key_cert_sign=False,
+                        crl_sign=False,
+                        encipher_only=False,
+                        decipher_only=False,
+                    ),
+                    critical=True,
+                )
+                .add_extension(
+                    x509.ExtendedKeyUsage([
+                        x509.oid.ExtendedKeyUsageOID.SERVER_AUTH,
+                        x509.oid.ExtendedKeyUsageOID.CLIENT_AUTH,
+                    ]),
+                    critical=False,
+                )
+                .sign(private_key, hashes.SHA256(), default_backend())
+            )
+            
+            # Сохраняем сертификат
+            cert_path = os.path.join(cert_dir, "cert.pem")
+            with open(cert_path, "wb") as f:
+                f.write(cert.public_bytes(serialization.Encoding.PEM))
+            self.logger.info(f"✓ Сертификат сохранен: {cert_path}")
+            
+            # Создаем fullchain (для самоподписанного это просто копия cert)
+            fullchain_path = os.path.join(cert_dir, "fullchain.pem")
+            with open(fullchain_path, "wb") as f:
+                f.write(cert.public_bytes(serialization.Encoding.PEM))
+            self.logger.info(f"✓ Fullchain сохранен: {fullchain_path}")
+            
+            # Создаем chain.pem (пустой для самоподписанного)
+            chain_path = os.path.join(cert_dir, "chain.pem")
+            with open(chain_path, "w") as f:
+                f.write("")
+            self.logger.info(f"✓ Chain файл создан: {chain_path}")
+            
+            # Выводим информацию о сертификате
+            self.logger.info("")
+            self.logger.info("=" * 80)
+            self.logger.info("ИНФОРМАЦИЯ О СЕРТИФИКАТЕ")
+            self.logger.info("=" * 80)
+            self.logger.info(f"Домен: {domain}")
+            if wildcard:
+                self.logger.info(f"Wildcard: *.{domain}")
+            self.logger.info(f"Действителен с: {cert.not_valid_before}")
+            self.logger.info(f"Действителен до: {cert.not_valid_after}")
+            self.logger.info(f"Серийный номер: {cert.serial_number}")
+            self.logger.info("")
+            self.logger.info("📁 Файлы сертификата:")
+            self.logger.info(f"  • Приватный ключ: {key_path}")
+            self.logger.info(f"  • Сертификат: {cert_path}")
+            self.logger.info(f"  • Fullchain: {fullchain_path}")
+            self.logger.info(f"  • Chain: {chain_path}")
+            self.logger.info("")
+            self.logger.info("⚠️  ВНИМАНИЕ:")
+            self.logger.info("  Это самоподписанный тестовый сертификат!")
+            self.logger.info("  Браузеры будут показывать предупреждение о безопасности.")
+            self.logger.info("  Используйте ТОЛЬКО для тестирования и разработки!")
+            self.logger.info("  Для production используйте настоящие Let's Encrypt сертификаты.")
+            self.logger.info("=" * 80)
+            
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"Ошибка при генерации тестового сертификата: {e}")
+            import traceback
+            self.logger.error(traceback.format_exc())
+            return False
+
+
+class CertificateState:
+    """
+    Сведения о сертификатах между запусками (JSON, по доменам)
+    
+    Для домена хранятся отпечаток SHA-256 текущего cert.pem, срок его
+    действия и отпечаток сертификата, последним загруженного в NPM.
+    По ним --auto решает, есть ли работа, без разбора сертификата и без сети.
+    """
+    
+    def __init__(self, path: str, logger: logging.Logger):
+        """
+        Инициализация
+        
+        Args:
+            path: Путь к файлу состояния
+            logger: Logger объект
+        """
+        self.path = path
+        self.logger = logger
+    
+    @staticmethod
+    def pem_fingerprint(pem: str) -> Optional[str]:
+        """
+        Отпечаток SHA-256 первого сертификата в тексте PEM (DER)
+        
+        Args:
+            pem: Сертификат или цепочка в формате PEM
+            
+        Returns:
+            Отпечаток (hex) или None, если сертификат не найден
+        """
+        try:
+            begin = pem.index("-----BEGIN CERTIFICATE-----") + len("-----BEGIN CERTIFICATE-----")
+            der = base64.b64decode("".join(pem[begin:pem.index("-----END CERTIFICATE-----", begin)].split()))
+        except ValueError:
+            return None
+        return hashlib.sha256(der).hexdigest()
+    
+    @classmethod
+    def fingerprint(cls, cert_path: str) -> Optional[str]:
+        """
+        Отпечаток SHA-256 первого сертификата PEM файла (DER)
+        
+        Args:
+            cert_path: Путь к cert.pem или fullchain.pem
+            
+        Returns:
+            Отпечаток (hex) или None, если файл не найден или повреждён
+        """
+        try:
+            with open(cert_path, 'r', encoding='ascii') as f:
+                return cls.pem_fingerprint(f.read())
+        except (OSError, ValueError):
+            return None
+    
+    def get(self, domain: str) -> Dict:
+        """
+        Сведения о сертификате домена
+        
+        Args:
+            domain: Доменное имя
+            
+        Returns:
+            Словарь (fingerprint, not_after, npm_fingerprint) или пустой словарь
+        """
+        return read_json_file(self.path, {}).get(domain, {})
+    
+    def update(self, domain: str, **fields):
+        """
+        Обновление сведений о сертификате домена
+        
+        Args:
+            domain: Доменное имя
+            **fields: Поля для записи
+        """
+        try:
+            data = read_json_file(self.path, {})
+            data.setdefault(domain, {}).update(fields)
+            write_json_file(self.path, data)
+        except OSError as e:
+            self.logger.debug(f"Не удалось сохранить состояние сертификата {self.path}: {e}")
+    
+    def mark_synced(self, domain: str, cert_path: str, cert_id: Optional[int] = None):
+        """
+        Отметка о загрузке сертификата в NPM
+        
+        Args:
+            domain: Доменное имя
+            cert_path: Загруженный сертификат (cert.pem или fullchain.pem)
+            cert_id: ID сертификата в NPM
+        """
+        fingerprint = self.fingerprint(cert_path)
+        if fingerprint:
+            self.update(domain, npm_fingerprint=fingerprint, npm_certificate_id=cert_id,
+                        npm_synced=time.time())
+
+
+# Переменная окружения с идентификатором запуска certbot (передаётся в hooks)
+RUN_ID_ENV = "LETSENCRYPT_REGRU_RUN_ID"
+
+
+class ChallengeRunState:
+    """
+    Состояние одного запуска certbot, общее для всех вызовов auth hook
+    
+    Хранит опубликованные в этом запуске TXT записи и серийные номера SOA
+    до первой публикации, чтобы проверить все записи одним ожиданием
+    на последнем challenge.
+    """
+    
+    # Состояние старше этого времени считается оставшимся от прерванного запуска
+    STALE_AFTER = 3600
+    
+    def __init__(self, state_dir: str, run_id: str, logger: logging.Logger):
+        """
+        Инициализация состояния запуска
+        
+        Args:
+            state_dir: Директория для файлов состояния
+            run_id: Идентификатор запуска certbot
+            logger: Logger объект
+        """
+        self.path = os.path.join(state_dir, f"run-{run_id}.json")
+        self.logger = logger
+    
+    @staticmethod
+    def current_run_id(env: Optional[Dict[str, str]] = None) -> str:
+        """
+        Идентификатор текущего запуска certbot
+        
+        Берётся из LETSENCRYPT_REGRU_RUN_ID (устанавливается obtain/renew),
+        иначе вычисляется из CERTBOT_ALL_DOMAINS. Такой идентификатор
+        совпадает у повторных запусков с теми же доменами: состояние
+        прерванного запуска отбрасывает load() по счётчику challenge.
+        
+        Args:
+            env: Переменные окружения hook (по умолчанию os.environ)
+            
+        Returns:
+            Идентификатор запуска
+        """
+        env = os.environ if env is None else env
+        run_id = env.get(RUN_ID_ENV)
+        if run_id:
+            return run_id
+        all_domains = env.get("CERTBOT_ALL_DOMAINS", "")
+        return hashlib.sha1(all_domains.encode("utf-8")).hexdigest()[:16]
+    
+    def load(self, remaining: Optional[int] = None) -> Dict:
+        """
+        Загрузка состояния запуска
+        
+        Certbot уменьшает CERTBOT_REMAINING_CHALLENGES на каждом challenge
+        запуска. Если сохранённый счётчик не больше текущего, состояние
+        осталось от прерванного запуска с тем же идентификатором, и его
+        записи к текущему запуску не относятся.
+        
+        Args:
+            remaining: Значение CERTBOT_REMAINING_CHALLENGES текущего challenge
+            
+        Returns:
+            Словарь с полями created, baseline, records, remaining
+        """
+        data = read_json_file(self.path)
+        stale = not data or time.time() - data.get("created", 0) > self.STALE_AFTER
+        if data and not stale and remaining is not None and data.get("remaining") is not None:
+            stale = data["remaining"] <= remaining
+            if stale:
+                self.logger.info(f"Состояние прерванного запуска certbot отброшено "
+                                 f"({len(data.get('records', []))} записей)")
+        if stale:
+            return {"created": time.time(), "baseline": {}, "records": []}
+        return data
+    
+    def save(self, data: Dict):
+        """
+        Сохранение состояния запуска
+        
+        Args:
+            data: Состояние (см. load)
+        """
+        write_json_file(self.path, data)
+    
+    def clear(self):
+        """Удаление файла состояния после завершения запуска"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.debug(f"Не удалось удалить {self.path}: {e}")
+    
+    @classmethod
+    def live_values(cls, state_dir: str) -> set:
+        """
+        Значения TXT записей незавершённых запусков certbot
+        
+        Args:
+            state_dir: Директория для файлов состояния
+            
+        Returns:
+            Множество значений TXT записей
+        """
+        values = set()
+        try:
+            names = os.listdir(state_dir)
+        except OSError:
+            return values
+        for name in names:
+            if not (name.startswith("run-") and name.endswith(".json")):
+                continue
+            data = read_json_file(os.path.join(state_dir, name))
+            if data and time.time() - data.get("created", 0) <= cls.STALE_AFTER:
+                values.update(record["value"] for record in data.get("records", []))
+        return values
+
+
+class CleanupQueue:
+    """
+    Очередь отложенного удаления TXT записей challenge (JSONL)
+    
+    Cleanup hook только добавляет в очередь тройку (domain, subdomain, value)
+    и сразу возвращает управление certbot. Очередь забирается целиком
+    и удаляется одним пакетным запросом к API.
+    """
+    
+    def __init__(self, path: str, logger: logging.Logger):
+        """
+        Инициализация
+        
+        Args:
+            path: Путь к файлу очереди
+            logger: Logger объект
+        """
+        self.path = path
+        self.logger = logger
+    
+    def put(self, domain: str, subdomain: str, value: str, backend: str = "regru"):
+        """
+        Добавление записи в очередь на удаление
+        
+        Args:
+            domain: Основной домен
+            subdomain: Поддомен
+            value: Значение TXT записи
+            backend: Бэкенд, в котором опубликована запись
+        """
+        append_json_line(self.path, {"domain": domain, "subdomain": subdomain, "value": value,
+                                     "backend": backend, "queued": time.time()})
+    
+    def take(self) -> List[Dict]:
+        """
+        Забор всех записей из очереди
+        
+        Returns:
+            Записи очереди (без повторов)
+        """
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return []
+        with os.fdopen(fd, 'r', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            entries = read_json_lines(self.path)
+            os.remove(self.path)
+        
+        unique: Dict[Tuple[str, str, str], Dict] = {}
+        for entry in entries:
+            unique.setdefault((entry["domain"], entry["subdomain"], entry["value"]), entry)
+        return list(unique.values())
+
+
+class PropagationHistory:
+    """
+    История задержек распространения DNS (JSONL)
+    
+    Для каждой зоны и авторитетного сервера хранится время от публикации
+    записи до её появления на сервере. По перцентилю этих замеров
+    вычисляется предел ожидания распространения.
+    """
+    
+    # Минимум замеров зоны, после которого история используется
+    MIN_SAMPLES = 5
+    
+    # Нижняя оценка размера строки замера: до 2 * max_samples * LINE_BYTES
+    # байт файл не перечитывается для проверки сжатия
+    LINE_BYTES = 64
+    
+    def __init__(self, path: str, max_samples: int, logger: logging.Logger):
+        """
+        Инициализация
+        
+        Args:
+            path: Путь к файлу истории
+            max_samples: Сколько последних замеров хранить на зону
+            logger: Logger объект
+        """
+        self.path = path
+        self.max_samples = max_samples
+        self.logger = logger
+        # Размер файла, начиная с которого проверяется необходимость сжатия
+        self._compact_at = 2 * max_samples * self.LINE_BYTES
+    
+    def record(self, zone: str, latencies: Dict[str, float]):
+        """
+        Сохранение замеров одной проверки
+        
+        Args:
+            zone: Имя зоны
+            latencies: {сервер: задержка в секундах}
+        """
+        if self.max_samples <= 0 or not latencies:
+            return
+        try:
+            for server, latency in latencies.items():
+                append_json_line(self.path, {"zone": zone, "server": server,
+                                             "latency": round(latency, 3), "time": time.time()})
+            if os.path.getsize(self.path) >= self._compact_at:
+                self._compact()
+        except OSError as e:
+            self.logger.debug(f"Не удалось сохранить историю задержек DNS: {e}")
+    
+    def samples(self, zone: str) -> List[float]:
+        """
+        Последние замеры зоны
+        
+        Args:
+            zone: Имя зоны
+            
+        Returns:
+            Задержки в секундах (не более max_samples)
+        """
+        latencies = [entry["latency"] for entry in read_json_lines(self.path) if entry.get("zone") == zone]
+        return latencies[-self.max_samples:] if self.max_samples > 0 else []
+    
+    @staticmethod
+    def percentile(values: List[float], q: float) -> float:
+        """
+        Перцентиль (метод ближайшего ранга)
+        
+        Args:
+            values: Значения
+            q: Перцентиль (0-100)
+            
+        Returns:
+            Значение перцентиля
+        """
+        ordered = sorted(values)
+        rank = max(1, int(-(-q * len(ordered) // 100)))
+        return ordered[min(rank, len(ordered)) - 1]
+    
+    def _compact(self):
+        """
+        Удаление старых замеров, когда файл вырос вдвое сверх лимита
+        
+        Файл перечитывается под блокировкой append_json_line, поэтому
+        замеры, добавленные другими процессами, не теряются. Следующая
+        проверка назначается по размеру файла пропорционально запасу
+        до лимита.
+        """
+        with lock_json_lines(self.path):
+            entries = read_json_lines(self.path)
+            size = os.path.getsize(self.path)
+            per_zone: Dict[str, List[Dict]] = {}
+            for entry in entries:
+                per_zone.setdefault(entry.get("zone"), []).append(entry)
+            limit = 2 * self.max_samples * max(1, len(per_zone))
+            if len(entries) <= limit:
+                self._compact_at = size * limit // max(1, len(entries)) + 1
+                return
+            kept = [entry for zone_entries in per_zone.values() for entry in zone_entries[-self.max_samples:]]
+            kept.sort(key=lambda entry: entry.get("time", 0))
+            rewrite_json_lines(self.path, kept)
+            self._compact_at = max(2 * self.max_samples * self.LINE_BYTES, 2 * os.path.getsize(self.path))
+
+
 # ==============================================================================
-# КЛАСС ДЛЯ ГЕНЕРАЦИИ ТЕСТОВЫХ СЕРТИФИКАТОВ
+# КЛАСС ДЛЯ РАБОТЫ С CERTBOT
 # ==============================================================================
 
-class TestCertificateGenerator:
-    """Класс для генерации самоподписанных тестовых SSL сертификатов"""
+class LetsEncryptManager:
+    """Класс для управления сертификатами Let's Encrypt"""
+    
+    def __init__(self, config: Dict, api: RegRuAPI, logger: logging.Logger):
+        """
+        Инициализация менеджера сертификатов
+        
+        Args:
+            config: Конфигурация
+            api: API клиент reg.ru
+            logger: Logger объект
+        """
+        self.config = config
+        self.api = api
+        self.logger = logger
+        self.domain = config["domain"]
+        self.email = config["email"]
+        self.cert_dir = os.path.join(config["cert_dir"], self.domain)
+        self.resolver = DNSResolver(
+            config.get("dns_nameservers") or None,
+            config.get("dns_query_timeout", 3),
+            logger
+        )
+        # Авторитетные серверы зон и серийные номера SOA до публикации записей
+        self._authoritative_servers: Dict[str, Dict[str, List[str]]] = {}
+        self._soa_baseline: Dict[str, Dict[str, Optional[int]]] = {}
+        # TTL отрицательного кэширования зон и TTL записей, полученные от авторитетных серверов
+        self._negative_ttl: Dict[str, Optional[int]] = {}
+        self._record_ttl: Dict[str, int] = {}
+        self.history = PropagationHistory(
+            os.path.join(config.get("state_dir", "/var/lib/letsencrypt-regru"), "propagation-history.jsonl"),
+            config.get("dns_latency_history_size", 200),
+            logger
+        )
+        # Бэкенды зон валидации и делегирование _acme-challenge по доменам
+        self._backends: Dict[str, ChallengeBackend] = {}
+        self._delegations: Dict[str, Optional[Dict]] = {}
+        # Зоны reg.ru доменов сертификата: (зона, поддомен TXT записи)
+        self._zones: Dict[str, Tuple[str, str]] = {}
+        self.cert_state = default_certificate_state(config, logger)
+    
+    def check_certbot_installed(self) -> bool:
+        """
+        Проверка установки certbot
+        
+        Returns:
+            True если certbot установлен
+        """
+        try:
+            result = subprocess.run(
+                ["certbot", "--version"],
+                capture_output=True,
+                text=True,
+                check=True
+            )
+            self.logger.debug(f"Certbot установлен: {result.stdout.strip()}")
+            return True
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            self.logger.error("Certbot не установлен!")
+            return False
+    
+    def check_certbot_running(self) -> bool:
+        """
+        Проверка наличия запущенных процессов certbot
+        
+        Returns:
+            True если процесс certbot запущен
+        """
+        try:
+            # Проверяем через ps
+            result = subprocess.run(
+                ["ps", "aux"],
+                capture_output=True,
+                text=True
+            )
+            
+            # Ищем процессы certbot (исключая текущий grep)
+            certbot_processes = [
+                line for line in result.stdout.split('\n')
+                if 'certbot' in line.lower() and 'grep' not in line.lower()
+                and str(os.getpid()) not in line  # Исключаем текущий процесс
+            ]
+            
+            if certbot_processes:
+                self.logger.warning("Обнаружены запущенные процессы Certbot:")
+                for proc in certbot_processes:
+                    self.logger.warning(f"  {proc}")
+                return True
+            
+            return False
+            
+        except Exception as e:
+            self.logger.debug(f"Не удалось проверить запущенные процессы: {e}")
+            return False
+    
+    def cleanup_certbot_locks(self) -> bool:
+        """
+        Очистка lock-файлов certbot
+        
+        Returns:
+            True если lock-файлы были удалены или их не было
+        """
+        lock_files = [
+            "/var/lib/letsencrypt/.certbot.lock",
+            "/etc/letsencrypt/.certbot.lock",
+        ]
+        
+        removed = False
+        for lock_file in lock_files:
+            if os.path.exists(lock_file):
+                try:
+                    os.remove(lock_file)
+                    self.logger.info(f"Удалён lock-файл: {lock_file}")
+                    removed = True
+                except Exception as e:
+                    self.logger.warning(f"Не удалось удалить lock-файл {lock_file}: {e}")
+        
+        if not removed:
+            self.logger.debug("Lock-файлы certbot не найдены")
+        
+        return True
     
-    def __init__(self, logger: logging.Logger):
+    def wait_for_certbot(self, timeout: int = 300) -> bool:
         """
-        Инициализация генератора тестовых сертификатов
+        Ожидание завершения работы других процессов certbot
         
         Args:
-            logger: Logger объект
+            timeout: Максимальное время ожидания в секундах
+            
+        Returns:
+            True если certbot больше не запущен
         """
-        self.logger = logger
+        self.logger.info("Ожидание завершения других процессов Certbot...")
+        
+        start_time = time.time()
+        check_interval = 5  # Проверяем каждые 5 секунд
+        
+        while time.time() - start_time < timeout:
+            if not self.check_certbot_running():
+                self.logger.info("Другие процессы Certbot завершены")
+                return True
+            
+            elapsed = int(time.time() - start_time)
+            self.logger.info(f"Ожидание... ({elapsed}/{timeout} секунд)")
+            time.sleep(check_interval)
+        
+        self.logger.error(f"Превышено время ожидания ({timeout} секунд)")
+        return False
     
-    def generate_self_signed_certificate(
-        self,
-        domain: str,
-        wildcard: bool = False,
-        output_dir: str = "/etc/letsencrypt/live",
-        validity_days: int = 90
-    ) -> bool:
+    def is_staging_certificate(self) -> bool:
         """
-        Генерация самоподписанного SSL сертификата для тестирования
+        Проверка, является ли сертификат staging (тестовым)
         
-        Args:
-            domain: Основной домен
-            wildcard: Создать wildcard сертификат
-            output_dir: Директория для сохранения сертификата
-            validity_days: Срок действия сертификата в днях (по умолчанию 90)
-            
         Returns:
-            True если сертификат создан успешно, False в противном случае
+            True если сертификат staging
         """
+        cert_file = os.path.join(self.cert_dir, "cert.pem")
+        
+        if not os.path.exists(cert_file):
+            return False
+        
         try:
-            self.logger.info("=" * 80)
-            self.logger.info("ГЕНЕРАЦИЯ ТЕСТОВОГО САМОПОДПИСАННОГО СЕРТИФИКАТА")
-            self.logger.info("=" * 80)
-            self.logger.info(f"Домен: {domain}")
-            self.logger.info(f"Wildcard: {wildcard}")
-            self.logger.info(f"Срок действия: {validity_days} дней")
-            self.logger.info("⚠️  ВНИМАНИЕ: Это тестовый сертификат, не для production!")
+            from cryptography import x509
+            from cryptography.hazmat.backends import default_backend
             
-            # Создаем директорию для сертификата
-            cert_dir = os.path.join(output_dir, domain)
-            os.makedirs(cert_dir, exist_ok=True)
-            self.logger.info(f"Директория: {cert_dir}")
+            with open(cert_file, "rb") as f:
+                cert_data = f.read()
+                cert = x509.load_pem_x509_certificate(cert_data, default_backend())
             
-            # Генерируем приватный ключ
-            self.logger.info("Генерация приватного ключа RSA 2048 бит...")
-            private_key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=2048,
-                backend=default_backend()
+            # Проверяем issuer (издателя сертификата)
+            issuer = cert.issuer.rfc4514_string()
+            
+            # Staging сертификаты Let's Encrypt содержат "Fake LE" или "Staging" в issuer
+            is_staging = (
+                "fake" in issuer.lower() or 
+                "staging" in issuer.lower() or
+                "test" in issuer.lower()
             )
             
-            # Сохраняем приватный ключ
-            key_path = os.path.join(cert_dir, "privkey.pem")
-            with open(key_path, "wb") as f:
-                f.write(private_key.private_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PrivateFormat.TraditionalOpenSSL,
-                    encryption_algorithm=serialization.NoEncryption()
-                ))
-            os.chmod(key_path, 0o600)
-            self.logger.info(f"✓ Приватный ключ сохранен: {key_path}")
+            return is_staging
             
-            # Подготовка данных для сертификата
-            subject = issuer = x509.Name([
-                x509.NameAttribute(NameOID.COUNTRY_NAME, "RU"),
-                x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "Moscow"),
-                x509.NameAttribute(NameOID.LOCALITY_NAME, "Moscow"),
-                x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Test Certificate"),
-                x509.NameAttribute(NameOID.COMMON_NAME, domain),
-            ])
+        except Exception as e:
+            self.logger.debug(f"Не удалось проверить тип сертификата: {e}")
+            return False
+    
+    def check_certificate_expiry(self) -> Optional[int]:
+        """
+        Проверка срока действия сертификата
+        
+        Returns:
+            Количество дней до истечения или None если сертификат не найден
+        """
+        cert_file = os.path.join(self.cert_dir, "cert.pem")
+        
+        if not os.path.exists(cert_file):
+            self.logger.info("Сертификат не найден")
+            return None
+        
+        try:
+            from cryptography import x509
+            from cryptography.hazmat.backends import default_backend
+            from cryptography.hazmat.primitives import serialization
+            import warnings
             
-            # Создаем список альтернативных имен (SAN)
-            san_list = [x509.DNSName(domain)]
-            if wildcard:
-                san_list.append(x509.DNSName(f"*.{domain}"))
+            with open(cert_file, "rb") as f:
+                cert_data = f.read()
+                cert = x509.load_pem_x509_certificate(cert_data, default_backend())
             
-            # Генерируем сертификат
-            self.logger.info("Генерация самоподписанного сертификата...")
-            cert = (
-                x509.CertificateBuilder()
-                .subject_name(subject)
-                .issuer_name(issuer)
-                .public_key(private_key.public_key())
-                .serial_number(x509.random_serial_number())
-                .not_valid_before(datetime.utcnow())
-                .not_valid_after(datetime.utcnow() + timedelta(days=validity_days))
-                .add_extension(
-                    x509.SubjectAlternativeName(san_list),
-                    critical=False,
-                )
-                .add_extension(
-                    x509.BasicConstraints(ca=False, path_length=None),
-                    critical=True,
-                )
-                .add_extension(
-                    x509.KeyUsage(
-                        digital_signature=True,
-                        key_encipherment=True,
-                        content_commitment=False,
-                        data_encipherment=False,
-                        key_agreement=False,
-                        key_cert_sign=False,
-                        crl_sign=False,
-                        encipher_only=False,
-                        decipher_only=False,
-                    ),
-                    critical=True,
-                )
-                .add_extension(
-                    x509.ExtendedKeyUsage([
-                        x509.oid.ExtendedKeyUsageOID.SERVER_AUTH,
-                        x509.oid.ExtendedKeyUsageOID.CLIENT_AUTH,
-                    ]),
-                    critical=False,
-                )
-                .sign(private_key, hashes.SHA256(), default_backend())
+            # Используем not_valid_after_utc для избежания предупреждения
+            try:
+                expiry_date = cert.not_valid_after_utc.replace(tzinfo=None)
+            except AttributeError:
+                # Для старых версий cryptography
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    expiry_date = cert.not_valid_after
+            
+            days_left = (expiry_date - datetime.now()).days
+            self.cert_state.update(self.domain, fingerprint=hashlib.sha256(cert.public_bytes(
+                serialization.Encoding.DER)).hexdigest(), not_after=expiry_date.isoformat())
+            
+            self.logger.info(f"Сертификат истекает: {expiry_date.strftime('%d.%m.%Y %H:%M:%S')}")
+            self.logger.info(f"Осталось дней: {days_left}")
+            
+            return days_left
+            
+        except Exception as e:
+            self.logger.error(f"Ошибка при проверке сертификата: {e}")
+            return None
+    
+    def dns_challenge_hook(self, validation_domain: str, validation_token: str,
+                           remaining_challenges: Optional[int] = None,
+                           run_id: Optional[str] = None) -> bool:
+        """
+        Обработчик DNS challenge - добавление TXT записи
+        
+        Пока certbot сообщает о невыполненных challenge (CERTBOT_REMAINING_CHALLENGES > 0),
+        запись только публикуется и запоминается в состоянии запуска. На последнем
+        challenge выполняется одно общее ожидание для всех записей этого запуска.
+        
+        Args:
+            validation_domain: Домен для валидации (например, dfv24.com или *.dfv24.com)
+            validation_token: Токен валидации
+            remaining_challenges: Значение CERTBOT_REMAINING_CHALLENGES (None - ждать сразу)
+            run_id: Идентификатор запуска certbot (по умолчанию из окружения)
+            
+        Returns:
+            True если успешно
+        """
+        try:
+            self.logger.info("=== DNS Challenge: Добавление TXT записи ===")
+            
+            base_domain, subdomain = self.challenge_zone(validation_domain)
+            
+            self.logger.info(f"Validation Domain: {validation_domain}")
+            self.logger.info(f"Base Domain: {base_domain}")
+            self.logger.info(f"Subdomain: {subdomain}")
+            self.logger.info(f"Token: {validation_token[:20]}...")
+            
+            run_state = ChallengeRunState(
+                self.config.get("state_dir", "/var/lib/letsencrypt-regru"),
+                run_id or ChallengeRunState.current_run_id(),
+                self.logger
             )
+            state = run_state.load(remaining_challenges)
             
-            # Сохраняем сертификат
-            cert_path = os.path.join(cert_dir, "cert.pem")
-            with open(cert_path, "wb") as f:
-                f.write(cert.public_bytes(serialization.Encoding.PEM))
-            self.logger.info(f"✓ Сертификат сохранен: {cert_path}")
+            # Серийные номера SOA до первой публикации в этом запуске -
+            # для дешёвой проверки изменения зоны
+            if base_domain in state["baseline"]:
+                self._soa_baseline[base_domain] = state["baseline"][base_domain]
+            else:
+                state["baseline"][base_domain] = self.capture_soa_baseline(base_domain)
             
-            # Создаем fullchain (для самоподписанного это просто копия cert)
-            fullchain_path = os.path.join(cert_dir, "fullchain.pem")
-            with open(fullchain_path, "wb") as f:
-                f.write(cert.public_bytes(serialization.Encoding.PEM))
-            self.logger.info(f"✓ Fullchain сохранен: {fullchain_path}")
+            # Добавляем TXT запись
+            record = self.publish_challenge(validation_domain, validation_token)
+            if not record:
+                return False
             
-            # Создаем chain.pem (пустой для самоподписанного)
-            chain_path = os.path.join(cert_dir, "chain.pem")
-            with open(chain_path, "w") as f:
-                f.write("")
-            self.logger.info(f"✓ Chain файл создан: {chain_path}")
+            state["records"].append(record)
             
-            # Выводим информацию о сертификате
-            self.logger.info("")
-            self.logger.info("=" * 80)
-            self.logger.info("ИНФОРМАЦИЯ О СЕРТИФИКАТЕ")
-            self.logger.info("=" * 80)
-            self.logger.info(f"Домен: {domain}")
-            if wildcard:
-                self.logger.info(f"Wildcard: *.{domain}")
-            self.logger.info(f"Действителен с: {cert.not_valid_before}")
-            self.logger.info(f"Действителен до: {cert.not_valid_after}")
-            self.logger.info(f"Серийный номер: {cert.serial_number}")
+            if remaining_challenges:
+                state["remaining"] = remaining_challenges
+                run_state.save(state)
+                self.logger.info(f"Осталось challenge: {remaining_challenges}. "
+                                 "Проверка распространения DNS - на последнем challenge")
+                return True
+            
+            run_state.clear()
+            
+            # Сразу начинаем опрос DNS: ожидание завершается, как только записи видны
             self.logger.info("")
-            self.logger.info("📁 Файлы сертификата:")
-            self.logger.info(f"  • Приватный ключ: {key_path}")
-            self.logger.info(f"  • Сертификат: {cert_path}")
-            self.logger.info(f"  • Fullchain: {fullchain_path}")
-            self.logger.info(f"  • Chain: {chain_path}")
+            self.logger.info("🔍 Ожидание распространения DNS...")
+            self.logger.info(f"   TXT записей в этом запуске: {len(state['records'])}")
             self.logger.info("")
-            self.logger.info("⚠️  ВНИМАНИЕ:")
-            self.logger.info("  Это самоподписанный тестовый сертификат!")
-            self.logger.info("  Браузеры будут показывать предупреждение о безопасности.")
-            self.logger.info("  Используйте ТОЛЬКО для тестирования и разработки!")
-            self.logger.info("  Для production используйте настоящие Let's Encrypt сертификаты.")
-            self.logger.info("=" * 80)
-            
-            return True
             
+            if self.wait_for_challenges(state["records"]):
+                self.logger.info("✅ DNS записи подтверждены")
+                self.logger.info("   Certbot сможет пройти валидацию")
+                return True
+            else:
+                self.logger.warning("⚠️  DNS запись НЕ обнаружена, но продолжаем...")
+                self.logger.warning("   Возможные причины:")
+                self.logger.warning("   • DNS серверы ещё не обновились (требуется больше времени)")
+                self.logger.warning("   • Let's Encrypt использует свои DNS серверы")
+                self.logger.warning("   • API reg.ru обновляет записи с задержкой")
+                self.logger.warning("")
+                self.logger.warning("   Certbot будет продолжать попытки валидации...")
+                return True
+                
         except Exception as e:
-            self.logger.error(f"Ошибка при генерации тестового сертификата: {e}")
-            import traceback
-            self.logger.error(traceback.format_exc())
+            self.logger.error(f"💥 Ошибка в dns_challenge_hook: {e}")
+            self.logger.exception("Traceback:")
             return False
-
-
-# ==============================================================================
-# КЛАСС ДЛЯ РАБОТЫ С CERTBOT
-# ==============================================================================
-
-class LetsEncryptManager:
-    """Класс для управления сертификатами Let's Encrypt"""
     
-    def __init__(self, config: Dict, api: RegRuAPI, logger: logging.Logger):
+    def challenge_zone(self, validation_domain: str) -> Tuple[str, str]:
         """
-        Инициализация менеджера сертификатов
+        Определение зоны и поддомена TXT записи для DNS-01 challenge
+        
+        Для доменов из challenge_delegation - зона валидации и имя,
+        на которое указывает CNAME _acme-challenge.<домен>. Для остальных -
+        самая длинная зона аккаунта reg.ru, в которую входит имя
+        (api.eu.example.com → зона eu.example.com, поддомен _acme-challenge.api).
         
         Args:
-            config: Конфигурация
-            api: API клиент reg.ru
-            logger: Logger объект
+            validation_domain: Домен для валидации (например, dfv24.com или *.dfv24.com)
+            
+        Returns:
+            Кортеж (зона, поддомен)
         """
-        self.config = config
-        self.api = api
-        self.logger = logger
-        self.domain = config["domain"]
-        self.email = config["email"]
-        self.cert_dir = os.path.join(config["cert_dir"], self.domain)
+        delegation = self._delegation(validation_domain)
+        if delegation:
+            return delegation["zone"], delegation["subdomain"]
+        
+        # Убираем wildcard если есть; для DNS-01 challenge всегда используем _acme-challenge
+        base_domain = validation_domain.replace("*.", "").lower()
+        if base_domain in self._zones:
+            return self._zones[base_domain]
+        
+        name = f"_acme-challenge.{base_domain}"
+        try:
+            self._zones[base_domain] = self.api.resolve_zone(name)
+        except RegRuAPIError as e:
+            # Без списка зон аккаунта - зоны из конфигурации
+            fallback = ZoneIndex(None, 0, self.logger)
+            fallback.update(configured_zones(self.config))
+            match = fallback.lookup(name) or (base_domain, "_acme-challenge")
+            self.logger.warning(f"Зона для {name} не определена по списку зон reg.ru ({e}), "
+                                f"используется {match[0]}")
+            self._zones[base_domain] = match
+        return self._zones[base_domain]
     
-    def check_certbot_installed(self) -> bool:
+    def challenge_backend_name(self, validation_domain: str) -> str:
         """
-        Проверка установки certbot
+        Бэкенд, в котором публикуется TXT запись домена
         
+        Args:
+            validation_domain: Домен для валидации
+            
         Returns:
-            True если certbot установлен
+            Имя бэкенда ("regru" - API reg.ru, зона самого домена)
         """
-        try:
-            result = subprocess.run(
-                ["certbot", "--version"],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            self.logger.debug(f"Certbot установлен: {result.stdout.strip()}")
-            return True
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            self.logger.error("Certbot не установлен!")
-            return False
+        delegation = self._delegation(validation_domain)
+        return delegation["backend"] if delegation else "regru"
     
-    def check_certbot_running(self) -> bool:
+    def challenge_backend(self, name: str) -> ChallengeBackend:
         """
-        Проверка наличия запущенных процессов certbot
+        Бэкенд зоны валидации по имени из challenge_backends
         
+        Args:
+            name: Имя бэкенда
+            
         Returns:
-            True если процесс certbot запущен
+            Бэкенд (создаётся один раз)
+            
+        Raises:
+            ValueError: Если бэкенд не описан или тип неизвестен
         """
-        try:
-            # Проверяем через ps
-            result = subprocess.run(
-                ["ps", "aux"],
-                capture_output=True,
-                text=True
-            )
+        if name in self._backends:
+            return self._backends[name]
+        
+        backends = self.config.get("challenge_backends", {})
+        if name not in backends:
+            if name != "regru":
+                raise ValueError(f"Бэкенд challenge '{name}' не описан в challenge_backends")
+            backend: ChallengeBackend = RegRuChallengeBackend(self.api)
+        else:
+            conf = backends[name]
+            backend_type = conf.get("type", "regru")
+            if backend_type == "regru":
+                backend = RegRuChallengeBackend(self.api, name, conf["zone"], conf.get("nameservers"))
+            elif backend_type == "rfc2136":
+                backend = RFC2136ChallengeBackend(
+                    name, conf["zone"], conf["server"], self.logger,
+                    port=conf.get("port", 53),
+                    key_name=conf.get("key_name"),
+                    key_secret=conf.get("key_secret"),
+                    key_algorithm=conf.get("key_algorithm", "hmac-sha256"),
+                    ttl=conf.get("ttl", self.config.get("challenge_record_ttl", 60)),
+                    timeout=self.config.get("dns_query_timeout", 3),
+                    nameservers=conf.get("nameservers")
+                )
+            elif backend_type == "builtin":
+                # Проверка - на адресе и порту, где слушает --challenge-responder
+                listen = conf.get("listen", "0.0.0.0")
+                local = {"0.0.0.0": "127.0.0.1", "::": "::1", "": "127.0.0.1"}.get(listen, listen)
+                backend = BuiltinChallengeBackend(
+                    name, conf["zone"], conf.get("store") or default_responder_store(self.config),
+                    conf.get("address", local), conf.get("port", 53)
+                )
+            else:
+                raise ValueError(f"Неизвестный тип бэкенда challenge '{name}': {backend_type}")
+        
+        self._backends[name] = backend
+        return backend
+    
+    def _delegation(self, validation_domain: str) -> Optional[Dict]:
+        """
+        Делегирование _acme-challenge домена в зону валидации
+        
+        Args:
+            validation_domain: Домен для валидации
             
-            # Ищем процессы certbot (исключая текущий grep)
-            certbot_processes = [
-                line for line in result.stdout.split('\n')
-                if 'certbot' in line.lower() and 'grep' not in line.lower()
-                and str(os.getpid()) not in line  # Исключаем текущий процесс
-            ]
+        Returns:
+            Словарь (backend, zone, subdomain) или None без делегирования
             
-            if certbot_processes:
-                self.logger.warning("Обнаружены запущенные процессы Certbot:")
-                for proc in certbot_processes:
-                    self.logger.warning(f"  {proc}")
+        Raises:
+            Exception: Если цель CNAME не найдена или не входит в зону бэкенда
+        """
+        base_domain = validation_domain.replace("*.", "")
+        if base_domain in self._delegations:
+            return self._delegations[base_domain]
+        
+        entry = self.config.get("challenge_delegation", {}).get(base_domain)
+        if entry is None:
+            self._delegations[base_domain] = None
+            return None
+        if isinstance(entry, str):
+            entry = {"backend": entry}
+        
+        backend = self.challenge_backend(entry["backend"])
+        target = entry.get("target")
+        if not target:
+            target = self.resolver.query_cname(f"_acme-challenge.{base_domain}")
+            if not target:
+                raise Exception(f"Для _acme-challenge.{base_domain} не найдена CNAME запись "
+                                f"(делегирование в бэкенд {backend.name})")
+        target = target.rstrip(".").lower()
+        if not backend.zone or not target.endswith("." + backend.zone):
+            raise Exception(f"Цель CNAME {target} не входит в зону бэкенда {backend.name} ({backend.zone})")
+        
+        # Проверка распространения - на серверах бэкенда, если они заданы
+        servers = backend.nameservers()
+        if servers:
+            self._authoritative_servers.setdefault(backend.zone, servers)
+        
+        delegation = {
+            "backend": backend.name,
+            "zone": backend.zone,
+            "subdomain": target[:-len(backend.zone) - 1],
+        }
+        self.logger.debug(f"_acme-challenge.{base_domain} делегирован в {target} (бэкенд {backend.name})")
+        self._delegations[base_domain] = delegation
+        return delegation
+    
+    def needs_regru_api(self) -> bool:
+        """
+        Нужен ли API reg.ru для выпуска сертификата
+        
+        Returns:
+            False если все домены сертификата делегированы в бэкенды не на reg.ru
+        """
+        for domain in self.certificate_domains():
+            try:
+                backend = self.challenge_backend(self.challenge_backend_name(domain))
+            except Exception as e:
+                self.logger.debug(f"Не удалось определить бэкенд challenge для {domain}: {e}")
                 return True
+            if isinstance(backend, RegRuChallengeBackend):
+                return True
+        return False
+    
+    def certificate_domains(self) -> List[str]:
+        """
+        Домены сертификата
+        
+        Returns:
+            Список доменов: domain (с wildcard, если включён) и extra_domains
+        """
+        domains = [self.domain]
+        if self.config.get("wildcard", False):
+            domains.append(f"*.{self.domain}")
+        domains.extend(self.config.get("extra_domains", []))
+        return list(dict.fromkeys(domains))
+    
+    def certificate_zones(self) -> List[str]:
+        """
+        Зоны reg.ru, в которых публикуются TXT записи доменов сертификата
+        
+        Returns:
+            Список зон (без зон бэкендов делегирования)
+        """
+        zones = []
+        for domain in self.certificate_domains():
+            if isinstance(self.challenge_backend(self.challenge_backend_name(domain)), RegRuChallengeBackend):
+                zones.append(self.challenge_zone(domain)[0])
+        return list(dict.fromkeys(zones))
+    
+    def _apply_backends(self, records: List[Tuple[str, str, str, str]], publish: bool) -> List[Optional[str]]:
+        """
+        Публикация или удаление TXT записей через их бэкенды (один вызов на бэкенд)
+        
+        Args:
+            records: Записи (бэкенд, зона, поддомен, значение)
+            publish: True - публикация, False - удаление
             
-            return False
+        Returns:
+            Для каждой записи None при успехе или текст ошибки
+        """
+        errors: List[Optional[str]] = [None] * len(records)
+        groups: Dict[str, List[int]] = {}
+        for index, record in enumerate(records):
+            groups.setdefault(record[0], []).append(index)
+        
+        for name, indexes in groups.items():
+            items = [records[index][1:] for index in indexes]
+            try:
+                backend = self.challenge_backend(name)
+                results = backend.publish(items) if publish else backend.unpublish(items)
+            except Exception as e:
+                backend, results = None, [str(e)] * len(items)
+            
+            for index, error in zip(indexes, results):
+                errors[index] = error
+                # Записи reg.ru попадают в журнал через zone/update_records
+                if error is None and self.api.ledger and not isinstance(backend, RegRuChallengeBackend):
+                    _, zone, subdomain, value = records[index]
+                    if publish:
+                        self.api.ledger.record_added(zone, subdomain, value, backend=name)
+                    else:
+                        self.api.ledger.record_removed(value)
+        return errors
+    
+    def publish_challenge(self, validation_domain: str, validation_token: str) -> Optional[Dict]:
+        """
+        Публикация TXT записи challenge без ожидания распространения
+        
+        Args:
+            validation_domain: Домен для валидации
+            validation_token: Значение TXT записи
             
+        Returns:
+            Опубликованная запись (domain, subdomain, value, published, backend) или None
+        """
+        try:
+            return self.publish_challenges([(validation_domain, validation_token)])[0]
         except Exception as e:
-            self.logger.debug(f"Не удалось проверить запущенные процессы: {e}")
-            return False
+            self.logger.error(f"Не удалось добавить TXT запись: {e}")
+            return None
     
-    def cleanup_certbot_locks(self) -> bool:
+    def perform_challenges(self, challenges: List[Tuple[str, str]]) -> List[Dict]:
         """
-        Очистка lock-файлов certbot
+        Публикация набора challenge и одно общее ожидание распространения
         
+        Args:
+            challenges: Список пар (домен для валидации, значение TXT записи)
+            
         Returns:
-            True если lock-файлы были удалены или их не было
+            Опубликованные записи
+            
+        Raises:
+            Exception: Если какую-либо запись не удалось опубликовать
         """
-        lock_files = [
-            "/var/lib/letsencrypt/.certbot.lock",
-            "/etc/letsencrypt/.certbot.lock",
-        ]
+        for validation_domain, _ in challenges:
+            base_domain, _ = self.challenge_zone(validation_domain)
+            if base_domain not in self._soa_baseline:
+                self.capture_soa_baseline(base_domain)
         
-        removed = False
-        for lock_file in lock_files:
-            if os.path.exists(lock_file):
-                try:
-                    os.remove(lock_file)
-                    self.logger.info(f"Удалён lock-файл: {lock_file}")
-                    removed = True
-                except Exception as e:
-                    self.logger.warning(f"Не удалось удалить lock-файл {lock_file}: {e}")
+        records = self.publish_challenges(challenges)
         
-        if not removed:
-            self.logger.debug("Lock-файлы certbot не найдены")
+        if not self.wait_for_challenges(records):
+            self.logger.warning("⚠️  Не все DNS записи обнаружены, продолжаем валидацию...")
+        return records
+    
+    def publish_challenges(self, challenges: List[Tuple[str, str]]) -> List[Dict]:
+        """
+        Публикация нескольких TXT записей (один запрос на бэкенд)
+        
+        Args:
+            challenges: Список пар (домен для валидации, значение TXT записи)
+            
+        Returns:
+            Опубликованные записи (domain, subdomain, value, published, backend)
+            
+        Raises:
+            Exception: Если какую-либо запись не удалось опубликовать
+        """
+        records = []
+        for validation_domain, validation_token in challenges:
+            zone, subdomain = self.challenge_zone(validation_domain)
+            records.append((self.challenge_backend_name(validation_domain), zone, subdomain, validation_token))
+        
+        backends = sorted(set(record[0] for record in records))
+        self.logger.info(f"Добавление {len(records)} TXT записей (бэкенды: {', '.join(backends)})...")
+        errors = self._apply_backends(records, publish=True)
+        published = time.time()
+        
+        failed = 0
+        for (backend, zone, subdomain, _), error in zip(records, errors):
+            if error:
+                failed += 1
+                self.logger.error(f"Не удалось добавить TXT запись {subdomain}.{zone} ({backend}): {error}")
+        if failed:
+            raise Exception(f"Не удалось добавить TXT записи: {failed} из {len(records)}")
+        
+        self.logger.info("✅ TXT записи успешно добавлены")
+        return [{"domain": zone, "subdomain": subdomain, "value": value,
+                 "published": published, "backend": backend}
+                for backend, zone, subdomain, value in records]
+    
+    def cleanup_challenges(self, challenges: List[Tuple[str, str]]) -> bool:
+        """
+        Удаление нескольких TXT записей (один запрос на бэкенд)
+        
+        Args:
+            challenges: Список пар (домен для валидации, значение TXT записи)
+            
+        Returns:
+            True если все записи удалены
+        """
+        records = [self.published_record(validation_domain, validation_token) + (validation_token,)
+                   for validation_domain, validation_token in challenges]
+        
+        if self.cleanup_deferred():
+            queue = self.cleanup_queue()
+            for backend, zone, subdomain, value in records:
+                queue.put(zone, subdomain, value, backend)
+            self.logger.info(f"Удаление {len(records)} TXT записей отложено до завершения certbot")
+            return True
         
+        self.logger.info(f"Удаление {len(records)} TXT записей...")
+        errors = self._apply_backends(records, publish=False)
+        for (backend, zone, subdomain, _), error in zip(records, errors):
+            if error:
+                self.logger.warning(f"Не удалось удалить TXT запись {subdomain}.{zone} ({backend}): {error}")
+        return not any(errors)
+    
+    def wait_for_challenges(self, records: List[Dict]) -> bool:
+        """
+        Одно общее ожидание распространения для нескольких опубликованных записей
+        
+        Args:
+            records: Записи с полями domain, subdomain, value, published (time.time())
+            
+        Returns:
+            True если все записи видны
+        """
+        if not records:
+            return True
+        
+        # Отсчёт задержки - от первой публикации в запуске
+        first_published = min(record["published"] for record in records)
+        published_at = time.monotonic() - max(0.0, time.time() - first_published)
+        
+        groups: Dict[Tuple[str, str], List[str]] = {}
+        for record in records:
+            groups.setdefault((record["domain"], record["subdomain"]), []).append(record["value"])
+        
+        all_visible = True
+        for (domain, subdomain), values in groups.items():
+            if not self.wait_for_txt_values(domain, subdomain, values, published_at):
+                all_visible = False
+        return all_visible
+    
+    def dns_cleanup_hook(self, validation_domain: str, validation_token: str) -> bool:
+        """
+        Обработчик очистки DNS challenge - удаление TXT записи
+        
+        Args:
+            validation_domain: Домен валидации (например, dfv24.com или *.dfv24.com)
+            validation_token: Токен валидации
+            
+        Returns:
+            True если успешно
+        """
+        self.logger.info("=== DNS Challenge: Удаление TXT записи ===")
+        
+        backend, base_domain, subdomain = self.published_record(validation_domain, validation_token)
+        
+        self.logger.info(f"Домен: {base_domain}, Поддомен: {subdomain}, Бэкенд: {backend}")
+        
+        if self.cleanup_deferred():
+            self.cleanup_queue().put(base_domain, subdomain, validation_token, backend)
+            self.logger.info("Удаление TXT записи отложено до завершения certbot")
+            return True
+        
+        error = self._apply_backends([(backend, base_domain, subdomain, validation_token)], publish=False)[0]
+        if error:
+            self.logger.error(f"Не удалось удалить TXT запись: {error}")
+            # Для cleanup hook не критично, если не удалось удалить
+            self.logger.warning("Продолжаем выполнение, несмотря на ошибку удаления")
+        else:
+            self.logger.info("TXT запись успешно удалена")
         return True
     
-    def wait_for_certbot(self, timeout: int = 300) -> bool:
+    def cleanup_deferred(self) -> bool:
+        """Включено ли отложенное удаление TXT записей (dns_cleanup_mode: deferred)"""
+        return self.config.get("dns_cleanup_mode", "immediate") == "deferred"
+    
+    def cleanup_queue(self) -> CleanupQueue:
+        """Очередь отложенного удаления TXT записей"""
+        return CleanupQueue(cleanup_queue_path(self.config), self.logger)
+    
+    def drain_cleanup_queue(self) -> int:
+        """
+        Удаление всех отложенных TXT записей одним запросом к API
+        
+        Записи, которые не удалось удалить, возвращаются в очередь.
+        
+        Returns:
+            Количество удалённых записей
+        """
+        queue = self.cleanup_queue()
+        try:
+            entries = queue.take()
+        except OSError as e:
+            self.logger.warning(f"Не удалось прочитать очередь удаления {queue.path}: {e}")
+            return 0
+        if not entries:
+            return 0
+        
+        self.logger.info(f"Удаление отложенных TXT записей: {len(entries)}")
+        records = [(entry.get("backend", "regru"), entry["domain"], entry["subdomain"], entry["value"])
+                   for entry in entries]
+        errors = self._apply_backends(records, publish=False)
+        
+        removed = 0
+        for (backend, zone, subdomain, value), error in zip(records, errors):
+            if not error:
+                removed += 1
+            else:
+                self.logger.warning(f"Не удалось удалить TXT запись {subdomain}.{zone} ({backend}): "
+                                    f"{error} (останется в очереди)")
+                queue.put(zone, subdomain, value, backend)
+        self.logger.info(f"Отложенные TXT записи удалены: {removed} из {len(entries)}")
+        return removed
+    
+    def published_record(self, validation_domain: str, validation_token: str) -> Tuple[str, str, str]:
+        """
+        Бэкенд, зона и поддомен, в которых была опубликована TXT запись challenge
+        
+        Берутся из журнала challenge по токену валидации; если записи
+        в журнале нет - вычисляются из домена валидации.
+        
+        Args:
+            validation_domain: Домен валидации
+            validation_token: Токен валидации (значение TXT записи)
+            
+        Returns:
+            Кортеж (бэкенд, зона, поддомен)
+        """
+        entry = self.api.ledger.get(validation_token) if self.api.ledger else None
+        if entry:
+            return entry.get("backend", "regru"), entry["domain"], entry["subdomain"]
+        return (self.challenge_backend_name(validation_domain),) + self.challenge_zone(validation_domain)
+    
+    def find_stale_challenges(self, zones: List[str], min_age: float,
+                              include_unknown: bool = False) -> List[Dict]:
+        """
+        Поиск оставшихся TXT записей _acme-challenge в зонах
+        
+        Запись считается оставшейся, если она не относится к незавершённому
+        запуску certbot и опубликована раньше min_age секунд назад. Записей,
+        которых нет в журнале challenge, возраст неизвестен: их могли только
+        что опубликовать другой хост или certbot, поэтому они удаляются
+        только при include_unknown.
+        
+        Args:
+            zones: Зоны для проверки
+            min_age: Минимальный возраст удаляемой записи (секунды)
+            include_unknown: Удалять и записи, которых нет в журнале
+            
+        Returns:
+            Записи (domain, subdomain, value, age) для удаления
+        """
+        state_dir = self.config.get("state_dir", "/var/lib/letsencrypt-regru")
+        live = ChallengeRunState.live_values(state_dir)
+        ledger = {entry["value"]: entry for entry in self.api.ledger.active()} if self.api.ledger else {}
+        now = time.time()
+        
+        stale = []
+        for zone in zones:
+            for record in self.api.get_zone_records(zone, use_cache=False):
+                rectype, subdomain, value = ZoneRecordCache.record_key(record)
+                if rectype != "TXT" or not subdomain.startswith("_acme-challenge"):
+                    continue
+                if value in live:
+                    self.logger.debug(f"Пропуск {subdomain}.{zone}: challenge текущего запуска")
+                    continue
+                entry = ledger.get(value)
+                age = now - entry["time"] if entry else None
+                if age is None and not include_unknown:
+                    self.logger.debug(f"Пропуск {subdomain}.{zone}: нет в журнале, возраст неизвестен")
+                    continue
+                if age is not None and age < min_age:
+                    self.logger.debug(f"Пропуск {subdomain}.{zone}: опубликована {int(age)} сек назад")
+                    continue
+                stale.append({"domain": zone, "subdomain": subdomain, "value": value, "age": age})
+        return stale
+    
+    def gc_challenges(self, zones: List[str], min_age: float, dry_run: bool = False,
+                      batch_size: int = 50, include_unknown: bool = False) -> Tuple[int, int]:
         """
-        Ожидание завершения работы других процессов certbot
+        Удаление оставшихся TXT записей _acme-challenge пакетами
+        
+        Каждый пакет - один запрос zone/update_records; паузы между пакетами
+        задаёт общий ограничитель частоты запросов.
         
         Args:
-            timeout: Максимальное время ожидания в секундах
+            zones: Зоны для проверки
+            min_age: Минимальный возраст удаляемой записи (секунды)
+            dry_run: Только показать записи, не удаляя их
+            batch_size: Операций в одном запросе
+            include_unknown: Удалять и записи, которых нет в журнале
             
         Returns:
-            True если certbot больше не запущен
+            Кортеж (найдено записей, удалено записей)
         """
-        self.logger.info("Ожидание завершения других процессов Certbot...")
+        stale = self.find_stale_challenges(zones, min_age, include_unknown)
+        
+        self.logger.info(f"Оставшихся TXT записей _acme-challenge: {len(stale)}")
+        for record in stale:
+            age = "неизвестен" if record["age"] is None else f"{int(record['age'] // 3600)} ч"
+            self.logger.info(f"  {record['subdomain']}.{record['domain']}  "
+                             f"{record['value'][:20]}...  возраст: {age}")
+        
+        if dry_run or not stale:
+            if dry_run:
+                self.logger.info("Режим --dry-run: записи не удалены")
+            return len(stale), 0
+        
+        removed = 0
+        batch_size = max(1, batch_size)
+        for start in range(0, len(stale), batch_size):
+            batch = self.api.batch()
+            for record in stale[start:start + batch_size]:
+                batch.remove_txt(record["domain"], record["subdomain"], record["value"])
+            for result in batch.submit():
+                if result["success"]:
+                    removed += 1
+                else:
+                    self.logger.warning(f"Не удалось удалить {result['subdomain']}.{result['domain']}: "
+                                        f"{result['error']}")
+        
+        # Записи журнала, которых уже нет в зонах, больше не активны
+        if self.api.ledger:
+            for entry in self.api.ledger.active():
+                if entry["domain"] in zones and not self.api.find_records(
+                        entry["domain"], "TXT", entry["subdomain"], entry["value"]):
+                    self.api.ledger.record_removed(entry["value"])
+        
+        self.logger.info(f"Удалено TXT записей: {removed} из {len(stale)}")
+        return len(stale), removed
+    
+    def get_propagation_timeout(self, zone: Optional[str] = None) -> float:
+        """
+        Максимальное время ожидания распространения DNS
         
-        start_time = time.time()
-        check_interval = 5  # Проверяем каждые 5 секунд
+        Если для зоны накоплена история задержек, предел - перцентиль
+        dns_latency_percentile плюс dns_latency_margin. Значения
+        dns_propagation_wait и dns_check_attempts × dns_check_interval
+        используются только как верхняя граница, а не как фиксированная пауза.
         
-        while time.time() - start_time < timeout:
-            if not self.check_certbot_running():
-                self.logger.info("Другие процессы Certbot завершены")
-                return True
+        Args:
+            zone: Имя зоны (None - без учёта истории)
             
-            elapsed = int(time.time() - start_time)
-            self.logger.info(f"Ожидание... ({elapsed}/{timeout} секунд)")
-            time.sleep(check_interval)
-        
-        self.logger.error(f"Превышено время ожидания ({timeout} секунд)")
-        return False
+        Returns:
+            Время в секундах
+        """
+        wait_time = self.config.get("dns_propagation_wait", 60)
+        attempts = self.config.get("dns_check_attempts", 10)
+        interval = self.config.get("dns_check_interval", 10)
+        cap = float(wait_time + attempts * interval)
+        
+        samples = self.history.samples(zone) if zone else []
+        if len(samples) < PropagationHistory.MIN_SAMPLES:
+            return cap
+        learned = (PropagationHistory.percentile(samples, self.config.get("dns_latency_percentile", 99))
+                   + self.config.get("dns_latency_margin", 10))
+        self.logger.debug(f"Предел ожидания {zone} по истории ({len(samples)} замеров): {learned:.1f} сек "
+                          f"(верхняя граница {int(cap)} сек)")
+        return min(cap, learned)
     
-    def is_staging_certificate(self) -> bool:
+    def _next_poll_delay(self, attempt: int) -> float:
         """
-        Проверка, является ли сертификат staging (тестовым)
+        Интервал до следующей проверки DNS (экспоненциальный рост с джиттером)
         
+        Args:
+            attempt: Номер выполненной попытки (с нуля)
+            
         Returns:
-            True если сертификат staging
+            Задержка в секундах
         """
-        cert_file = os.path.join(self.cert_dir, "cert.pem")
-        
-        if not os.path.exists(cert_file):
-            return False
+        initial = self.config.get("dns_poll_initial_interval", 2)
+        maximum = self.config.get("dns_poll_max_interval", 15)
+        delay = min(maximum, initial * (2 ** attempt))
+        # Джиттер: случайная задержка в диапазоне [delay/2, delay]
+        return random.uniform(delay / 2, delay)
+    
+    def _lookup_txt(self, full_domain: str) -> List[str]:
+        """
+        Запрос значений TXT записи через встроенный DNS клиент
         
-        try:
-            from cryptography import x509
-            from cryptography.hazmat.backends import default_backend
-            
-            with open(cert_file, "rb") as f:
-                cert_data = f.read()
-                cert = x509.load_pem_x509_certificate(cert_data, default_backend())
-            
-            # Проверяем issuer (издателя сертификата)
-            issuer = cert.issuer.rfc4514_string()
-            
-            # Staging сертификаты Let's Encrypt содержат "Fake LE" или "Staging" в issuer
-            is_staging = (
-                "fake" in issuer.lower() or 
-                "staging" in issuer.lower() or
-                "test" in issuer.lower()
-            )
-            
-            return is_staging
+        Args:
+            full_domain: Полное доменное имя
             
-        except Exception as e:
-            self.logger.debug(f"Не удалось проверить тип сертификата: {e}")
-            return False
+        Returns:
+            Список значений TXT записи
+        """
+        return self.resolver.query_txt(full_domain)
     
-    def check_certificate_expiry(self) -> Optional[int]:
+    def discover_authoritative_servers(self, zone: str) -> Dict[str, List[str]]:
         """
-        Проверка срока действия сертификата
+        Определение авторитетных DNS серверов зоны (выполняется один раз на зону)
         
+        Args:
+            zone: Имя зоны
+            
         Returns:
-            Количество дней до истечения или None если сертификат не найден
+            Словарь {имя NS сервера: [IP адреса]}
         """
-        cert_file = os.path.join(self.cert_dir, "cert.pem")
-        
-        if not os.path.exists(cert_file):
-            self.logger.info("Сертификат не найден")
-            return None
+        if zone in self._authoritative_servers:
+            return self._authoritative_servers[zone]
         
+        servers: Dict[str, List[str]] = {}
         try:
-            from cryptography import x509
-            from cryptography.hazmat.backends import default_backend
-            import warnings
-            
-            with open(cert_file, "rb") as f:
-                cert_data = f.read()
-                cert = x509.load_pem_x509_certificate(cert_data, default_backend())
+            for ns_name in self.resolver.query_ns(zone):
+                try:
+                    addresses = self.resolver.query_a(ns_name)
+                except DNSError as e:
+                    self.logger.debug(f"Не удалось определить IP адрес {ns_name}: {e}")
+                    continue
+                if addresses:
+                    servers[ns_name] = addresses
+        except DNSError as e:
+            self.logger.warning(f"Не удалось получить NS записи зоны {zone}: {e}")
+        
+        if servers:
+            self.logger.debug(f"Авторитетные серверы {zone}: {', '.join(sorted(servers))}")
+        self._authoritative_servers[zone] = servers
+        return servers
+    
+    def get_soa_serials(self, zone: str) -> Dict[str, Optional[int]]:
+        """
+        Параллельный запрос серийных номеров SOA со всех авторитетных серверов
+        
+        Args:
+            zone: Имя зоны
             
-            # Используем not_valid_after_utc для избежания предупреждения
+        Returns:
+            Словарь {имя NS сервера: serial или None при ошибке}
+        """
+        servers = self.discover_authoritative_servers(zone)
+        if not servers:
+            return {}
+        
+        def fetch(ns_name: str) -> Optional[int]:
             try:
-                expiry_date = cert.not_valid_after_utc.replace(tzinfo=None)
-            except AttributeError:
-                # Для старых версий cryptography
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore")
-                    expiry_date = cert.not_valid_after
-            
-            days_left = (expiry_date - datetime.now()).days
-            
-            self.logger.info(f"Сертификат истекает: {expiry_date.strftime('%d.%m.%Y %H:%M:%S')}")
-            self.logger.info(f"Осталось дней: {days_left}")
-            
-            return days_left
-            
-        except Exception as e:
-            self.logger.error(f"Ошибка при проверке сертификата: {e}")
-            return None
+                soa = self.resolver.query_soa(zone, servers[ns_name], recursion=False)
+                return soa["serial"] if soa else None
+            except DNSError:
+                return None
+        
+        with ThreadPoolExecutor(max_workers=len(servers)) as pool:
+            return dict(zip(servers, pool.map(fetch, servers)))
     
-    def dns_challenge_hook(self, validation_domain: str, validation_token: str) -> bool:
+    def capture_soa_baseline(self, zone: str) -> Dict[str, Optional[int]]:
         """
-        Обработчик DNS challenge - добавление TXT записи
+        Запоминание серийных номеров SOA до публикации записи
         
         Args:
-            validation_domain: Домен для валидации (например, dfv24.com или *.dfv24.com)
-            validation_token: Токен валидации
+            zone: Имя зоны
             
         Returns:
-            True если успешно
+            Словарь {имя NS сервера: serial}
         """
-        try:
-            self.logger.info("=== DNS Challenge: Добавление TXT записи ===")
-            
-            # Извлекаем основной домен из validation_domain
-            # Убираем wildcard если есть
-            base_domain = validation_domain.replace("*.", "")
-            
-            # Для DNS-01 challenge всегда используем _acme-challenge
-            subdomain = "_acme-challenge"
-            
-            self.logger.info(f"Validation Domain: {validation_domain}")
-            self.logger.info(f"Base Domain: {base_domain}")
-            self.logger.info(f"Subdomain: {subdomain}")
-            self.logger.info(f"Token: {validation_token[:20]}...")
+        if self.config.get("dns_verify_mode", "authoritative") != "authoritative":
+            return {}
+        self._soa_baseline[zone] = self.get_soa_serials(zone)
+        return self._soa_baseline[zone]
+    
+    def _required_quorum(self, total: int) -> int:
+        """
+        Количество серверов, которые должны вернуть запись
+        
+        Args:
+            total: Общее число авторитетных серверов
             
-            # Добавляем TXT запись
-            self.logger.info("Добавление TXT записи через API reg.ru...")
-            success = self.api.add_txt_record(base_domain, subdomain, validation_token)
+        Returns:
+            Требуемый кворум
+        """
+        quorum = self.config.get("dns_quorum", "all")
+        if quorum == "all":
+            return total
+        return max(1, min(int(quorum), total))
+    
+    def _check_authoritative(self, zone: str, full_domain: str, expected_values: List[str],
+                             confirmed: Dict[str, bool], pool: ThreadPoolExecutor) -> Tuple[int, int]:
+        """
+        Один раунд проверки записи на всех авторитетных серверах
+        
+        Сначала сравнивается серийный номер SOA с запомненным до публикации;
+        TXT запрашивается только с серверов, где serial изменился.
+        
+        Args:
+            zone: Имя зоны
+            full_domain: Полное имя TXT записи
+            expected_values: Ожидаемые значения TXT записи
+            confirmed: Серверы, уже подтвердившие запись (обновляется)
+            pool: Пул потоков для параллельных запросов
             
-            if not success:
-                self.logger.error("Не удалось добавить TXT запись")
+        Returns:
+            Кортеж (подтвердивших серверов, всего серверов)
+        """
+        servers = self._authoritative_servers[zone]
+        baseline = self._soa_baseline.get(zone, {})
+        
+        def check(ns_name: str) -> bool:
+            addresses = servers[ns_name]
+            try:
+                old_serial = baseline.get(ns_name)
+                if old_serial is not None:
+                    soa = self.resolver.query_soa(zone, addresses, recursion=False)
+                    if soa and soa["serial"] == old_serial:
+                        return False
+                response = self.resolver.query(full_domain, DNS_TYPE_TXT, addresses, recursion=False)
+                answers = [rr for rr in response["answers"] if rr["type"] == DNS_TYPE_TXT]
+                if answers:
+                    self._record_ttl[full_domain] = max(rr["ttl"] for rr in answers)
+                values = [rr["data"] for rr in answers]
+                return all(value in values for value in expected_values)
+            except DNSError as e:
+                self.logger.debug(f"Ошибка запроса к {ns_name}: {e}")
                 return False
-            
-            self.logger.info("✅ TXT запись успешно добавлена в API reg.ru")
-            
-            # Ждем распространения DNS
-            wait_time = self.config.get("dns_propagation_wait", 60)
-            self.logger.info("")
-            self.logger.info("⏳ Ожидание распространения DNS...")
-            self.logger.info(f"   Время ожидания: {wait_time} секунд")
-            self.logger.info(f"   TXT запись: _acme-challenge.{base_domain}")
-            self.logger.info("")
-            
-            # Показываем прогресс ожидания
-            for i in range(wait_time):
-                if i % 10 == 0:
-                    elapsed_pct = int((i / wait_time) * 100)
-                    self.logger.info(f"   ⏱️  Прошло: {i}/{wait_time} сек ({elapsed_pct}%)")
-                time.sleep(1)
-            
-            self.logger.info(f"   ✅ Ожидание завершено ({wait_time} секунд)")
-            self.logger.info("")
-            
-            # Проверяем DNS запись (используем base_domain для проверки)
-            self.logger.info("🔍 Проверка распространения DNS через публичные серверы...")
-            if self.verify_dns_record_external(base_domain, subdomain, validation_token):
-                self.logger.info("✅ DNS запись подтверждена через публичные DNS серверы")
-                self.logger.info("   Certbot сможет пройти валидацию")
-                return True
-            else:
-                self.logger.warning("⚠️  DNS запись НЕ обнаружена через публичные DNS, но продолжаем...")
-                self.logger.warning("   Возможные причины:")
-                self.logger.warning("   • DNS серверы ещё не обновились (требуется больше времени)")
-                self.logger.warning("   • Let's Encrypt использует свои DNS серверы")
-                self.logger.warning("   • API reg.ru обновляет записи с задержкой")
-                self.logger.warning("")
-                self.logger.warning("   Certbot будет продолжать попытки валидации...")
-                return True
-                
-        except Exception as e:
-            self.logger.error(f"💥 Ошибка в dns_challenge_hook: {e}")
-            self.logger.exception("Traceback:")
-            return False
+        
+        pending = [ns_name for ns_name in servers if not confirmed.get(ns_name)]
+        for ns_name, ok in zip(pending, pool.map(check, pending)):
+            if ok:
+                confirmed[ns_name] = True
+        
+        return sum(1 for ns_name in servers if confirmed.get(ns_name)), len(servers)
     
-    def dns_cleanup_hook(self, validation_domain: str, validation_token: str) -> bool:
+    def negative_cache_ttl(self, zone: str) -> Optional[int]:
         """
-        Обработчик очистки DNS challenge - удаление TXT записи
+        Время отрицательного кэширования зоны (RFC 2308: min(TTL SOA, SOA minimum))
+        
+        Столько резолвер может помнить, что записи нет, если запросил её
+        до публикации.
         
         Args:
-            validation_domain: Домен валидации (например, dfv24.com или *.dfv24.com)
-            validation_token: Токен валидации
+            zone: Имя зоны
             
         Returns:
-            True если успешно
+            Секунды или None, если SOA получить не удалось
         """
-        self.logger.info("=== DNS Challenge: Удаление TXT записи ===")
+        if zone in self._negative_ttl:
+            return self._negative_ttl[zone]
         
-        # Извлекаем основной домен
-        base_domain = validation_domain.replace("*.", "")
-        subdomain = "_acme-challenge"
+        addresses = [address for servers in self.discover_authoritative_servers(zone).values()
+                     for address in servers]
+        try:
+            soa = self.resolver.query_soa(zone, addresses or None, recursion=not addresses)
+        except DNSError as e:
+            self.logger.debug(f"Не удалось получить SOA зоны {zone}: {e}")
+            soa = None
+        self._negative_ttl[zone] = min(soa["ttl"], soa["minimum"]) if soa else None
+        return self._negative_ttl[zone]
+    
+    def worst_case_wait(self, zone: str, full_domain: str) -> Tuple[float, Optional[int], int]:
+        """
+        Наихудшее время, через которое запись гарантированно видна резолверам
+        после подтверждения авторитетными серверами
         
-        self.logger.info(f"Домен: {base_domain}, Поддомен: {subdomain}")
+        Резолвер мог закэшировать отсутствие записи (TTL отрицательного
+        кэширования) или прежнее значение (TTL записи).
         
-        return self.api.remove_txt_record(base_domain, subdomain, validation_token)
+        Args:
+            zone: Имя зоны
+            full_domain: Полное имя TXT записи
+            
+        Returns:
+            Кортеж (секунды, TTL отрицательного кэширования, TTL записи)
+        """
+        negative_ttl = self.negative_cache_ttl(zone)
+        record_ttl = self._record_ttl.get(full_domain, self.config.get("challenge_record_ttl", 60))
+        return float(max(negative_ttl or 0, record_ttl)), negative_ttl, record_ttl
+    
+    def _report_worst_case(self, zone: str, full_domain: str):
+        """Вывод расчётного наихудшего времени видимости записи для резолверов"""
+        worst, negative_ttl, record_ttl = self.worst_case_wait(zone, full_domain)
+        negative = f"{negative_ttl} сек" if negative_ttl is not None else "неизвестен"
+        self.logger.info(f"   ⏱️  Наихудшее время видимости для резолверов: {int(worst)} сек "
+                         f"(отрицательное кэширование: {negative}, TTL записи: {record_ttl} сек)")
     
-    def verify_dns_record_external(self, domain: str, subdomain: str, expected_value: str) -> bool:
+    def verify_dns_record_external(self, domain: str, subdomain: str, expected_value: str,
+                                   published_at: Optional[float] = None) -> bool:
         """
-        Проверка наличия DNS записи через внешний DNS
+        Ожидание появления DNS записи во внешнем DNS
         
         Args:
             domain: Основной домен
             subdomain: Поддомен
             expected_value: Ожидаемое значение TXT записи
+            published_at: Момент публикации записи (time.monotonic()), для замера задержки
             
         Returns:
             True если запись найдена
         """
-        import time
+        return self.wait_for_txt_values(domain, subdomain, [expected_value], published_at)
+    
+    def wait_for_txt_values(self, domain: str, subdomain: str, expected_values: List[str],
+                            published_at: Optional[float] = None, verify_mode: Optional[str] = None,
+                            timings: Optional[Dict[str, float]] = None,
+                            record_history: bool = True) -> bool:
+        """
+        Ожидание появления всех значений TXT записи
+        
+        Опрос начинается сразу и завершается, как только записи видны.
+        Интервал между проверками растёт экспоненциально (со случайным джиттером)
+        до dns_poll_max_interval, общее время ограничено get_propagation_timeout().
+        
+        Сначала параллельно опрашиваются все авторитетные серверы зоны; запись
+        считается опубликованной, когда она видна на dns_quorum из них. В режиме
+        dns_verify_mode = "resolver" только после этого запрос идёт через
+        dns_nameservers - иначе резолвер может закэшировать отсутствие записи
+        на время отрицательного кэширования зоны.
         
+        Args:
+            domain: Основной домен (зона)
+            subdomain: Поддомен
+            expected_values: Ожидаемые значения TXT записи
+            published_at: Момент публикации записи (time.monotonic()), для замера задержки
+            verify_mode: Режим проверки (по умолчанию dns_verify_mode)
+            timings: Словарь для задержек видимости: authoritative, resolver (заполняется)
+            record_history: Сохранять задержки серверов в историю (False - замер не влияет
+                            на предел ожидания при выпуске)
+            
+        Returns:
+            True если все значения найдены
+        """
         full_domain = f"{subdomain}.{domain}"
-        attempts = self.config.get("dns_check_attempts", 10)
-        interval = self.config.get("dns_check_interval", 10)
+        timeout = self.get_propagation_timeout(domain)
+        if published_at is None:
+            published_at = time.monotonic()
+        deadline = published_at + timeout
+        verify_mode = verify_mode or self.config.get("dns_verify_mode", "authoritative")
+        timings = {} if timings is None else timings
+        
+        servers = self.discover_authoritative_servers(domain)
+        if not servers:
+            self.logger.warning("   Авторитетные серверы не найдены, проверяем через DNS резолвер")
         
         self.logger.info(f"   Проверяем: {full_domain}")
-        self.logger.info(f"   Ожидаемое значение: {expected_value[:30]}...")
-        self.logger.info(f"   Попыток: {attempts}, интервал: {interval} сек")
+        for value in expected_values:
+            self.logger.info(f"   Ожидаемое значение: {value[:30]}...")
+        if servers:
+            quorum = self._required_quorum(len(servers))
+            self.logger.info(f"   Авторитетные серверы: {', '.join(sorted(servers))} (кворум: {quorum})")
+        self.logger.info(f"   Предел ожидания: {int(timeout)} сек")
         self.logger.info("")
         
-        for attempt in range(attempts):
-            try:
-                # Используем nslookup или dig через subprocess
-                result = subprocess.run(
-                    ["nslookup", "-type=TXT", full_domain],
-                    capture_output=True,
-                    text=True,
-                    timeout=10
-                )
-                
-                if expected_value in result.stdout:
-                    self.logger.info(f"   ✅ Попытка {attempt + 1}/{attempts}: DNS запись НАЙДЕНА!")
-                    # Показываем найденную запись
-                    for line in result.stdout.split('\n'):
-                        if 'text =' in line.lower() or expected_value[:20] in line:
-                            self.logger.info(f"      {line.strip()}")
-                    return True
-                else:
-                    self.logger.info(f"   ⏳ Попытка {attempt + 1}/{attempts}: DNS запись не найдена, ждём...")
+        confirmed: Dict[str, bool] = {}
+        latencies: Dict[str, float] = {}
+        pool = ThreadPoolExecutor(max_workers=len(servers)) if servers else None
+        authoritative = bool(pool)
+        attempt = 0
+        try:
+            while True:
+                try:
+                    if authoritative:
+                        before = set(confirmed)
+                        found, total = self._check_authoritative(domain, full_domain, expected_values,
+                                                                 confirmed, pool)
+                        now = time.monotonic()
+                        for ns_name in set(confirmed) - before:
+                            latencies[ns_name] = now - published_at
+                        visible = found >= quorum
+                        status = f"{found}/{total} серверов"
+                    else:
+                        values = self._lookup_txt(full_domain)
+                        visible = all(value in values for value in expected_values)
+                        status = "DNS резолвер"
                     
-            except Exception as e:
-                self.logger.info(f"   ⚠️  Попытка {attempt + 1}/{attempts}: Ошибка nslookup - {e}")
-            
-            if attempt < attempts - 1:
-                time.sleep(interval)
-        
-        self.logger.warning(f"   ❌ DNS запись не найдена после {attempts} попыток")
+                    if visible:
+                        latency = time.monotonic() - published_at
+                        timings["authoritative" if authoritative else "resolver"] = latency
+                        self.logger.info(f"   ✅ Попытка {attempt + 1}: DNS запись НАЙДЕНА ({status})!")
+                        self.logger.info(f"   ⏱️  Запись видна через {latency:.1f} сек после публикации")
+                        if authoritative:
+                            self._report_worst_case(domain, full_domain)
+                        if authoritative and record_history:
+                            # Только подтвердившие серверы: остальные не дождались ни записи,
+                            # ни предела, их задержка неизвестна
+                            self.history.record(domain, latencies)
+                        if authoritative and verify_mode == "resolver":
+                            # Теперь резолвер не закэширует отсутствие записи
+                            self.logger.info("   Проверка через DNS резолвер...")
+                            authoritative = False
+                            continue
+                        return True
+                    else:
+                        self.logger.info(f"   ⏳ Попытка {attempt + 1}: DNS запись не найдена ({status}), ждём...")
+                        
+                except Exception as e:
+                    self.logger.info(f"   ⚠️  Попытка {attempt + 1}: Ошибка DNS запроса - {e}")
+                
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(self._next_poll_delay(attempt), remaining))
+                attempt += 1
+        finally:
+            if pool:
+                pool.shutdown(wait=False)
+        
+        # Таймаут на авторитетных серверах: не подтвердившие запись серверы ждали
+        # весь предел. Если таймаут в фазе резолвера - замеры серверов уже записаны
+        if authoritative and record_history:
+            for ns_name in servers:
+                if ns_name not in confirmed:
+                    latencies[ns_name] = timeout
+            self.history.record(domain, latencies)
+        self.logger.warning(f"   ❌ DNS запись не найдена за {int(timeout)} сек ({attempt + 1} попыток)")
         return False
     
     def verify_dns_record(self, subdomain: str, expected_value: str) -> bool:
@@ -1419,6 +5325,93 @@ class LetsEncryptManager:
         """
         return self.verify_dns_record_external(self.domain, subdomain, expected_value)
     
+    def benchmark_dns(self, domain: str, subdomain: str, iterations: int) -> Dict:
+        """
+        Замер задержек цикла публикация/проверка/удаление TXT записи
+        
+        Каждый цикл: добавление записи через API reg.ru, ожидание на
+        авторитетных серверах, затем через DNS резолвер, удаление записи.
+        Частоту запросов к API ограничивает общий ограничитель. Замеры
+        не попадают в историю задержек, по которой настраивается выпуск.
+        
+        Args:
+            domain: Зона reg.ru
+            subdomain: Поддомен тестовой записи
+            iterations: Количество циклов
+            
+        Returns:
+            Отчёт: параметры запуска, число ошибок и замеры по метрикам
+            (api_publish, authoritative, resolver, api_remove) с p50/p95/max
+        """
+        samples: Dict[str, List[float]] = {
+            "api_publish": [], "authoritative": [], "resolver": [], "api_remove": []
+        }
+        failures = 0
+        started = datetime.now()
+        verify_mode = "resolver"
+        
+        for iteration in range(iterations):
+            self.logger.info("")
+            self.logger.info(f"🔁 Цикл {iteration + 1}/{iterations}")
+            value = f"benchmark-{uuid.uuid4().hex[:16]}"
+            self.capture_soa_baseline(domain)
+            
+            start = time.monotonic()
+            result = self.api.batch().add_txt(domain, subdomain, value).submit()[0]
+            published_at = time.monotonic()
+            if not result["success"]:
+                self.logger.error(f"   ❌ Не удалось создать TXT запись: {result['error']}")
+                failures += 1
+                continue
+            samples["api_publish"].append(published_at - start)
+            
+            timings: Dict[str, float] = {}
+            if not self.wait_for_txt_values(domain, subdomain, [value], published_at,
+                                            verify_mode=verify_mode, timings=timings,
+                                            record_history=False):
+                failures += 1
+            for metric, latency in timings.items():
+                samples[metric].append(latency)
+            
+            start = time.monotonic()
+            result = self.api.batch().remove_txt(domain, subdomain, value).submit()[0]
+            if result["success"]:
+                samples["api_remove"].append(time.monotonic() - start)
+            else:
+                self.logger.warning(f"   ⚠️  Не удалось удалить TXT запись: {result['error']}")
+                failures += 1
+        
+        metrics = {}
+        for metric, values in samples.items():
+            metrics[metric] = {
+                "count": len(values),
+                "p50": round(PropagationHistory.percentile(values, 50), 3) if values else None,
+                "p95": round(PropagationHistory.percentile(values, 95), 3) if values else None,
+                "max": round(max(values), 3) if values else None,
+                "samples": [round(value, 3) for value in values],
+            }
+        return {
+            "domain": domain,
+            "subdomain": subdomain,
+            "iterations": iterations,
+            "failures": failures,
+            "started": started.isoformat(timespec="seconds"),
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "verify_mode": verify_mode,
+            "metrics": metrics,
+        }
+    
+    def _certbot_env(self) -> Dict[str, str]:
+        """
+        Окружение для запуска certbot с уникальным идентификатором запуска
+        
+        Returns:
+            Переменные окружения
+        """
+        env = dict(os.environ)
+        env[RUN_ID_ENV] = uuid.uuid4().hex
+        return env
+    
     def obtain_certificate(self, staging: bool = False) -> bool:
         """
         Получение нового сертификата
@@ -1459,62 +5452,120 @@ class LetsEncryptManager:
                     return False
         
         # Формируем список доменов
-        domains = [self.domain]
-        if self.config.get("wildcard", False):
-            domains.append(f"*.{self.domain}")
-        
         domain_args = []
-        for d in domains:
+        for d in self.certificate_domains():
             domain_args.extend(["-d", d])
         
-        # Создаём временные wrapper скрипты для hooks
-        import tempfile
+        config_path = self._config_path_from_argv()
+        if not config_path:
+            self.logger.error("Не указан путь к конфигурации. Используйте --config /path/to/config.json")
+            return False
+        
+        challenge_args, hooks = self._start_challenge_hooks(config_path)
+        
+        # Команда certbot
+        cmd = ["certbot", "certonly"] + challenge_args + [
+            "--email", self.email,
+            "--agree-tos",
+            "--non-interactive",
+            "--expand",
+        ]
+        
+        # Добавляем --staging для тестового окружения
+        if staging:
+            cmd.append("--staging")
+            cmd.append("--break-my-certs")  # Разрешает перезапись production сертификатов staging версиями
+        
+        cmd.extend(domain_args)
         
-        # Получаем путь к конфигурации из аргументов командной строки
-        config_path = None
+        try:
+            return self._run_certbot(cmd, staging, config_path)
+        finally:
+            self._stop_challenge_hooks(hooks)
+    
+    @staticmethod
+    def _config_path_from_argv() -> Optional[str]:
+        """Путь к конфигурации из аргументов командной строки (-c/--config)"""
         for i, arg in enumerate(sys.argv):
             if arg in ['-c', '--config'] and i + 1 < len(sys.argv):
-                config_path = os.path.abspath(sys.argv[i + 1])
-                break
+                return os.path.abspath(sys.argv[i + 1])
+        return None
+    
+    def _start_challenge_hooks(self, config_path: str) -> Tuple[List[str], Dict]:
+        """
+        Подготовка прохождения DNS-01 challenge для certbot certonly/renew
         
-        if not config_path:
-            self.logger.error("Не указан путь к конфигурации. Используйте --config /path/to/config.json")
-            return False
+        Плагин regru-api обрабатывает все challenge в процессе certbot.
+        Для --manual поднимается сервер hooks в этом процессе (или
+        используется уже запущенный --hook-server), а hook скрипты -
+        тонкие клиенты: API reg.ru и конфигурация остаются загруженными
+        на весь заказ.
         
-        # Auth hook wrapper
-        auth_hook_script = tempfile.NamedTemporaryFile(mode='w', suffix='.sh', delete=False)
-        auth_hook_script.write('#!/bin/bash\n')
-        auth_hook_script.write(f'{sys.executable} {os.path.abspath(__file__)} --config {config_path} --auth-hook\n')
-        auth_hook_script.close()
-        os.chmod(auth_hook_script.name, 0o755)
+        Args:
+            config_path: Путь к конфигурации
+            
+        Returns:
+            Аргументы certbot и состояние для _stop_challenge_hooks
+        """
+        hooks = {"server": None, "scripts": []}
         
-        # Cleanup hook wrapper
-        cleanup_hook_script = tempfile.NamedTemporaryFile(mode='w', suffix='.sh', delete=False)
-        cleanup_hook_script.write('#!/bin/bash\n')
-        cleanup_hook_script.write(f'{sys.executable} {os.path.abspath(__file__)} --config {config_path} --cleanup-hook\n')
-        cleanup_hook_script.close()
-        os.chmod(cleanup_hook_script.name, 0o755)
+        if self.config.get("certbot_authenticator", "manual") == CERTBOT_PLUGIN_NAME:
+            args = [
+                "--authenticator", CERTBOT_PLUGIN_NAME,
+                f"--{CERTBOT_PLUGIN_NAME}-config", config_path,
+            ]
+            return args, hooks
         
-        # Команда certbot
-        cmd = [
-            "certbot", "certonly",
+        socket_path = default_hook_socket_path(self.config)
+        if hook_server_running(socket_path):
+            self.logger.info(f"Используется запущенный сервер hooks: {socket_path}")
+        else:
+            try:
+                hook_server = HookServer(socket_path, self, self.logger,
+                                         self.config.get("hook_server_idle_timeout", 300))
+                hook_server.start()
+                hooks["server"] = hook_server
+            except OSError as e:
+                self.logger.warning(f"Не удалось запустить сервер hooks ({e}), hooks запустят скрипт целиком")
+        
+        client_timeout = self.config.get("hook_client_timeout", 900)
+        auth_hook_script = write_hook_client("auth", socket_path, config_path, client_timeout)
+        cleanup_hook_script = write_hook_client("cleanup", socket_path, config_path, client_timeout)
+        hooks["scripts"] = [auth_hook_script, cleanup_hook_script]
+        
+        self.logger.info(f"Auth hook: {auth_hook_script} -> {socket_path}")
+        self.logger.info(f"Cleanup hook: {cleanup_hook_script} -> {socket_path}")
+        
+        args = [
             "--manual",
             "--preferred-challenges", "dns",
-            "--manual-auth-hook", auth_hook_script.name,
-            "--manual-cleanup-hook", cleanup_hook_script.name,
-            "--email", self.email,
-            "--agree-tos",
-            "--non-interactive",
-            "--expand",
+            "--manual-auth-hook", auth_hook_script,
+            "--manual-cleanup-hook", cleanup_hook_script,
         ]
+        return args, hooks
+    
+    def _stop_challenge_hooks(self, hooks: Dict):
+        """Остановка сервера hooks и удаление временных hook скриптов"""
+        if hooks["server"]:
+            hooks["server"].stop()
+        for script in hooks["scripts"]:
+            try:
+                os.unlink(script)
+            except OSError:
+                pass
+    
+    def _run_certbot(self, cmd: List[str], staging: bool, config_path: str) -> bool:
+        """
+        Запуск certbot certonly и разбор результата
         
-        # Добавляем --staging для тестового окружения
-        if staging:
-            cmd.append("--staging")
-            cmd.append("--break-my-certs")  # Разрешает перезапись production сертификатов staging версиями
-        
-        cmd.extend(domain_args)
-        
+        Args:
+            cmd: Команда certbot
+            staging: Используется staging окружение
+            config_path: Путь к конфигурации
+            
+        Returns:
+            True если сертификат получен
+        """
         self.logger.info("=" * 80)
         if staging:
             self.logger.info("ЗАПУСК CERTBOT (STAGING MODE)")
@@ -1526,8 +5577,6 @@ class LetsEncryptManager:
         self.logger.info(f"Python: {sys.executable}")
         self.logger.info(f"Скрипт: {os.path.abspath(__file__)}")
         self.logger.info(f"Конфигурация: {config_path}")
-        self.logger.info(f"Auth hook: {sys.executable} {os.path.abspath(__file__)} --config {config_path} --auth-hook")
-        self.logger.info(f"Cleanup hook: {sys.executable} {os.path.abspath(__file__)} --config {config_path} --cleanup-hook")
         self.logger.info("=" * 80)
         
         try:
@@ -1535,7 +5584,8 @@ class LetsEncryptManager:
                 cmd,
                 capture_output=True,
                 text=True,
-                check=True
+                check=True,
+                env=self._certbot_env()
             )
             
             self.logger.info("=" * 80)
@@ -1608,13 +5658,6 @@ class LetsEncryptManager:
             self.logger.error("=" * 80)
             
             return False
-        finally:
-            # Удаляем временные wrapper скрипты
-            try:
-                os.unlink(auth_hook_script.name)
-                os.unlink(cleanup_hook_script.name)
-            except:
-                pass
     
     def renew_certificate(self) -> bool:
         """
@@ -1625,20 +5668,22 @@ class LetsEncryptManager:
         """
         self.logger.info("=== Обновление SSL сертификата ===")
         
-        cmd = [
-            "certbot", "renew",
-            "--manual",
-            "--manual-auth-hook", f"{sys.executable} {os.path.abspath(__file__)} --auth-hook",
-            "--manual-cleanup-hook", f"{sys.executable} {os.path.abspath(__file__)} --cleanup-hook",
-            "--non-interactive",
-        ]
+        config_path = self._config_path_from_argv()
+        if not config_path:
+            self.logger.error("Не указан путь к конфигурации. Используйте --config /path/to/config.json")
+            return False
+        
+        # Тот же способ прохождения challenge, что и при получении
+        challenge_args, hooks = self._start_challenge_hooks(config_path)
+        cmd = ["certbot", "renew"] + challenge_args + ["--non-interactive"]
         
         try:
             result = subprocess.run(
                 cmd,
                 capture_output=True,
                 text=True,
-                check=True
+                check=True,
+                env=self._certbot_env()
             )
             
             self.logger.info("Проверка обновления завершена")
@@ -1649,6 +5694,8 @@ class LetsEncryptManager:
             self.logger.error(f"Ошибка при обновлении: {e}")
             self.logger.error(e.stderr)
             return False
+        finally:
+            self._stop_challenge_hooks(hooks)
     
     def display_certificate_info(self):
         """Вывод информации о сертификате"""
@@ -1701,65 +5748,691 @@ class LetsEncryptManager:
         except Exception as e:
             self.logger.error(f"Ошибка при чтении сертификата: {e}")
     
-    def sync_with_npm(self, npm_api: NginxProxyManagerAPI) -> bool:
-        """
-        Синхронизация сертификата с Nginx Proxy Manager
+    def sync_with_npm(self, npm_api: NginxProxyManagerAPI) -> bool:
+        """
+        Синхронизация сертификата с Nginx Proxy Manager
+        
+        Args:
+            npm_api: API клиент NPM
+            
+        Returns:
+            True если успешно
+        """
+        self.logger.info("=== Синхронизация сертификата с Nginx Proxy Manager ===")
+        
+        # Проверяем наличие сертификата
+        if not os.path.exists(self.cert_dir):
+            self.logger.error(f"Директория сертификата не найдена: {self.cert_dir}")
+            return False
+        
+        # Синхронизируем сертификат (загрузка - только если содержимое отличается)
+        result = npm_api.sync_certificate(self.domain, self.cert_dir, self.cert_state.get(self.domain))
+        if not result:
+            return False
+        self.cert_state.mark_synced(self.domain, os.path.join(self.cert_dir, "cert.pem"), result.get("id"))
+        return True
+    
+    def npm_in_sync(self) -> bool:
+        """
+        Загружен ли текущий сертификат в NPM (по локальному состоянию)
+        
+        Returns:
+            True если отпечаток cert.pem совпадает с последним загруженным в NPM
+        """
+        fingerprint = CertificateState.fingerprint(os.path.join(self.cert_dir, "cert.pem"))
+        return bool(fingerprint) and self.cert_state.get(self.domain).get("npm_fingerprint") == fingerprint
+
+
+# ==============================================================================
+# ПЛАГИН CERTBOT (regru-api)
+# ==============================================================================
+
+# Имя плагина; отличается от стороннего certbot-dns-regru (dns-regru),
+# чтобы оба пакета могли быть установлены одновременно
+CERTBOT_PLUGIN_NAME = "regru-api"
+
+if CERTBOT_AVAILABLE:
+    
+    class RegRuAuthenticator(certbot_common.Plugin, certbot_interfaces.Authenticator):
+        """
+        Плагин аутентификации certbot для DNS-01 challenge через API reg.ru
+        
+        Все challenge заказа обрабатываются в процессе certbot: записи публикуются
+        вместе, распространение проверяется один раз, одна HTTP сессия reg.ru
+        используется для всего заказа.
+        
+        Регистрация (entry point группы certbot.plugins, make install-certbot-plugin):
+            regru-api = letsencrypt_regru_api:RegRuAuthenticator
+        
+        Использование:
+            certbot certonly --authenticator regru-api --regru-api-config /etc/letsencrypt-regru/config.json
+        """
+        
+        description = "Получение сертификата через DNS-01 challenge с API reg.ru"
+        
+        @classmethod
+        def add_parser_arguments(cls, add):
+            add("config", help="Путь к файлу конфигурации letsencrypt-regru (JSON)")
+        
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.manager: Optional[LetsEncryptManager] = None
+        
+        def prepare(self):
+            config = load_config(self.conf("config"))
+            # Логирование настраивает certbot: свои обработчики в его процесс не добавляем
+            logger = logging.getLogger(__name__)
+            api = create_regru_api(config, logger)
+            self.manager = LetsEncryptManager(config, api, logger)
+        
+        def more_info(self) -> str:
+            return ("Плагин создаёт TXT записи _acme-challenge через API reg.ru "
+                    "и удаляет их после валидации.")
+        
+        def get_chall_pref(self, domain: str):
+            return [acme_challenges.DNS01]
+        
+        def _challenges(self, achalls) -> List[Tuple[str, str]]:
+            """Пары (домен, значение TXT записи) для списка challenge"""
+            return [(achall.domain, achall.validation(achall.account_key)) for achall in achalls]
+        
+        def perform(self, achalls):
+            try:
+                self.manager.perform_challenges(self._challenges(achalls))
+            except Exception as e:
+                raise certbot_errors.PluginError(f"Ошибка DNS challenge reg.ru: {e}")
+            return [achall.response(achall.account_key) for achall in achalls]
+        
+        def cleanup(self, achalls):
+            self.manager.cleanup_challenges(self._challenges(achalls))
+
+
+# ==============================================================================
+# СЕРВЕР HOOKS
+# ==============================================================================
+
+# Тонкий клиент hook: пересылает CERTBOT_* серверу, без тяжёлых импортов.
+# Если к серверу не удалось подключиться - запускает скрипт целиком, как раньше.
+# Ошибка после отправки запроса не повторяет hook: сервер мог его уже выполнить
+HOOK_CLIENT_TEMPLATE = """#!{python}
+import json, os, socket, sys
+env = {{k: v for k, v in os.environ.items() if k.startswith(("CERTBOT_", "LETSENCRYPT_REGRU_"))}}
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+sock.settimeout(5)
+try:
+    sock.connect({socket_path!r})
+except OSError:
+    sock.close()
+    os.execv({python!r}, [{python!r}, {script!r}, "--config", {config_path!r}, "--{action}-hook"])
+try:
+    sock.settimeout({timeout!r})
+    sock.sendall(json.dumps({{"action": {action!r}, "env": env}}).encode("utf-8") + b"\\n")
+    data = b""
+    while not data.endswith(b"\\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    sys.exit(int(json.loads(data.decode("utf-8"))["code"]))
+except (OSError, ValueError, KeyError) as e:
+    sys.stderr.write("hook: сервер hooks не ответил ({{}}): {{}}\\n".format({socket_path!r}, e))
+    sys.exit(1)
+"""
+
+
+def default_hook_socket_path(config: Dict) -> str:
+    """
+    Путь к сокету сервера hooks по умолчанию
+    
+    Args:
+        config: Конфигурация
+        
+    Returns:
+        Путь к Unix сокету (hook_socket или state_dir/hook.sock)
+    """
+    return config.get("hook_socket") or os.path.join(
+        config.get("state_dir", "/var/lib/letsencrypt-regru"), "hook.sock")
+
+
+def hook_server_running(socket_path: str) -> bool:
+    """
+    Принимает ли сервер hooks подключения на сокете
+    
+    Args:
+        socket_path: Путь к Unix сокету
+        
+    Returns:
+        True если к сокету удалось подключиться
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(1.0)
+    try:
+        sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def write_hook_client(action: str, socket_path: str, config_path: str,
+                      timeout: float = 900) -> str:
+    """
+    Создание временного скрипта тонкого клиента hook
+    
+    Args:
+        action: "auth" или "cleanup"
+        socket_path: Путь к сокету сервера hooks
+        config_path: Путь к конфигурации (для запуска без сервера)
+        timeout: Максимальное время ответа сервера (секунды)
+        
+    Returns:
+        Путь к созданному скрипту
+    """
+    import tempfile
+    
+    script = tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False)
+    script.write(HOOK_CLIENT_TEMPLATE.format(
+        python=sys.executable,
+        script=os.path.abspath(__file__),
+        socket_path=socket_path,
+        config_path=config_path,
+        action=action,
+        timeout=timeout,
+    ))
+    script.close()
+    os.chmod(script.name, 0o700)
+    return script.name
+
+
+class HookServer:
+    """
+    Сервер certbot hooks на Unix сокете
+    
+    Держит API reg.ru (с открытой HTTP сессией), конфигурацию и обработчики логов
+    в памяти; hook скрипты становятся тонкими клиентами. Завершается, если
+    за idle_timeout секунд не пришло ни одного запроса.
+    """
+    
+    def __init__(self, socket_path: str, manager: "LetsEncryptManager", logger: logging.Logger,
+                 idle_timeout: float = 300):
+        """
+        Инициализация сервера hooks
+        
+        Args:
+            socket_path: Путь к Unix сокету
+            manager: Менеджер сертификатов
+            logger: Logger объект
+            idle_timeout: Время простоя до завершения (секунды)
+        """
+        self.socket_path = socket_path
+        self.manager = manager
+        self.logger = logger
+        self.idle_timeout = idle_timeout
+        self._stopped = threading.Event()
+        self._sock: Optional[socket.socket] = None
+        self._bind()
+    
+    def _bind(self):
+        """Создание сокета, доступного только владельцу"""
+        directory = os.path.dirname(self.socket_path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            # Не перехватываем сокет у работающего сервера, удаляем только оставшийся файл
+            if hook_server_running(self.socket_path):
+                raise OSError(errno.EADDRINUSE, "Сервер hooks уже запущен", self.socket_path)
+            os.remove(self.socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self._sock.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self._sock.listen(4)
+        # Короткий таймаут accept - чтобы периодически проверять остановку и простой
+        self._sock.settimeout(1.0)
+    
+    def _handle(self, conn: socket.socket):
+        """Обработка одного запроса hook (ошибки сокета не останавливают сервер)"""
+        try:
+            self._serve_connection(conn)
+        except OSError as e:
+            self.logger.warning(f"Сервер hooks: ошибка соединения с клиентом: {e}")
+    
+    def _serve_connection(self, conn: socket.socket):
+        """Чтение запроса, выполнение hook и отправка кода возврата"""
+        with conn:
+            # Клиент, не приславший запрос, не должен останавливать сервер
+            conn.settimeout(30)
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            if not data:
+                # Проверка доступности сервера (hook_server_running)
+                return
+            try:
+                request = json.loads(data.decode("utf-8"))
+                action = request["action"]
+                if action not in ("auth", "cleanup"):
+                    raise ValueError(f"Неизвестное действие: {action}")
+                code = run_certbot_hook(action, request.get("env", {}), self.manager, self.logger)
+            except (ValueError, KeyError) as e:
+                self.logger.error(f"Некорректный запрос к серверу hooks: {e}")
+                code = 1
+            conn.sendall(json.dumps({"code": code}).encode("utf-8") + b"\n")
+    
+    def serve_forever(self):
+        """Обработка запросов до остановки или истечения времени простоя"""
+        self.logger.info(f"Сервер hooks запущен: {self.socket_path} (простой до {int(self.idle_timeout)} сек)")
+        last_activity = time.monotonic()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    conn, _ = self._sock.accept()
+                except socket.timeout:
+                    if time.monotonic() - last_activity > self.idle_timeout:
+                        self.logger.info("Сервер hooks: превышено время простоя, завершение")
+                        break
+                    continue
+                self._handle(conn)
+                last_activity = time.monotonic()
+        finally:
+            self.close()
+    
+    def start(self) -> threading.Thread:
+        """
+        Запуск сервера в фоновом потоке
+        
+        Returns:
+            Поток сервера
+        """
+        thread = threading.Thread(target=self.serve_forever, name="hook-server", daemon=True)
+        thread.start()
+        return thread
+    
+    def stop(self):
+        """Остановка сервера"""
+        self._stopped.set()
+    
+    def close(self):
+        """Закрытие сокета и удаление файла сокета"""
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+
+
+# ==============================================================================
+# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
+# ==============================================================================
+
+def reload_webserver(logger: logging.Logger):
+    """
+    Перезагрузка веб-сервера
+    
+    Args:
+        logger: Logger объект
+    """
+    logger.info("Перезагрузка веб-сервера...")
+    
+    # Проверяем какие сервисы активны
+    services = ["nginx", "apache2", "httpd"]
+    
+    for service in services:
+        try:
+            # Проверяем статус
+            result = subprocess.run(
+                ["systemctl", "is-active", service],
+                capture_output=True,
+                text=True
+            )
+            
+            if result.stdout.strip() == "active":
+                # Перезагружаем
+                subprocess.run(
+                    ["systemctl", "reload", service],
+                    check=True
+                )
+                logger.info(f"Сервис {service} перезагружен")
+                return
+                
+        except Exception as e:
+            logger.debug(f"Сервис {service} не активен или ошибка: {e}")
+    
+    logger.warning("Активный веб-сервер не найден")
+
+
+def run_certbot_hook(action: str, env: Dict[str, str], manager: "LetsEncryptManager",
+                     logger: logging.Logger) -> int:
+    """
+    Выполнение certbot hook (auth или cleanup) по переменным окружения CERTBOT_*
+    
+    Args:
+        action: "auth" или "cleanup"
+        env: Переменные окружения hook
+        manager: Менеджер сертификатов
+        logger: Logger объект
+        
+    Returns:
+        Код возврата hook
+    """
+    if action == "auth":
+        try:
+            logger.info("=" * 80)
+            logger.info("🔑 AUTH HOOK ВЫЗВАН")
+            logger.info("=" * 80)
+            
+            # Certbot передает домен и токен через переменные окружения
+            domain = env.get("CERTBOT_DOMAIN")
+            token = env.get("CERTBOT_VALIDATION")
+            
+            logger.info(f"CERTBOT_DOMAIN: {domain}")
+            logger.info(f"CERTBOT_VALIDATION: {token[:20]}..." if token else "CERTBOT_VALIDATION: None")
+            
+            if not domain or not token:
+                logger.error("CERTBOT_DOMAIN или CERTBOT_VALIDATION не установлены")
+                logger.error("Переменные окружения:")
+                for key in env:
+                    if key.startswith("CERTBOT_"):
+                        logger.error(f"  {key}: {env[key]}")
+                return 1
+            
+            remaining = env.get("CERTBOT_REMAINING_CHALLENGES")
+            logger.info(f"CERTBOT_REMAINING_CHALLENGES: {remaining}")
+            
+            success = manager.dns_challenge_hook(
+                domain, token,
+                int(remaining) if remaining and remaining.isdigit() else None,
+                ChallengeRunState.current_run_id(env)
+            )
+            
+            if success:
+                logger.info("✅ AUTH HOOK ЗАВЕРШЕН УСПЕШНО")
+                return 0
+            else:
+                logger.error("❌ AUTH HOOK ЗАВЕРШИЛСЯ С ОШИБКОЙ")
+                return 1
+                
+        except Exception as e:
+            logger.error(f"💥 КРИТИЧЕСКАЯ ОШИБКА В AUTH HOOK: {e}")
+            logger.exception("Traceback:")
+            return 1
+    
+    try:
+        logger.info("=" * 80)
+        logger.info("🧹 CLEANUP HOOK ВЫЗВАН")
+        logger.info("=" * 80)
+        
+        domain = env.get("CERTBOT_DOMAIN")
+        token = env.get("CERTBOT_VALIDATION")
+        
+        logger.info(f"CERTBOT_DOMAIN: {domain}")
+        logger.info(f"CERTBOT_VALIDATION: {token[:20]}..." if token else "CERTBOT_VALIDATION: None")
+        
+        if not domain or not token:
+            logger.error("CERTBOT_DOMAIN или CERTBOT_VALIDATION не установлены")
+            logger.error("Переменные окружения:")
+            for key in env:
+                if key.startswith("CERTBOT_"):
+                    logger.error(f"  {key}: {env[key]}")
+            return 1
+        
+        success = manager.dns_cleanup_hook(domain, token)
+        
+        if success:
+            logger.info("✅ CLEANUP HOOK ЗАВЕРШЕН УСПЕШНО")
+            return 0
+        else:
+            logger.warning("⚠️ CLEANUP HOOK ЗАВЕРШИЛСЯ С ПРЕДУПРЕЖДЕНИЕМ (не критично)")
+            return 0  # Cleanup hook не должен блокировать получение сертификата
+            
+    except Exception as e:
+        logger.error(f"💥 ОШИБКА В CLEANUP HOOK: {e}")
+        logger.exception("Traceback:")
+        return 0  # Cleanup hook не должен блокировать получение сертификата
+
+
+def run_dns_benchmark(config: Dict, manager: "LetsEncryptManager", iterations: int,
+                      report_path: Optional[str], logger: logging.Logger) -> int:
+    """
+    Режим замера задержек --test-dns --iterations N
+    
+    Args:
+        config: Конфигурация
+        manager: Менеджер сертификатов
+        iterations: Количество циклов
+        report_path: Файл JSON отчёта (по умолчанию в state_dir)
+        logger: Logger объект
         
-        Args:
-            npm_api: API клиент NPM
-            
-        Returns:
-            True если успешно
-        """
-        self.logger.info("=== Синхронизация сертификата с Nginx Proxy Manager ===")
+    Returns:
+        Код возврата (0 - все циклы без ошибок)
+    """
+    logger.info(f"📋 Замер задержек: {iterations} циклов публикация/проверка/удаление")
+    report = manager.benchmark_dns(config["domain"], "_acme-challenge", iterations)
+    
+    titles = {
+        "api_publish": "API reg.ru: добавление",
+        "authoritative": "Авторитетные серверы",
+        "resolver": "DNS резолвер",
+        "api_remove": "API reg.ru: удаление",
+    }
+    logger.info("")
+    logger.info("=" * 80)
+    logger.info("РЕЗУЛЬТАТЫ ЗАМЕРА (секунды)")
+    logger.info("=" * 80)
+    logger.info(f"{'Метрика':<28}{'n':>5}{'p50':>10}{'p95':>10}{'max':>10}")
+    for metric, title in titles.items():
+        data = report["metrics"][metric]
+        values = [f"{data[key]:>10.2f}" if data[key] is not None else f"{'-':>10}"
+                  for key in ("p50", "p95", "max")]
+        logger.info(f"{title:<28}{data['count']:>5}{''.join(values)}")
+    logger.info(f"Ошибок: {report['failures']}")
+    
+    if not report_path:
+        report_path = os.path.join(
+            config.get("state_dir", DEFAULT_CONFIG["state_dir"]),
+            f"dns-benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+        )
+    try:
+        write_json_file(report_path, report, mode=0o644)
+        logger.info(f"Отчёт сохранён: {report_path}")
+    except OSError as e:
+        logger.error(f"Не удалось сохранить отчёт {report_path}: {e}")
+    logger.info("=" * 80)
+    return 0 if report["failures"] == 0 else 1
+
+
+def default_certificate_state(config: Dict, logger: logging.Logger) -> CertificateState:
+    """
+    Состояние сертификатов в state_dir
+    
+    Args:
+        config: Конфигурация
+        logger: Logger объект
         
-        # Проверяем наличие сертификата
-        if not os.path.exists(self.cert_dir):
-            self.logger.error(f"Директория сертификата не найдена: {self.cert_dir}")
-            return False
+    Returns:
+        Состояние сертификатов
+    """
+    return CertificateState(
+        os.path.join(config.get("state_dir", DEFAULT_CONFIG["state_dir"]), "certificates.json"), logger
+    )
+
+
+def cleanup_queue_path(config: Dict) -> str:
+    """
+    Путь к очереди отложенного удаления TXT записей
+    
+    Args:
+        config: Конфигурация
         
-        # Синхронизируем сертификат
-        return npm_api.sync_certificate(self.domain, self.cert_dir)
+    Returns:
+        Путь к файлу
+    """
+    return os.path.join(config.get("state_dir", DEFAULT_CONFIG["state_dir"]), "cleanup-queue.jsonl")
 
 
-# ==============================================================================
-# ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
-# ==============================================================================
+def auto_nothing_due(config: Dict, logger: logging.Logger) -> bool:
+    """
+    Быстрая проверка --auto по локальному состоянию, без сети
+    
+    Работы нет, если cert.pem не изменился с последней проверки срока,
+    до порога обновления больше renewal_days, сертификат уже загружен
+    в NPM (если он включён) и нет отложенного удаления TXT записей.
+    
+    Args:
+        config: Конфигурация
+        logger: Logger объект
+        
+    Returns:
+        True если ничего делать не нужно
+    """
+    domain = config["domain"]
+    entry = default_certificate_state(config, logger).get(domain)
+    fingerprint = CertificateState.fingerprint(os.path.join(config["cert_dir"], domain, "cert.pem"))
+    if not fingerprint or entry.get("fingerprint") != fingerprint or not entry.get("not_after"):
+        return False
+    
+    days_left = (datetime.fromisoformat(entry["not_after"]) - datetime.now()).days
+    if days_left < config.get("renewal_days", 30):
+        return False
+    if config.get("npm_enabled", False) and entry.get("npm_fingerprint") != fingerprint:
+        return False
+    
+    queue_path = cleanup_queue_path(config)
+    if os.path.exists(queue_path) and os.path.getsize(queue_path) > 0:
+        return False
+    
+    logger.info(f"Сертификат {domain} действителен ({days_left} дней), "
+                "обновление и синхронизация не требуются")
+    return True
 
-def reload_webserver(logger: logging.Logger):
+
+def default_responder_store(config: Dict) -> str:
     """
-    Перезагрузка веб-сервера
+    Путь к файлу записей встроенного DNS сервера challenge
+    
+    Args:
+        config: Конфигурация
+        
+    Returns:
+        Путь к файлу
+    """
+    return os.path.join(config.get("state_dir", DEFAULT_CONFIG["state_dir"]), "responder-records.json")
+
+
+def configured_zones(config: Dict) -> List[str]:
+    """
+    Имена из конфигурации (domain и extra_domains без wildcard)
+    
+    Используются как зоны, если список зон аккаунта reg.ru недоступен.
+    
+    Args:
+        config: Конфигурация
+        
+    Returns:
+        Список имён
+    """
+    names = [config["domain"]] + list(config.get("extra_domains", []))
+    return list(dict.fromkeys(name.replace("*.", "").lower() for name in names))
+
+
+def create_npm_api(config: Dict, logger: logging.Logger) -> NginxProxyManagerAPI:
+    """
+    Создание API клиента NPM с кэшем токенов в state_dir
     
     Args:
+        config: Конфигурация
         logger: Logger объект
+        
+    Returns:
+        API клиент NPM
     """
-    logger.info("Перезагрузка веб-сервера...")
+    return NginxProxyManagerAPI(
+        config["npm_host"],
+        config["npm_email"],
+        config["npm_password"],
+        logger,
+        token_cache_dir=os.path.join(config.get("state_dir", DEFAULT_CONFIG["state_dir"]), "npm-tokens"),
+        token_refresh_before=config.get("npm_token_refresh_before", DEFAULT_CONFIG["npm_token_refresh_before"])
+    )
+
+
+def create_regru_api(config: Dict, logger: logging.Logger) -> RegRuAPI:
+    """
+    Создание API клиента reg.ru с ограничителем частоты из конфигурации
     
-    # Проверяем какие сервисы активны
-    services = ["nginx", "apache2", "httpd"]
+    Args:
+        config: Конфигурация
+        logger: Logger объект
+        
+    Returns:
+        API клиент reg.ru или RegRuAccountPool, если заданы regru_accounts
+    """
+    state_dir = config.get("state_dir", DEFAULT_CONFIG["state_dir"])
+    zone_cache = ZoneRecordCache(
+        os.path.join(state_dir, "zones"),
+        config.get("regru_zone_cache_ttl", DEFAULT_CONFIG["regru_zone_cache_ttl"]),
+        logger
+    )
+    ledger = ChallengeLedger(os.path.join(state_dir, "challenges.jsonl"), logger)
+    rate_limit_file = config.get("regru_rate_limit_file", DEFAULT_CONFIG["regru_rate_limit_file"])
     
-    for service in services:
-        try:
-            # Проверяем статус
-            result = subprocess.run(
-                ["systemctl", "is-active", service],
-                capture_output=True,
-                text=True
-            )
-            
-            if result.stdout.strip() == "active":
-                # Перезагружаем
-                subprocess.run(
-                    ["systemctl", "reload", service],
-                    check=True
-                )
-                logger.info(f"Сервис {service} перезагружен")
-                return
-                
-        except Exception as e:
-            logger.debug(f"Сервис {service} не активен или ошибка: {e}")
+    accounts = {"default": {"username": config["regru_username"], "password": config["regru_password"]}}
+    for name, account in config.get("regru_accounts", {}).items():
+        if name == "default":
+            # Имя занято основным аккаунтом (regru_username/regru_password)
+            logger.warning("Аккаунт 'default' в regru_accounts пропущен: имя зарезервировано "
+                           "для regru_username/regru_password, переименуйте его")
+            continue
+        accounts[name] = account
     
-    logger.warning("Активный веб-сервер не найден")
+    clients: Dict[str, RegRuAPI] = {}
+    zones: Dict[str, str] = {}
+    for name, account in accounts.items():
+        # Файлы основного аккаунта сохраняют прежние имена
+        suffix = "" if name == "default" else f"-{name}"
+        base, ext = os.path.splitext(rate_limit_file)
+        rate_limiter = RateLimiter(
+            f"{base}{suffix}{ext}",
+            account.get("rate_limit_per_minute", config.get(
+                "regru_rate_limit_per_minute", DEFAULT_CONFIG["regru_rate_limit_per_minute"])),
+            account.get("rate_limit_burst", config.get(
+                "regru_rate_limit_burst", DEFAULT_CONFIG["regru_rate_limit_burst"])),
+            logger
+        )
+        circuit_breaker = CircuitBreaker(os.path.join(state_dir, f"regru-cooldown{suffix}.json"), logger)
+        zone_index = ZoneIndex(
+            os.path.join(state_dir, "zones", f"zone-list{suffix}.json"),
+            config.get("regru_zone_list_ttl", DEFAULT_CONFIG["regru_zone_list_ttl"]),
+            logger
+        )
+        clients[name] = RegRuAPI(
+            account["username"], account["password"], logger,
+            rate_limiter, circuit_breaker,
+            max_retries=config.get("regru_max_retries", 3),
+            retry_base_delay=config.get("regru_retry_base_delay", 1.0),
+            retry_max_delay=config.get("regru_retry_max_delay", 30.0),
+            cooldown_seconds=config.get("regru_cooldown_seconds", 600),
+            zone_cache=zone_cache,
+            ledger=ledger,
+            zone_index=zone_index,
+            ip_cache_file=os.path.join(state_dir, "public-ip.json"),
+            ip_cache_ttl=config.get("public_ip_cache_ttl", DEFAULT_CONFIG["public_ip_cache_ttl"]),
+            ip_timeout=config.get("public_ip_timeout", DEFAULT_CONFIG["public_ip_timeout"])
+        )
+        for zone in account.get("zones", []):
+            zones[zone] = name
+    
+    if len(clients) == 1:
+        return clients["default"]
+    return RegRuAccountPool(clients, zones, logger)
 
 
 def load_config(config_file: Optional[str] = None) -> Dict:
@@ -1922,6 +6595,11 @@ def main():
         help="Показать все сертификаты в Nginx Proxy Manager",
         action="store_true"
     )
+    main_group.add_argument(
+        "--gc-challenges",
+        help="Удалить оставшиеся TXT записи _acme-challenge во всех зонах конфигурации",
+        action="store_true"
+    )
     main_group.add_argument(
         "--delete-npm",
         help="Удалить сертификат из Nginx Proxy Manager по ID",
@@ -1964,6 +6642,22 @@ def main():
         help="Certbot cleanup hook (удаление DNS записи)",
         action="store_true"
     )
+    service_group.add_argument(
+        "--hook-server",
+        help="Сервер certbot hooks на Unix сокете (API reg.ru остаётся загруженным)",
+        action="store_true"
+    )
+    service_group.add_argument(
+        "--challenge-responder",
+        help="Встроенный DNS сервер зоны валидации (бэкенды challenge типа builtin)",
+        action="store_true"
+    )
+    service_group.add_argument(
+        "--hook-socket",
+        help="Путь к Unix сокету сервера hooks",
+        metavar="PATH",
+        default=None
+    )
     
     # Дополнительные параметры
     parser.add_argument(
@@ -1971,6 +6665,36 @@ def main():
         help="Подробный вывод для диагностики",
         action="store_true"
     )
+    parser.add_argument(
+        "--iterations",
+        help="Для --test-dns: количество циклов замера задержек (p50/p95/max и JSON отчёт)",
+        metavar="N",
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        "--report",
+        help="Для --test-dns: файл JSON отчёта замера задержек (без --iterations - один цикл)",
+        metavar="FILE",
+        default=None
+    )
+    parser.add_argument(
+        "--dry-run",
+        help="Для --gc-challenges: только показать записи, не удаляя их",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--gc-min-age",
+        help="Для --gc-challenges: не удалять записи моложе SECONDS (по умолчанию из конфигурации)",
+        metavar="SECONDS",
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        "--gc-include-unknown",
+        help="Для --gc-challenges: удалять и записи, которых нет в журнале challenge (возраст неизвестен)",
+        action="store_true"
+    )
     parser.add_argument(
         "--force-cleanup",
         help="Принудительная очистка lock-файлов Certbot (если процесс завис)",
@@ -2046,12 +6770,18 @@ def main():
     
     # Загрузка конфигурации
     config = load_config(args.config)
+    if args.hook_socket:
+        # Один путь и для --hook-server, и для клиентов hooks выпуска
+        config["hook_socket"] = args.hook_socket
     
     # Настройка логирования
     logger = setup_logging(config["log_file"], args.verbose)
     
     # Тестирование DNS записей (полный цикл как при создании SSL)
     if args.test_dns:
+        if args.iterations is not None and args.iterations < 1:
+            logger.error("--iterations должно быть не меньше 1")
+            return 1
         logger.info("=" * 80)
         logger.info("ТЕСТИРОВАНИЕ СОЗДАНИЯ DNS ЗАПИСИ ДЛЯ SSL")
         logger.info("=" * 80)
@@ -2063,7 +6793,8 @@ def main():
         logger.info("=" * 80)
         logger.info("")
         
-        api = RegRuAPI(config["regru_username"], config["regru_password"], logger)
+        api = create_regru_api(config, logger)
+        manager = LetsEncryptManager(config, api, logger)
         domain = config["domain"]
         test_subdomain = "_acme-challenge"
         test_value = f"test-value-{int(time.time())}"
@@ -2078,50 +6809,51 @@ def main():
         logger.info("✅ API доступен")
         logger.info("")
         
+        # Замер задержек: при --iterations (в т.ч. 1) или --report
+        if args.iterations is not None or args.report:
+            return run_dns_benchmark(config, manager, args.iterations or 1, args.report, logger)
+        
         # Шаг 2: Создание TXT записи
         logger.info("📋 ШАГ 2/4: Создание тестовой TXT записи")
         logger.info(f"   Домен: {domain}")
         logger.info(f"   Поддомен: {test_subdomain}")
         logger.info(f"   Значение: {test_value}")
         
-        if api.add_txt_record(domain, test_subdomain, test_value):
+        manager.capture_soa_baseline(domain)
+        add_result = api.batch().add_txt(domain, test_subdomain, test_value).submit()[0]
+        published_at = time.monotonic()
+        if add_result["success"]:
             logger.info("✅ TXT запись создана успешно")
         else:
-            logger.error("❌ Не удалось создать TXT запись")
+            logger.error(f"❌ Не удалось создать TXT запись: {add_result['error']}")
             all_passed = False
         logger.info("")
         
         if all_passed:
-            # Шаг 3: Ожидание распространения DNS
+            # Шаг 3: Ожидание распространения DNS (сначала авторитетные серверы зоны)
             logger.info("📋 ШАГ 3/4: Ожидание распространения DNS")
-            wait_time = config.get("dns_propagation_wait", 60)
-            logger.info(f"   Ожидаем {wait_time} секунд...")
-            
-            for i in range(wait_time):
-                if i % 10 == 0:
-                    logger.info(f"   ⏳ Прошло {i}/{wait_time} секунд")
-                time.sleep(1)
-            
-            logger.info("✅ Ожидание завершено")
+            if manager.wait_for_txt_values(domain, test_subdomain, [test_value], published_at):
+                logger.info("✅ Запись видна в DNS")
+            else:
+                logger.warning("⚠️  Запись не подтверждена за отведённое время")
             logger.info("")
             
-            # Проверка DNS через nslookup
-            logger.info("📋 ШАГ 3.5/4: Проверка DNS записи через nslookup")
+            # Проверка DNS через встроенный DNS клиент
+            logger.info("📋 ШАГ 3.5/4: Проверка DNS записи")
             full_domain = f"{test_subdomain}.{domain}"
             try:
-                result = subprocess.run(
-                    ["nslookup", "-type=TXT", full_domain],
-                    capture_output=True,
-                    text=True,
-                    timeout=10
+                resolver = DNSResolver(
+                    config.get("dns_nameservers") or None,
+                    config.get("dns_query_timeout", 3),
+                    logger
                 )
+                values = resolver.query_txt(full_domain)
                 
-                if test_value in result.stdout:
+                if test_value in values:
                     logger.info(f"✅ DNS запись найдена для {full_domain}")
-                    logger.info("   Вывод nslookup:")
-                    for line in result.stdout.split("\n"):
-                        if test_value in line or "text =" in line.lower():
-                            logger.info(f"   {line.strip()}")
+                    logger.info(f"   DNS серверы: {', '.join(resolver.nameservers)}")
+                    for value in values:
+                        logger.info(f"   {full_domain} text = \"{value}\"")
                 else:
                     logger.warning(f"⚠️  DNS запись НЕ найдена для {full_domain}")
                     logger.warning("   Это может быть нормально, если DNS ещё не распространился")
@@ -2133,10 +6865,11 @@ def main():
         
         # Шаг 4: Удаление тестовой записи
         logger.info("📋 ШАГ 4/4: Удаление тестовой записи")
-        if api.remove_txt_record(domain, test_subdomain, test_value):
+        remove_result = api.batch().remove_txt(domain, test_subdomain, test_value).submit()[0]
+        if remove_result["success"]:
             logger.info("✅ TXT запись удалена успешно")
         else:
-            logger.warning("⚠️  Не удалось удалить TXT запись (возможно уже удалена)")
+            logger.warning(f"⚠️  Не удалось удалить TXT запись (возможно уже удалена): {remove_result['error']}")
         
         logger.info("")
         logger.info("=" * 80)
@@ -2165,7 +6898,7 @@ def main():
         logger.info("ТЕСТИРОВАНИЕ ПОДКЛЮЧЕНИЯ К API REG.RU")
         logger.info("=" * 80)
         
-        api = RegRuAPI(config["regru_username"], config["regru_password"], logger)
+        api = create_regru_api(config, logger)
         
         # Тест подключения
         if api.test_api_access():
@@ -2216,12 +6949,7 @@ def main():
                 logger.info("ЗАГРУЗКА ТЕСТОВОГО СЕРТИФИКАТА В NGINX PROXY MANAGER")
                 logger.info("=" * 80)
                 
-                npm_api = NginxProxyManagerAPI(
-                    config["npm_host"],
-                    config["npm_email"],
-                    config["npm_password"],
-                    logger
-                )
+                npm_api = create_npm_api(config, logger)
                 
                 if npm_api.login():
                     cert_dir = os.path.join(config["cert_dir"], config["domain"])
@@ -2259,90 +6987,128 @@ def main():
             return 1
     
     # Обработка хуков для certbot
-    if args.auth_hook:
-        try:
-            logger.info("=" * 80)
-            logger.info("🔑 AUTH HOOK ВЫЗВАН")
-            logger.info("=" * 80)
-            
-            # Certbot передает домен и токен через переменные окружения
-            domain = os.environ.get("CERTBOT_DOMAIN")
-            token = os.environ.get("CERTBOT_VALIDATION")
-            
-            logger.info(f"CERTBOT_DOMAIN: {domain}")
-            logger.info(f"CERTBOT_VALIDATION: {token[:20]}..." if token else "CERTBOT_VALIDATION: None")
-            
-            if not domain or not token:
-                logger.error("CERTBOT_DOMAIN или CERTBOT_VALIDATION не установлены")
-                logger.error("Переменные окружения:")
-                for key in os.environ:
-                    if key.startswith("CERTBOT_"):
-                        logger.error(f"  {key}: {os.environ[key]}")
+    if args.auth_hook or args.cleanup_hook:
+        api = create_regru_api(config, logger)
+        manager = LetsEncryptManager(config, api, logger)
+        action = "auth" if args.auth_hook else "cleanup"
+        return run_certbot_hook(action, dict(os.environ), manager, logger)
+    
+    # Сервер hooks: держит API reg.ru, конфигурацию и логирование "тёплыми"
+    if args.hook_server:
+        api = create_regru_api(config, logger)
+        manager = LetsEncryptManager(config, api, logger)
+        socket_path = default_hook_socket_path(config)
+        server = HookServer(socket_path, manager, logger,
+                            config.get("hook_server_idle_timeout", 300))
+        server.serve_forever()
+        return 0
+    
+    # Встроенный DNS сервер для зон валидации (делегирование через CNAME)
+    if args.challenge_responder:
+        builtin = [conf for conf in config.get("challenge_backends", {}).values()
+                   if conf.get("type") == "builtin"]
+        if not builtin:
+            logger.error("В challenge_backends нет бэкендов типа builtin")
+            return 1
+        
+        # Один сервер на адрес и порт; бэкенды на общем адресе делят его настройки
+        groups: Dict[Tuple[str, int], List[Dict]] = {}
+        for conf in builtin:
+            groups.setdefault((conf.get("listen", "0.0.0.0"), conf.get("port", 53)), []).append(conf)
+        responders = []
+        for (listen, port), confs in groups.items():
+            settings = {(conf.get("store") or default_responder_store(config), conf.get("ns_name"),
+                         conf.get("ns_address"), conf.get("ttl", 1)) for conf in confs}
+            if len(settings) > 1:
+                logger.error(f"Бэкенды builtin на {listen}:{port} должны иметь одинаковые "
+                             "store, ns_name, ns_address и ttl")
                 return 1
-            
-            api = RegRuAPI(config["regru_username"], config["regru_password"], logger)
-            manager = LetsEncryptManager(config, api, logger)
-            success = manager.dns_challenge_hook(domain, token)
-            
-            if success:
-                logger.info("✅ AUTH HOOK ЗАВЕРШЕН УСПЕШНО")
-                return 0
-            else:
-                logger.error("❌ AUTH HOOK ЗАВЕРШИЛСЯ С ОШИБКОЙ")
+            store, ns_name, ns_address, ttl = settings.pop()
+            try:
+                responders.append(ChallengeResponder(
+                    [conf["zone"] for conf in confs], store, logger,
+                    listen=listen, port=port, ns_name=ns_name, ns_address=ns_address, ttl=ttl
+                ))
+            except ValueError as e:
+                logger.error(f"Бэкенд builtin на {listen}:{port}: {e}")
                 return 1
-                
-        except Exception as e:
-            logger.error(f"💥 КРИТИЧЕСКАЯ ОШИБКА В AUTH HOOK: {e}")
-            logger.exception("Traceback:")
-            return 1
+        
+        threads = [threading.Thread(target=responder.serve_forever, daemon=True,
+                                    name=f"challenge-responder-{responder.port}")
+                   for responder in responders]
+        for thread in threads:
+            thread.start()
+        # Завершаемся, если один из серверов остановился (например, порт занят)
+        while all(thread.is_alive() for thread in threads):
+            time.sleep(1)
+        logger.error("DNS сервер challenge остановлен")
+        return 1
     
-    if args.cleanup_hook:
+    # Сборка оставшихся TXT записей _acme-challenge
+    if args.gc_challenges:
+        logger.info("=" * 80)
+        logger.info("УДАЛЕНИЕ ОСТАВШИХСЯ TXT ЗАПИСЕЙ _acme-challenge")
+        logger.info("=" * 80)
+        
+        api = create_regru_api(config, logger)
+        manager = LetsEncryptManager(config, api, logger)
+        
+        min_age = args.gc_min_age if args.gc_min_age is not None else config.get("challenge_gc_min_age", 3600)
         try:
-            logger.info("=" * 80)
-            logger.info("🧹 CLEANUP HOOK ВЫЗВАН")
-            logger.info("=" * 80)
-            
-            domain = os.environ.get("CERTBOT_DOMAIN")
-            token = os.environ.get("CERTBOT_VALIDATION")
-            
-            logger.info(f"CERTBOT_DOMAIN: {domain}")
-            logger.info(f"CERTBOT_VALIDATION: {token[:20]}..." if token else "CERTBOT_VALIDATION: None")
-            
-            if not domain or not token:
-                logger.error("CERTBOT_DOMAIN или CERTBOT_VALIDATION не установлены")
-                logger.error("Переменные окружения:")
-                for key in os.environ:
-                    if key.startswith("CERTBOT_"):
-                        logger.error(f"  {key}: {os.environ[key]}")
+            zones = manager.certificate_zones()
+        except RegRuAPIError as e:
+            logger.error(f"❌ Ошибка API reg.ru: {e}")
+            return 1
+        
+        # Зоны аккаунтов на паузе после блокировки пропускаются, остальные обрабатываются
+        paused = [zone for zone in zones if api.cooldown_remaining([zone]) > 0]
+        if paused:
+            logger.warning(f"⏸️  Запросы к API reg.ru приостановлены для зон: {', '.join(paused)} "
+                           "(превышен лимит запросов), они пропускаются")
+            zones = [zone for zone in zones if zone not in paused]
+            if not zones:
                 return 1
-            
-            api = RegRuAPI(config["regru_username"], config["regru_password"], logger)
-            manager = LetsEncryptManager(config, api, logger)
-            success = manager.dns_cleanup_hook(domain, token)
-            
-            if success:
-                logger.info("✅ CLEANUP HOOK ЗАВЕРШЕН УСПЕШНО")
-                return 0
-            else:
-                logger.warning("⚠️ CLEANUP HOOK ЗАВЕРШИЛСЯ С ПРЕДУПРЕЖДЕНИЕМ (не критично)")
-                return 0  # Cleanup hook не должен блокировать получение сертификата
-                
-        except Exception as e:
-            logger.error(f"💥 ОШИБКА В CLEANUP HOOK: {e}")
-            logger.exception("Traceback:")
-            return 0  # Cleanup hook не должен блокировать получение сертификата
+        logger.info(f"Зоны: {', '.join(zones)}")
+        logger.info(f"Минимальный возраст записи: {min_age} сек")
+        logger.info("")
+        
+        try:
+            found, removed = manager.gc_challenges(
+                zones, min_age, args.dry_run, config.get("challenge_gc_batch_size", 50),
+                args.gc_include_unknown
+            )
+        except RegRuAPIError as e:
+            logger.error(f"❌ Ошибка API reg.ru: {e}")
+            return 1
+        return 0 if (args.dry_run or removed == found) and not paused else 1
     
     # Проверка прав root
     if os.geteuid() != 0:
         logger.error("Скрипт должен быть запущен от имени root (sudo)")
         return 1
     
+    # Автоматический режим - если не выбрана другая команда
+    auto_mode = not any((args.info, args.check, args.staging, args.obtain, args.renew,
+                         args.list_npm, args.delete_npm, args.upload_npm))
+    
+    # Быстрый выход --auto: решение по локальному состоянию, без сети
+    if auto_mode and auto_nothing_due(config, logger):
+        return 0
+    
     # Инициализация API и менеджера
-    api = RegRuAPI(config["regru_username"], config["regru_password"], logger)
+    api = create_regru_api(config, logger)
     manager = LetsEncryptManager(config, api, logger)
     
+    # Авто-режим: обновление нужно, если сертификата нет или он скоро истекает
+    renewal_days = config.get("renewal_days", 30)
+    days_left = manager.check_certificate_expiry() if auto_mode else None
+    renewal_due = auto_mode and (days_left is None or days_left < renewal_days)
+    
+    # Режимы, которым не нужны ни certbot, ни IP адрес, ни API reg.ru
+    local_only = args.check or args.info or args.list_npm or (auto_mode and not renewal_due)
+    
     # Проверка certbot
-    if not manager.check_certbot_installed():
+    if not local_only and not manager.check_certbot_installed():
         logger.error("Установите certbot: apt-get install certbot")
         return 1
     
@@ -2350,16 +7116,39 @@ def main():
     logger.info("СКРИПТ УПРАВЛЕНИЯ SSL СЕРТИФИКАТАМИ LET'S ENCRYPT")
     logger.info("=" * 60)
     
-    # Получаем текущий IP
-    try:
-        ip_response = requests.get("https://api.ipify.org", timeout=5)
-        current_ip = ip_response.text
-        logger.info(f"Текущий IP адрес: {current_ip}")
-    except:
-        logger.warning("Не удалось определить IP адрес")
+    # Получаем текущий IP (из кэша или первый ответ сервисов)
+    if not local_only:
+        current_ip = api.get_current_ip()
+        if current_ip != "Неизвестно":
+            logger.info(f"Текущий IP адрес: {current_ip}")
+        else:
+            logger.warning("Не удалось определить IP адрес")
+    
+    # Пауза после блокировки по лимиту запросов: не продлеваем блокировку.
+    # API reg.ru нужен только для выпуска и обновления, и то не всегда:
+    # если все домены делегированы в бэкенды не на reg.ru, он не используется.
+    # Остальные команды не выполняют даже DNS запросы делегирования
+    issuance = args.staging or args.obtain or args.renew or renewal_due
+    needs_regru = issuance and manager.needs_regru_api()
+    regru_cooldown = 0
+    if needs_regru:
+        # Пауза учитывается только для аккаунтов зон этого сертификата
+        try:
+            cert_zones = manager.certificate_zones()
+        except Exception as e:
+            logger.debug(f"Не удалось определить зоны сертификата: {e}")
+            cert_zones = None
+        regru_cooldown = api.cooldown_remaining(cert_zones)
+    elif auto_mode:
+        # Авто-режим без выпуска только удаляет отложенные TXT записи
+        regru_cooldown = api.cooldown_remaining()
+    if regru_cooldown > 0:
+        logger.warning(f"⏸️  Запросы к API reg.ru приостановлены ещё на {int(regru_cooldown)} сек "
+                       "(превышен лимит запросов)")
+        logger.warning("   Операции, требующие API reg.ru, в этом запуске пропускаются")
     
     # Проверка доступности API reg.ru (кроме режимов только проверки)
-    if not args.check:
+    if needs_regru and not regru_cooldown:
         logger.info("Проверка доступности API reg.ru...")
         if not api.test_api_access():
             logger.error("=" * 80)
@@ -2476,6 +7265,10 @@ def main():
         logger.info("⚠️  НЕ используйте staging сертификаты на production сайтах!")
         logger.info("")
         
+        if regru_cooldown > 0:
+            logger.error("Получение сертификата отложено: действует пауза в запросах к API reg.ru")
+            return 1
+        
         success = manager.obtain_certificate(staging=True)
         
         if success:
@@ -2503,10 +7296,14 @@ def main():
                 logger.warning("⚠️  Staging сертификат НЕ загружается в Nginx Proxy Manager")
                 logger.warning("   (staging сертификаты не предназначены для production)")
         
+        manager.drain_cleanup_queue()
         return 0 if success else 1
     
     elif args.obtain:
         # Принудительное получение нового сертификата
+        if regru_cooldown > 0:
+            logger.error("Получение сертификата отложено: действует пауза в запросах к API reg.ru")
+            return 1
         success = manager.obtain_certificate(staging=False)
         if success:
             manager.display_certificate_info()
@@ -2514,25 +7311,25 @@ def main():
             
             # Синхронизация с Nginx Proxy Manager
             if config.get("npm_enabled", False):
-                npm_api = NginxProxyManagerAPI(
-                    config["npm_host"],
-                    config["npm_email"],
-                    config["npm_password"],
-                    logger
-                )
+                npm_api = create_npm_api(config, logger)
                 if manager.sync_with_npm(npm_api):
                     logger.info("Сертификат успешно добавлен в Nginx Proxy Manager")
                 else:
                     logger.warning("Не удалось синхронизировать сертификат с NPM")
             
             logger.info("Новый сертификат успешно создан")
+            manager.drain_cleanup_queue()
             return 0
         else:
             logger.error("Не удалось получить сертификат")
+            manager.drain_cleanup_queue()
             return 1
     
     elif args.renew:
         # Обновление существующего сертификата
+        if regru_cooldown > 0:
+            logger.error("Обновление сертификата отложено: действует пауза в запросах к API reg.ru")
+            return 1
         success = manager.renew_certificate()
         if success:
             manager.display_certificate_info()
@@ -2540,21 +7337,18 @@ def main():
             
             # Синхронизация с Nginx Proxy Manager
             if config.get("npm_enabled", False):
-                npm_api = NginxProxyManagerAPI(
-                    config["npm_host"],
-                    config["npm_email"],
-                    config["npm_password"],
-                    logger
-                )
+                npm_api = create_npm_api(config, logger)
                 if manager.sync_with_npm(npm_api):
                     logger.info("Сертификат успешно обновлен в Nginx Proxy Manager")
                 else:
                     logger.warning("Не удалось синхронизировать сертификат с NPM")
             
             logger.info("Сертификат успешно обновлен")
+            manager.drain_cleanup_queue()
             return 0
         else:
             logger.error("Не удалось обновить сертификат")
+            manager.drain_cleanup_queue()
             return 1
     
     elif args.list_npm:
@@ -2567,12 +7361,7 @@ def main():
             logger.error("NPM не настроен в конфигурации!")
             return 1
         
-        npm_api = NginxProxyManagerAPI(
-            config["npm_host"],
-            config["npm_email"],
-            config["npm_password"],
-            logger
-        )
+        npm_api = create_npm_api(config, logger)
         
         if not npm_api.login():
             logger.error("Не удалось подключиться к NPM")
@@ -2640,12 +7429,7 @@ def main():
             logger.error("NPM не настроен в конфигурации!")
             return 1
         
-        npm_api = NginxProxyManagerAPI(
-            config["npm_host"],
-            config["npm_email"],
-            config["npm_password"],
-            logger
-        )
+        npm_api = create_npm_api(config, logger)
         
         if not npm_api.login():
             logger.error("Не удалось подключиться к NPM")
@@ -2785,12 +7569,7 @@ def main():
         
         # Подключаемся к NPM
         logger.info("Подключение к Nginx Proxy Manager...")
-        npm_api = NginxProxyManagerAPI(
-            config["npm_host"],
-            config["npm_email"],
-            config["npm_password"],
-            logger
-        )
+        npm_api = create_npm_api(config, logger)
         
         if not npm_api.login():
             logger.error("Не удалось подключиться к NPM")
@@ -2824,6 +7603,7 @@ def main():
             logger.info("Обновление сертификата...")
             
             if npm_api.update_certificate(cert_id, cert_path, key_path):
+                manager.cert_state.mark_synced(domain, cert_path, cert_id)
                 logger.info("")
                 logger.info("=" * 80)
                 logger.info("✅ СЕРТИФИКАТ УСПЕШНО ОБНОВЛЕН В NPM")
@@ -2832,14 +7612,11 @@ def main():
                 logger.info(f"Домен: {domain}")
                 logger.info("")
                 
-                # Проверяем результат
-                updated_certs = npm_api.get_certificates()
-                for cert in updated_certs:
-                    if cert.get("id") == cert_id:
-                        expires = cert.get("expires_on", "Unknown")
-                        logger.info(f"Статус в NPM: {cert.get('provider', 'Unknown')}")
-                        logger.info(f"Истекает: {expires}")
-                        break
+                # Проверяем результат (данные после обновления уже в индексе)
+                cert = npm_api.index.get(cert_id) if npm_api.index else None
+                if cert:
+                    logger.info(f"Статус в NPM: {cert.get('provider', 'Unknown')}")
+                    logger.info(f"Истекает: {cert.get('expires_on', 'Unknown')}")
                 
                 return 0
             else:
@@ -2852,6 +7629,7 @@ def main():
             result = npm_api.upload_certificate(domain, cert_path, key_path)
             if result:
                 cert_id = result.get("id")
+                manager.cert_state.mark_synced(domain, cert_path, cert_id)
                 logger.info("")
                 logger.info("=" * 80)
                 logger.info("✅ СЕРТИФИКАТ УСПЕШНО ЗАГРУЖЕН В NPM")
@@ -2860,22 +7638,11 @@ def main():
                 logger.info(f"Домен: {domain}")
                 logger.info("")
                 
-                # Проверяем результат (повторно получаем из NPM, если возможно)
-                try:
-                    final = npm_api.get_certificate_by_id(cert_id)
-                    if final:
-                        provider = final.get('provider', result.get('provider', 'Unknown'))
-                        expires = final.get('expires_on', result.get('expires_on', 'Unknown'))
-                        domains = final.get('domain_names', [])
-                        logger.info(f"Статус в NPM: {provider}")
-                        logger.info(f"Домены: {', '.join(domains) if domains else '[пока не распознаны]'}")
-                        logger.info(f"Истекает: {expires}")
-                    else:
-                        logger.info(f"Статус в NPM: {result.get('provider', 'Unknown')}")
-                        logger.info(f"Истекает: {result.get('expires_on', 'Unknown')}")
-                except Exception:
-                    logger.info(f"Статус в NPM: {result.get('provider', 'Unknown')}")
-                    logger.info(f"Истекает: {result.get('expires_on', 'Unknown')}")
+                # upload_certificate уже вернул итоговые данные после парсинга NPM
+                domains = result.get('domain_names', [])
+                logger.info(f"Статус в NPM: {result.get('provider', 'Unknown')}")
+                logger.info(f"Домены: {', '.join(domains) if domains else '[пока не распознаны]'}")
+                logger.info(f"Истекает: {result.get('expires_on', 'Unknown')}")
                 logger.info("")
                 logger.info("Теперь вы можете использовать этот сертификат в Proxy Hosts")
                 return 0
@@ -2889,12 +7656,18 @@ def main():
         logger.info("АВТОМАТИЧЕСКАЯ ПРОВЕРКА И ОБНОВЛЕНИЕ СЕРТИФИКАТА")
         logger.info("=" * 60)
         
-        # Получаем порог для обновления из конфигурации
-        renewal_days = config.get("renewal_days", 30)
+        # Удаляем TXT записи, отложенные прошлыми запусками
+        if regru_cooldown == 0:
+            manager.drain_cleanup_queue()
+        
+        # Порог обновления из конфигурации; срок действия проверен выше
         logger.info(f"Порог обновления: {renewal_days} дней до истечения")
         
-        # Проверяем срок действия сертификата
-        days_left = manager.check_certificate_expiry()
+        if (days_left is None or days_left < renewal_days) and regru_cooldown > 0:
+            # Не тратим попытку выпуска: следующий запуск таймера повторит после паузы
+            logger.warning("Сертификат требует обновления, но действует пауза в запросах к API reg.ru")
+            logger.warning("Обновление будет выполнено при следующем запуске после окончания паузы")
+            return 1
         
         if days_left is None:
             # Сертификат не существует - создаем новый
@@ -2920,20 +7693,13 @@ def main():
             logger.info("=" * 60)
             manager.display_certificate_info()
             
-            # Проверяем синхронизацию с NPM даже если сертификат действителен
+            # Синхронизация с NPM, если текущий сертификат туда ещё не загружен
             if config.get("npm_enabled", False):
-                logger.info("Проверка синхронизации с Nginx Proxy Manager...")
-                npm_api = NginxProxyManagerAPI(
-                    config["npm_host"],
-                    config["npm_email"],
-                    config["npm_password"],
-                    logger
-                )
-                existing_cert = npm_api.login() and npm_api.find_certificate_by_domain(manager.domain)
-                if existing_cert:
-                    logger.info(f"Сертификат найден в NPM (ID: {existing_cert.get('id')})")
+                if manager.npm_in_sync():
+                    logger.info("Сертификат уже загружен в Nginx Proxy Manager")
                 else:
-                    logger.info("Сертификат не найден в NPM. Синхронизация...")
+                    logger.info("Загрузка текущего сертификата в NPM не подтверждена. Сверка с NPM...")
+                    npm_api = create_npm_api(config, logger)
                     if manager.sync_with_npm(npm_api):
                         logger.info("Сертификат успешно синхронизирован с NPM")
             
@@ -2954,12 +7720,7 @@ def main():
                 logger.info("СИНХРОНИЗАЦИЯ С NGINX PROXY MANAGER")
                 logger.info("=" * 60)
                 
-                npm_api = NginxProxyManagerAPI(
-                    config["npm_host"],
-                    config["npm_email"],
-                    config["npm_password"],
-                    logger
-                )
+                npm_api = create_npm_api(config, logger)
                 if manager.sync_with_npm(npm_api):
                     logger.info(f"✅ Сертификат успешно {action} в Nginx Proxy Manager")
                 else:
@@ -2968,9 +7729,11 @@ def main():
             logger.info("=" * 60)
             logger.info("ОПЕРАЦИЯ ЗАВЕРШЕНА УСПЕШНО")
             logger.info("=" * 60)
+            manager.drain_cleanup_queue()
             return 0
         else:
             logger.error("Операция завершилась с ошибкой")
+            manager.drain_cleanup_queue()
             return 1
 
 